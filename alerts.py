@@ -0,0 +1,163 @@
+'''Overdue and at risk load alerts.
+
+Every open load gets an ETA: today plus the days needed to drive its remaining miles, at
+ALERT_SOLO_MILES_PER_DAY, or ALERT_TEAM_MILES_PER_DAY for team drivers. A load is overdue once its
+due date has passed, and at risk when its ETA is after its due date.
+
+evaluate_alerts checks every user's open loads with set based statements (one upsert of the flagged
+loads, one delete of the alerts that no longer apply), so it costs the same few statements however
+many loads there are. Alerts live in the load_alerts table, which the load board reads by primary
+key, and new or changed alerts are handed to a sink: the log, or a webhook (ALERT_SINK).
+'''
+from collections import namedtuple
+from datetime import date
+from flask import current_app
+from sqlalchemy import Date, Float, Integer, case, cast, exists, func, literal, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Load, LoadAlert
+from metrics import external_call
+from config import DEFAULT_SOLO_MILES_PER_DAY, DEFAULT_TEAM_MILES_PER_DAY, DEFAULT_SINK
+
+DEFAULT_WEBHOOK_TIMEOUT = 5
+# Alerts posted to a webhook per request.
+WEBHOOK_BATCH_SIZE = 500
+# Only one evaluation runs at a time, so the same alert isn't sent twice.
+ADVISORY_LOCK_KEY = 4240020
+
+KINDS = ('overdue', 'at_risk')
+
+# A new or changed alert.
+Alert = namedtuple('Alert', ['load_id', 'user_id', 'kind', 'due_date', 'eta'])
+
+# What one evaluation did: the new or changed alerts (None if another evaluation was already running),
+# the number of alerts that no longer apply and the number of alerts left.
+Evaluation = namedtuple('Evaluation', ['raised', 'resolved', 'total'])
+
+
+def _rates():
+    '''Returns the (solo, team) miles per day.'''
+    config = current_app.config
+    return (float(config.get('ALERT_SOLO_MILES_PER_DAY', DEFAULT_SOLO_MILES_PER_DAY)),
+            float(config.get('ALERT_TEAM_MILES_PER_DAY', DEFAULT_TEAM_MILES_PER_DAY)))
+
+
+def eta_expression(today):
+    '''SQL for the date a load arrives if it leaves today.'''
+    solo, team = _rates()
+    miles_per_day = case([(Load.team == 1, team)], else_=solo)
+    days = cast(func.ceil(cast(Load.miles, Float) / miles_per_day), Integer)
+    return literal(today, Date) + days
+
+
+def flagged_condition(today):
+    '''SQL that is true for the open loads that need an alert.'''
+    return ((Load.delivered == 0) & (Load.miles_pending == 0) & Load.due_date.isnot(None)
+            & or_(Load.due_date < today, eta_expression(today) > Load.due_date))
+
+
+def _utcnow():
+    '''SQL for the current UTC time, as the other tables store it.'''
+    return func.timezone('utc', func.now())
+
+
+def evaluate_alerts(today=None, sink=None):
+    '''Brings load_alerts up to date with every open load and sends new or changed alerts to the sink.'''
+    today = today or date.today()
+    if not db.session.execute(select([func.pg_try_advisory_xact_lock(ADVISORY_LOCK_KEY)])).scalar():
+        db.session.rollback()
+        return Evaluation(None, 0, 0)
+    table = LoadAlert.__table__
+    flagged = (select([Load.id, Load.user_id, case([(Load.due_date < today, 'overdue')], else_='at_risk'), Load.due_date, eta_expression(today), _utcnow(), _utcnow()])
+               .where(flagged_condition(today)))
+    stmt = insert(table).from_select(['load_id', 'user_id', 'kind', 'due_date', 'eta', 'created_at', 'updated_at'], flagged)
+    # Alerts that haven't changed aren't written again, or sent again.
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['load_id'],
+        set_={'kind': stmt.excluded.kind, 'due_date': stmt.excluded.due_date, 'eta': stmt.excluded.eta, 'updated_at': _utcnow()},
+        where=(table.c.kind != stmt.excluded.kind) | (table.c.eta != stmt.excluded.eta) | (table.c.due_date != stmt.excluded.due_date))
+    raised = [Alert(*row) for row in db.session.execute(stmt.returning(table.c.load_id, table.c.user_id, table.c.kind, table.c.due_date, table.c.eta))]
+    still_flagged = exists().where(Load.id == table.c.load_id).where(flagged_condition(today))
+    resolved = db.session.execute(table.delete().where(~still_flagged)).rowcount
+    total = db.session.execute(select([func.count()]).select_from(table)).scalar()
+    db.session.commit()
+    if raised:
+        (sink or get_sink()).send(raised)
+    return Evaluation(raised, resolved, total)
+
+
+def clear_alerts(load_ids):
+    '''Drops the alerts of loads that were just delivered, inside the current transaction.'''
+    if load_ids:
+        LoadAlert.query.filter(LoadAlert.load_id.in_(load_ids)).delete(synchronize_session=False)
+
+
+def get_load_alerts(user_id, load_ids):
+    '''Returns {load id: LoadAlert} for the given loads.'''
+    if not load_ids:
+        return {}
+    return {alert.load_id: alert for alert in LoadAlert.query.for_user(user_id).filter(LoadAlert.load_id.in_(load_ids))}
+
+
+def count_alerts(user_id):
+    '''Returns the user's number of alerts of each kind.'''
+    counts = dict.fromkeys(KINDS, 0)
+    counts.update(db.session.query(LoadAlert.kind, func.count()).for_user(user_id).group_by(LoadAlert.kind))
+    return counts
+
+#
+# SINKS
+#
+
+class AlertSink:
+    '''Interface for things that pass alerts on.'''
+
+    def send(self, alerts):
+        '''Delivers a list of Alert.'''
+        raise NotImplementedError
+
+
+class LogSink(AlertSink):
+    '''Writes alerts to a log, the app's logger by default.'''
+
+    def __init__(self, log=None):
+        self.log = log
+
+    def send(self, alerts):
+        log = self.log or current_app.logger.warning
+        for alert in alerts:
+            log(f'Load {alert.load_id} of user {alert.user_id} is {alert.kind.replace("_", " ")}: due {alert.due_date}, ETA {alert.eta}')
+
+
+class WebhookSink(AlertSink):
+    '''Posts alerts as JSON to a URL, a batch at a time. Failed batches are logged and dropped.'''
+
+    def __init__(self, url, timeout=DEFAULT_WEBHOOK_TIMEOUT, batch_size=WEBHOOK_BATCH_SIZE):
+        self.url = url
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+    def send(self, alerts):
+        import requests
+        for start in range(0, len(alerts), self.batch_size):
+            batch = [dict(alert._asdict(), due_date=str(alert.due_date), eta=str(alert.eta)) for alert in alerts[start:start + self.batch_size]]
+            try:
+                with external_call():
+                    requests.post(self.url, json={'alerts': batch}, timeout=self.timeout).raise_for_status()
+            except requests.RequestException as ex:
+                current_app.logger.error(f'Could not post {len(batch)} alerts to {self.url}: {ex}')
+
+
+def get_sink():
+    '''Returns the app's alert sink, building it from the config on first use.
+
+    ALERT_SINK is 'log' (the default) or 'webhook', which posts to ALERT_WEBHOOK_URL.
+    '''
+    sink = current_app.extensions.get('alert_sink')
+    if sink is None:
+        config = current_app.config
+        if config.get('ALERT_SINK', DEFAULT_SINK) == 'webhook':
+            sink = WebhookSink(config['ALERT_WEBHOOK_URL'], timeout=config.get('ALERT_WEBHOOK_TIMEOUT', DEFAULT_WEBHOOK_TIMEOUT))
+        else:
+            sink = LogSink()
+        current_app.extensions['alert_sink'] = sink
+    return sink
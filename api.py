@@ -0,0 +1,206 @@
+'''Versioned JSON API. Batch endpoints change many loads in one request and one transaction.'''
+from functools import wraps
+from flask import Blueprint, jsonify, request, session
+from models import db, User, Load, Carrier, DistributionCenter
+from helper import tenant_query, get_board_filters, get_page_size, encode_cursor, decode_cursor
+from kpi import get_user_kpis
+from forecast import score_open_loads
+from passwords import login_wait, PasswordsBusy
+from lifecycle import deliver_loads, update_locations, upsert_load_data
+from events import get_timeline, timeline_to_dict
+from refdata import get_choices
+from scorecard import rank_carriers, DEFAULT_TOP
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Largest number of items accepted by a batch endpoint.
+MAX_BATCH = 1000
+
+
+def error(message, status=400):
+    '''Returns a JSON error response.'''
+    return jsonify({'error': message}), status
+
+
+def login_required(view):
+    '''Rejects API requests that don't have a logged in session.'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'user_id' not in session:
+            return error('You must be logged in.', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def batch(key):
+    '''Reads a list of items from the JSON body, or returns an error response.'''
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return None, error(f'Expected a JSON object with a "{key}" list.')
+    if len(items) > MAX_BATCH:
+        return None, error(f'Batches are limited to {MAX_BATCH} items.', 413)
+    return items, None
+
+
+def commit_results(results, key='id'):
+    '''Commits a batch and turns its {id: status} results into a JSON response.'''
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        return error('Something went wrong, nothing was saved.', 500)
+    return jsonify({'results': [{key: id, 'status': status} for id, status in results.items()]})
+
+
+def load_to_dict(load):
+    '''Serializes a load.'''
+    return {
+        'id': load.id,
+        'po': load.po,
+        'name': load.name,
+        'pickup_city': load.pickup_city,
+        'pickup_state': load.pickup_state,
+        'due_date': str(load.due_date) if load.due_date else None,
+        'day_of_week': load.day_of_week,
+        'temp': load.temp,
+        'team': load.team,
+        'miles': load.miles,
+        'delivered': load.delivered,
+        'carrier_id': load.carrier_id,
+        'd_c_id': load.d_c_id,
+    }
+
+#
+# SESSION
+#
+
+@api.route('/session', methods=['POST'])
+def login():
+    '''Logs in with a JSON username and password.'''
+    body = request.get_json(silent=True) or {}
+    username = body.get('username')
+    wait = login_wait(username if isinstance(username, str) else None)
+    if wait:
+        response, status = error('Too many login attempts.', 429)
+        response.headers['Retry-After'] = str(int(wait) + 1)
+        return response, status
+    try:
+        user = User.authenticate(username=username, password=str(body.get('password') or ''))
+    except PasswordsBusy:
+        return error('Too many logins right now, try again shortly.', 503)
+    if not user:
+        return error('Username/Password is incorrect.', 401)
+    session['user_id'] = user.id
+    return jsonify({'user_id': user.id})
+
+
+@api.route('/session', methods=['DELETE'])
+def logout():
+    '''Logs out.'''
+    session.pop('user_id', None)
+    return jsonify({})
+
+#
+# READS
+#
+
+@api.route('/loads')
+@login_required
+def open_loads():
+    '''Returns one page of open loads. Takes the same filters and cursor as the load board.'''
+    per_page = get_page_size(request.args)
+    loads = Load.get_open_loads_page(user_id=session['user_id'], after=decode_cursor(request.args.get('after')), limit=per_page, **get_board_filters(request.args))
+    next_cursor = None
+    if len(loads) > per_page:
+        loads = loads[:per_page]
+        next_cursor = encode_cursor(loads[-1])
+    return jsonify({'loads': [load_to_dict(load) for load in loads], 'next': next_cursor})
+
+
+@api.route('/kpis')
+@login_required
+def kpis():
+    '''Returns the user's KPI's.'''
+    return jsonify(get_user_kpis(user_id=session['user_id'])._asdict())
+
+
+@api.route('/forecast')
+@login_required
+def forecast():
+    '''Returns the forecast cost and on time probability of every open load, empty without enough delivered loads.'''
+    scored = score_open_loads(user_id=session['user_id'])
+    if scored is None:
+        return jsonify({'loads': []})
+    model, ids, carrier_ids, cost, ontime = scored
+    return jsonify({'loads': [{'id': int(id), 'carrier_id': int(carrier_id), 'cost': round(float(c), 2), 'ontime': round(float(p), 3)}
+                              for id, carrier_id, c, p in zip(ids, carrier_ids, cost, ontime)]})
+
+@api.route('/places')
+@login_required
+def places():
+    '''Returns the user's DC's and carriers with their coordinates, for maps. Places not geocoded yet have null coordinates,
+    and approximate is 1 for places only found in their state.'''
+    places = {}
+    for kind, model in (('dcs', DistributionCenter), ('carriers', Carrier)):
+        query = db.session.query(model.id, model.name, model.city, model.state, model.latitude, model.longitude, model.approximate).for_user(session['user_id'])
+        places[kind] = [row._asdict() for row in query.order_by(model.id)]
+    return jsonify(places)
+
+
+@api.route('/carriers/ranked')
+@login_required
+def ranked_carriers():
+    '''Returns the best carriers for a load going to a D.C. (d_c_id), or anywhere. limit defaults to 5.'''
+    user_id = session['user_id']
+    names = dict(get_choices(user_id=user_id, kind='carriers'))
+    ranks = rank_carriers(user_id, list(names), d_c_id=request.args.get('d_c_id', type=int), limit=max(1, request.args.get('limit', DEFAULT_TOP, type=int)))
+    return jsonify({'carriers': [dict(rank._asdict(), name=names[rank.carrier_id]) for rank in ranks]})
+
+
+@api.route('/loads/<int:load_id>/events')
+@login_required
+def load_events(load_id):
+    '''Returns a load's timeline: every change in order, and its transit time once delivered.'''
+    if not tenant_query(Load.id).filter_by(id=load_id).first():
+        return error('That load could not be found.', 404)
+    return jsonify(timeline_to_dict(get_timeline(load_id)))
+
+#
+# BATCH WRITES
+#
+
+@api.route('/loads/delivered', methods=['POST'])
+@login_required
+def mark_delivered():
+    '''Marks many loads delivered. Body: {"load_ids": [1, 2, ...]}'''
+    load_ids, response = batch('load_ids')
+    if response:
+        return response
+    if not all(isinstance(id, int) for id in load_ids):
+        return error('load_ids must be whole numbers.')
+    return commit_results(deliver_loads(user_id=session['user_id'], load_ids=load_ids))
+
+
+@api.route('/loads/locations', methods=['POST'])
+@login_required
+def move_loads():
+    '''Updates the location of many loads. Body: {"loads": [{"id": 1, "city": "Dallas", "state": "TX"}, ...]}'''
+    updates, response = batch('loads')
+    if response:
+        return response
+    if not all(isinstance(update, dict) and isinstance(update.get('id'), int) for update in updates):
+        return error('Every load needs a whole number id.')
+    return commit_results(update_locations(user_id=session['user_id'], updates=updates))
+
+
+@api.route('/load_data', methods=['PUT'])
+@login_required
+def put_load_data():
+    '''Creates or updates the data of many loads. Body: {"load_data": [{"load_id": 1, "cost": 1000, ...}, ...]}'''
+    records, response = batch('load_data')
+    if response:
+        return response
+    if not all(isinstance(record, dict) and isinstance(record.get('load_id'), int) for record in records):
+        return error('Every record needs a whole number load_id.')
+    return commit_results(upsert_load_data(user_id=session['user_id'], records=records), key='load_id')
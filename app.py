@@ -1,253 +1,77 @@
-from flask import Flask, request, render_template, redirect, flash, session, jsonify
-from models import db, connect_db, User, DistributionCenter, Load, Carrier, LoadData
-from forms import LoginForm, SignupForm, DCCarrierForm, LoadForm, UpdateLocationForm, LoadDataForm
-from helper import get_user_carriers, get_dc, get_miles, ontime_KPI, damages_KPI, breakdown_KPI, avg_cost_load, cost_per_pallet, cost_per_lbs, try_commit, try_commit_rollback, try_signup
+'''The app factory. Importing this module is cheap: it only needs the setting defaults in config.py.
+The models, pages, API and CLI commands are imported by create_app, and the distance client,
+password hashing and forecast models load their libraries the first time they are used.
+
+    app = create_app()
+'''
+from flask import Flask
+from config import (DEFAULT_LOG_ROUNDS, DEFAULT_POOL_SIZE, DEFAULT_RATE_PER_USER, DEFAULT_RATE_PER_IP, STATEMENT_TIMEOUT,
+                    DEFAULT_FLUSH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_BUFFER, DEFAULT_SOLO_MILES_PER_DAY, DEFAULT_TEAM_MILES_PER_DAY, DEFAULT_SINK)
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 # from secret import MAP_QUEST_KEY, MAP_QUEST_SECRET
 
-app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///freight_db')
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'This_is_a_secret!')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['CONSUMER_KEY'] = os.environ.get('CONSUMER_KEY')
-app.config['CONSUMER_SECRET'] = os.environ.get('CONSUMER_SECRET')
-
-connect_db(app)
-
-# 
-# LANDING PAGE
-# 
-
-@app.route('/')
-def home():
-    '''Renders home screen or user's manage page.'''
-    # Checks if user id in session and directs accordingly!
-    if 'user_id' in session:
-        return redirect('/manage')
-    return render_template('home.html')
-
-# 
-# Login, SignUp, and Logout views
-# 
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    '''Renders and handles the login.'''
-    form = LoginForm()
-    if form.validate_on_submit():
-        username = form.username.data
-        password = form.password.data
-        # Checks user credentials
-        user = User.authenticate(username=username, password=password)
-        # If user is authenticated we set users session.
-        if user:
-            session['user_id'] = user.id
-            flash(f'Welcome back {username}!', 'alert-success')
-            return redirect('/manage')
-        else:
-            flash('Username/Password is incorrect.', 'alert-danger')
-    return render_template('login.html', form=form)
-
-@app.route('/signup', methods=['GET', 'POST'])
-def signup():
-    '''Renders and handles the signup.'''
-    form = SignupForm()
-    if form.validate_on_submit():
-        username = form.username.data
-        password = form.password.data
-        # Signs user up
-        user = User.singup(username=username, password=password)
-        # Verifies if user was created before commiting to database
-        if user:
-            db.session.add(user)
-            return try_signup(id=user.id, success='User was created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/', duplicate='You already have an account. Please login!')
-    return render_template('signup.html', form=form)
-
-@app.route('/logout', methods=['POST'])
-def logout():
-    '''Handles logging out a user.'''
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    session.pop('user_id')
-    flash("You've been logged out!", 'alert-success')
-    return redirect('/')
-
-# 
-# USER VIEWS
-# 
-
-@app.route('/manage', methods=['GET', 'POST'])
-def user_portal():
-    '''Renders the user portal.'''
-    # Checks if user has been autherized prior to allowing entrance to route.
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    # Grabs all loads.
-    loads = Load.query.filter(Load.delivered==0, Load.user_id==session['user_id']).all()
-    # Sets forms carrier and DC options.
-    tup_carriers = get_user_carriers()
-    tup_dc = get_dc()
-    # Selectfield form values.
-    form = LoadForm()
-    form.carrier_id.choices = tup_carriers
-    form.d_c_id.choices = tup_dc
-    if form.validate_on_submit():
-        po = form.po.data
-        name = form.name.data
-        city = form.city.data
-        state = form.state.data
-        due_date = form.due_date.data
-        day_of_week = form.day_of_week.data
-        temp = form.temp.data
-        team = form.team.data
-        carrier_id = form.carrier_id.data
-        d_c_id = form.d_c_id.data
-        # Calls MapQuest API to get distance
-        miles = get_miles(app=app.config['CONSUMER_KEY'], dc_id=d_c_id, city=city, state=state)
-        # Creates load object 
-        load = Load(po=po, name=name, pickup_city=city, pickup_state=state, due_date=due_date, day_of_week=day_of_week, temp=temp, team=team, miles=miles, carrier_id=carrier_id, d_c_id=d_c_id, user_id=session['user_id'])
-        if load:
-            try:
-                db.session.add(load)
-                db.session.commit()
-                # After the load has been commited we create the load data so that a user can add/edit from one route.
-                data = LoadData(load_id=load.id, user_id=session['user_id'])
-                db.session.add(data)
-                db.session.commit()
-                flash('Load created!', 'alert-success')
-            except Exception as ex:
-                flash('Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', 'alert-danger')
-            return redirect('/manage')
-    return render_template('user/portal.html', form=form, loads=loads)
-
-@app.route('/locations', methods=['GET', 'POST'])
-def locations():
-    '''Renders and handles DC locations users add.'''
-    # Checks if user has been autherized prior to allowing entrance to route.
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    form = DCCarrierForm()
-    # Grabs all user DC locations
-    dc = DistributionCenter.get_dist_by_user(user_id=session['user_id'])
-    if form.validate_on_submit():
-        name = form.name.data
-        address = form.address.data
-        city = form.city.data
-        state = form.state.data
-        zip = form.zip.data
-        phone = form.phone.data
-        # Creates a new DC location
-        dc = DistributionCenter(name=name, address=address, city=city, state=state, zip=zip, phone=phone, user_id=session['user_id'])
-        # If location was created, we commit.
-        if dc:
-            db.session.add(dc)
-            return try_commit_rollback(success='Location created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/locations', duplicate="Location has already been added by another user. Locations have to be unqiue to each user. See our FAQ's for more info.")
-    return render_template('user/locations.html', form=form, dc=dc)
-
-@app.route('/carriers', methods=['GET', 'POST'])
-def carriers():
-    '''Renders and handles carriers the user adds.'''
-    # Checks if user has been autherized prior to allowing entrance to route.
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    form = DCCarrierForm()
-    # Grabs all the carrier information.
-    carriers = Carrier.get_carrier_by_user(user_id=session['user_id'])
-    if form.validate_on_submit():
-        name = form.name.data
-        address = form.address.data
-        city = form.city.data
-        state = form.state.data
-        zip = form.zip.data
-        phone = form.phone.data
-        # Creates a carrier.
-        carrier = Carrier(name=name, address=address, city=city, state=state, zip=zip, phone=phone, user_id=session['user_id'])
-        # If carrier was created we commit it.
-        if carrier:
-            db.session.add(carrier)
-            return try_commit_rollback(success='Carrier created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/carriers')
-    return render_template('user/carriers.html', form=form, carriers=carriers)
-
-@app.route('/update_load/<int:load_id>', methods=['GET', 'POST'])
-def update_load(load_id):
-    '''Renders and handles the load data updates.'''
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/') 
-    data = LoadData.query.filter_by(load_id=load_id).first()
-    form = LoadDataForm(obj=data)
-    if form.validate_on_submit():
-        data.ontime = form.ontime.data
-        data.damges = form.damages.data
-        data.breakdown = form.breakdown.data
-        data.cost = form.cost.data
-        data.pallets = form.pallets.data
-        data.weight = form.weight.data
-        # Once object has been updated we commit.
-        return try_commit(success='Load Data added!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
-    return render_template('user/load.html', form=form)
-
-@app.route('/update_location/<int:load_id>', methods=['GET', 'POST'])
-def update_location(load_id):
-    '''Renders and handles updates to load locations.'''
-    # Checks if user has been autherized prior to allowing entrance to route.
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')    
-    form = UpdateLocationForm()
-    load = Load.query.filter_by(id=load_id).first()
-    if form.validate_on_submit():
-        load.pickup_city = form.city.data
-        load.pickup_state = form.state.data
-        load.miles = get_miles(app=app.config['CONSUMER_KEY'], dc_id=load.d_c_id, city=load.pickup_city, state=load.pickup_state)
-        # Commits changes.
-        return try_commit(success='Location updated!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
-    return render_template('user/update.html', form=form)
-
-@app.route('/delivered/<int:load_id>', methods=['POST'])
-def completed(load_id):
-    '''Handles when a load is marked as delivered.'''
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    load = Load.query.filter_by(id=load_id).first()
-    load_data = LoadData.query.filter_by(load_id=load_id).first()
-    # Changes the delivered status.
-    load.delivered = 1
-    load_data.delivered = 1
-    # Commits the change.
-    return try_commit(success='Load was delivered!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
-
-@app.route('/kpi')
-def show_kpi():
-    '''Gathers KPI's and renders results.'''
-    if 'user_id' not in session:
-        flash('You must be logged to access', 'alert-danger')
-        return redirect('/')
-    ontime = ontime_KPI()
-    breakdown = breakdown_KPI()
-    damages = damages_KPI()
-    avg_load_cost = avg_cost_load()
-    pallet_cost = cost_per_pallet()
-    weight_cost = cost_per_lbs()
-    return render_template('user/kpi.html', ontime=ontime, breakdown=breakdown, damages=damages, avg_load=avg_load_cost, avg_pallet=pallet_cost, avg_weight=weight_cost)
-
-# 
-# 404 PAGE
-# 
-@app.errorhandler(404)
-def page_not_found(e):
-    '''Custom 404 page'''
-    return render_template('404.html'), 404
-# 
-# FAQ'S
-# 
-@app.route('/faqs')
-def faq():
-    return render_template('user/faqs.html')
+def create_app(config=None, web=True):
+    '''Builds the app from the environment, with config (a dict) overriding it.
+
+    web=False leaves out the pages, API and CLI commands, for scripts that only need the database.
+    '''
+    from models import connect_db
+    from pooling import engine_options, init_statement_timeout
+    from metrics import init_metrics
+    from events import init_events
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///freight_db')
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'This_is_a_secret!')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Pool sized from the gunicorn worker and thread counts, see pooling.py.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    app.config['STATEMENT_TIMEOUT'] = int(os.environ.get('STATEMENT_TIMEOUT', STATEMENT_TIMEOUT))
+    # Logs every SQL statement, only for local debugging.
+    app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO') == '1'
+    app.config['CONSUMER_KEY'] = os.environ.get('CONSUMER_KEY')
+    app.config['CONSUMER_SECRET'] = os.environ.get('CONSUMER_SECRET')
+    app.config['DISTANCE_PROVIDER'] = os.environ.get('DISTANCE_PROVIDER', 'offline')
+    app.config['DISTANCE_CIRCUITY'] = float(os.environ.get('DISTANCE_CIRCUITY', 1.2))
+    if os.environ.get('MAPQUEST_URL'):
+        app.config['MAPQUEST_URL'] = os.environ['MAPQUEST_URL']
+    app.config['GEOCODER'] = os.environ.get('GEOCODER', 'offline')
+    if os.environ.get('MAPQUEST_GEOCODE_URL'):
+        app.config['MAPQUEST_GEOCODE_URL'] = os.environ['MAPQUEST_GEOCODE_URL']
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS))
+    app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', DEFAULT_POOL_SIZE))
+    app.config['LOGIN_RATE_PER_USER'] = int(os.environ.get('LOGIN_RATE_PER_USER', DEFAULT_RATE_PER_USER))
+    app.config['LOGIN_RATE_PER_IP'] = int(os.environ.get('LOGIN_RATE_PER_IP', DEFAULT_RATE_PER_IP))
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+    app.config['LOAD_EVENTS_FLUSH_SIZE'] = int(os.environ.get('LOAD_EVENTS_FLUSH_SIZE', DEFAULT_FLUSH_SIZE))
+    app.config['LOAD_EVENTS_FLUSH_INTERVAL'] = float(os.environ.get('LOAD_EVENTS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
+    app.config['LOAD_EVENTS_MAX_BUFFER'] = int(os.environ.get('LOAD_EVENTS_MAX_BUFFER', DEFAULT_MAX_BUFFER))
+    app.config['ALERT_SOLO_MILES_PER_DAY'] = float(os.environ.get('ALERT_SOLO_MILES_PER_DAY', DEFAULT_SOLO_MILES_PER_DAY))
+    app.config['ALERT_TEAM_MILES_PER_DAY'] = float(os.environ.get('ALERT_TEAM_MILES_PER_DAY', DEFAULT_TEAM_MILES_PER_DAY))
+    app.config['ALERT_SINK'] = os.environ.get('ALERT_SINK', DEFAULT_SINK)
+    app.config['ALERT_WEBHOOK_URL'] = os.environ.get('ALERT_WEBHOOK_URL')
+    app.config['METRICS_HEADER'] = os.environ.get('METRICS_HEADER') == '1'
+    # Heroku sets DYNO, and its router is the one proxy in front of every dyno.
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 1 if 'DYNO' in os.environ else 0))
+
+    if config:
+        app.config.update(config)
+
+    # Behind a load balancer the client IP comes from X-Forwarded-For, the login throttle needs it.
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+    connect_db(app)
+    init_statement_timeout(app)
+    init_metrics(app)
+    init_events(app)
+    if web:
+        from views import views
+        from api import api
+        from commands import commands
+        app.register_blueprint(views)
+        app.register_blueprint(api)
+        app.register_blueprint(commands)
+    return app
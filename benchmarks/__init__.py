@@ -0,0 +1 @@
+'''Benchmarks for the KPI engine and the busiest routes. See the Benchmarks section of the README.'''
@@ -0,0 +1,135 @@
+'''Throughput under concurrent load, through gunicorn with the settings in gunicorn.conf.py.
+
+Starts gunicorn against a benchmark database, hits it from many client threads for a while and
+reports requests per second, latency percentiles, errors and the most connections PostgreSQL
+saw open at once. Needs a benchmark user from benchmarks.generate (or benchmarks.run).
+
+    python -m benchmarks.concurrency --database-url postgresql:///freight_bench --clients 32 --workers 2 --threads 4
+'''
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import psycopg2
+import requests
+from benchmarks.generate import PASSWORD
+from benchmarks.run import DEFAULT_DATABASE_URL, percentile
+
+PATHS = ['/kpi', '/manage', '/api/v1/loads?per_page=50', '/kpi/breakdown']
+
+
+def wait_for(url, timeout=30):
+    '''Waits for gunicorn to answer.'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up.')
+
+
+def login(base, username):
+    '''Returns a logged in HTTP session. The JSON login needs no CSRF token and sets the same cookie as the site.'''
+    http = requests.Session()
+    http.post(f'{base}/api/v1/session', json={'username': username, 'password': PASSWORD}).raise_for_status()
+    return http
+
+
+def client(base, http, stop, paths):
+    '''Requests paths round robin until stopped. Returns (timings, errors).'''
+    timings = []
+    errors = 0
+    i = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            response = http.get(base + paths[i % len(paths)], timeout=30, allow_redirects=False)
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                timings.append(time.perf_counter() - started)
+        except requests.RequestException:
+            errors += 1
+        i += 1
+    return timings, errors
+
+
+def watch_connections(database_url, stop, seen):
+    '''Records the most connections to the database open at once.'''
+    connection = psycopg2.connect(database_url)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    while not stop.is_set():
+        cursor.execute('SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()')
+        seen.append(cursor.fetchone()[0])
+        time.sleep(0.1)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures throughput under concurrent load through gunicorn.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    parser.add_argument('--username', default='bench_1000')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--max-connections', type=int, default=20)
+    parser.add_argument('--pgbouncer', action='store_true', help='Runs without a pool, for a --database-url pointing at PgBouncer.')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=args.database_url, WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads),
+               DATABASE_MAX_CONNECTIONS=str(args.max_connections), PORT=str(args.port), DISTANCE_PROVIDER='offline',
+               # Every client logs in as the same user, from the same IP.
+               LOGIN_RATE_PER_USER='100000', LOGIN_RATE_PER_IP='100000')
+    env.pop('SQLALCHEMY_ECHO', None)
+    if args.pgbouncer:
+        env['DATABASE_PGBOUNCER'] = '1'
+    base = f'http://127.0.0.1:{args.port}'
+    server = subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '-c', 'gunicorn.conf.py', 'wsgi:app'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(base + '/')
+        # Logging in hashes a password, so it's done up front and kept out of the numbers.
+        sessions = [login(base, args.username) for i in range(args.clients)]
+        stop = Event()
+        seen = []
+        watcher = Thread(target=watch_connections, args=(args.database_url, stop, seen), daemon=True)
+        watcher.start()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            started = time.perf_counter()
+            futures = [pool.submit(client, base, http, stop, PATHS) for http in sessions]
+            time.sleep(args.seconds)
+            stop.set()
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - started
+        watcher.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    timings = sorted(timing for client_timings, errors in results for timing in client_timings)
+    report = {
+        'workers': args.workers,
+        'threads': args.threads,
+        'clients': args.clients,
+        'pgbouncer': args.pgbouncer,
+        'requests': len(timings),
+        'errors': sum(errors for client_timings, errors in results),
+        'requests_per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3) if timings else None,
+        'p99_ms': round(percentile(timings, 99) * 1000, 3) if timings else None,
+        'max_connections_seen': max(seen) if seen else None,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
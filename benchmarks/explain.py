@@ -0,0 +1,169 @@
+'''Checks that every per user read is served by an index, on a database shared by many users.
+
+Each hot read path is called for one benchmark user while the SQL it sends is recorded. Every
+recorded SELECT is then run through EXPLAIN with sequential scans disabled, so the planner only
+picks one when no index can serve the query. A sequential scan of a table that holds every
+user's rows fails the check, and so does walking a whole index of one (an index scan with no
+condition, like the primary key read in id order), and the script exits with status 1.
+
+    python -m benchmarks.explain --users 3 --loads 20000
+
+The database in --database-url is filled with benchmark users, use a scratch database.
+tests/test_query_plans.py runs the same reads on a small database with the tests, and also checks
+which indexes each one is planned with.
+'''
+from itertools import islice
+import argparse
+import json
+import os
+import sys
+
+DEFAULT_DATABASE_URL = 'postgresql:///freight_bench'
+
+# Tables with rows of every user. A scan of one of these reads other tenants' rows.
+TENANT_TABLES = {'users', 'carriers', 'distribution_centers', 'loads', 'load_data', 'kpi_rollups',
+                 'lane_stats', 'carrier_scores', 'load_alerts', 'mileage_jobs'}
+
+
+def hot_reads(user_id):
+    '''(name, call) pairs for the reads behind the busiest pages and API endpoints.'''
+    from datetime import date
+    from models import Load, LoadData, Carrier, DistributionCenter
+    from refdata import get_choices
+    from kpi import get_user_totals, get_user_kpis, get_grouped_kpis
+    from forecast import score_open_loads
+    from alerts import count_alerts, get_load_alerts
+    from lanes import search_lanes
+    from scorecard import rank_carriers
+    from export import export_rows
+    from events import get_timeline
+    from helper import get_due_range
+    first = Load.query.for_user(user_id).order_by(Load.id).first()
+    due_after, due_before = get_due_range('week', today=date(2024, 6, 1))
+    return [
+        ('Load.get_open_loads_page', lambda: Load.get_open_loads_page(user_id)),
+        ('Load.get_open_loads_page[carrier,dc]', lambda: Load.get_open_loads_page(user_id, carrier_id=first.carrier_id, d_c_id=first.d_c_id)),
+        ('Load.get_open_loads_page[due]', lambda: Load.get_open_loads_page(user_id, due_after=due_after, due_before=due_before)),
+        ('Carrier.get_carrier_by_user', lambda: Carrier.get_carrier_by_user(user_id)),
+        ('DistributionCenter.get_dist_by_user', lambda: DistributionCenter.get_dist_by_user(user_id)),
+        ('LoadData.get_load_data_by_user', lambda: LoadData.get_load_data_by_user(user_id)),
+        ('refdata.get_choices[carriers]', lambda: get_choices(user_id, 'carriers')),
+        ('refdata.get_choices[dcs]', lambda: get_choices(user_id, 'dcs')),
+        ('kpi.get_user_totals', lambda: get_user_totals(user_id)),
+        ('kpi.get_user_kpis', lambda: get_user_kpis(user_id)),
+        ('kpi.get_grouped_kpis[carrier,dc]', lambda: get_grouped_kpis(user_id, group_by=('carrier', 'dc'))),
+        ('forecast.score_open_loads', lambda: score_open_loads(user_id)),
+        ('alerts.count_alerts', lambda: count_alerts(user_id)),
+        ('alerts.get_load_alerts', lambda: get_load_alerts(user_id, [first.id])),
+        ('lanes.search_lanes', lambda: search_lanes(user_id)),
+        ('scorecard.rank_carriers', lambda: rank_carriers(user_id, [first.carrier_id], d_c_id=first.d_c_id)),
+        ('export.export_rows', lambda: list(islice(export_rows(user_id), 1000))),
+        ('events.get_timeline', lambda: get_timeline(first.id)),
+    ]
+
+
+def record_statements(engine, call):
+    '''Runs call and returns the (statement, parameters) of every single row SELECT it sent.'''
+    from sqlalchemy import event
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+FULL_INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+
+def _full_scan(node):
+    '''The tenant table a plan node reads whole, if any.'''
+    if node['Node Type'] == 'Seq Scan':
+        return node.get('Relation Name')
+    if node['Node Type'] in FULL_INDEX_SCANS and 'Index Cond' not in node:
+        return node.get('Relation Name') or node.get('Index Name')
+
+
+def plan_nodes(engine, statement, parameters):
+    '''Returns every node of a statement's plan, when the planner avoids sequential scans if it can.'''
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return list(_plan_nodes(plan[0]['Plan']))
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def full_scans(engine, statement, parameters):
+    '''Returns the tenant tables a statement reads whole.'''
+    return sorted({_full_scan(node) for node in plan_nodes(engine, statement, parameters)} & TENANT_TABLES)
+
+
+def indexes_used(engine, statement, parameters):
+    '''Returns the names of the indexes a statement's plan reads.'''
+    return {node['Index Name'] for node in plan_nodes(engine, statement, parameters) if 'Index Name' in node}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fails if a per user read scans the whole of a shared table.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    parser.add_argument('--users', type=int, default=3, help='Benchmark users sharing the database.')
+    parser.add_argument('--loads', type=int, default=20000, help='Loads per benchmark user.')
+    parser.add_argument('--reset', action='store_true', help='Drops and recreates every table first.')
+    args = parser.parse_args()
+
+    # The app reads its config from the environment.
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.pop('SQLALCHEMY_ECHO', None)
+    from benchmarks.generate import generate, analyze
+    from app import create_app
+    from models import db, User
+    from migrations import stamp
+    from events import ensure_partitions
+
+    failures = 0
+    with create_app(web=False).app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        if args.reset:
+            stamp()
+            ensure_partitions()
+        user_ids = []
+        for index in range(args.users):
+            username = f'tenant_{args.loads}_{index}'
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                user = generate(username, args.loads, seed=index / (args.users + 1))
+            user_ids.append(user.id)
+        analyze()
+        for name, call in hot_reads(user_ids[-1]):
+            statements = record_statements(db.engine, call)
+            scanned = sorted({table for statement, parameters in statements for table in full_scans(db.engine, statement, parameters)})
+            if scanned:
+                failures += 1
+            print(f'{"FAIL" if scanned else "ok  "} {name}: {len(statements)} queries' + (f', full scan of {", ".join(scanned)}' if scanned else ''))
+    print(f'{failures} of the hot reads scan a shared table.' if failures else 'Every hot read uses an index.')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''A local stand in for the MapQuest directions and geocoding APIs, so benchmarks never touch the network.
+
+Answers every route request with a distance worked out from the from/to text, so the same lane
+always gets the same miles, and every geocoding request with a point in the continental US worked
+out from the location text. latency adds a fixed delay to every answer, to mimic a slow API.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+import argparse
+import json
+import time
+import zlib
+
+PATH = '/directions/v2/route'
+GEOCODE_PATH = '/geocoding/v1/address'
+
+
+def fake_miles(origin, destination):
+    '''Returns a stable made up distance for a lane.'''
+    return 50 + zlib.crc32(f'{origin}|{destination}'.encode()) % 2500
+
+
+def fake_coordinates(location):
+    '''Returns a stable made up (latitude, longitude) for an address.'''
+    value = zlib.crc32(location.encode())
+    return 25 + (value % 2400) / 100, -124 + (value // 2400 % 5700) / 100
+
+
+class FakeMapQuestHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == GEOCODE_PATH and 'location' in params:
+            latitude, longitude = fake_coordinates(params['location'][0])
+            body = {'results': [{'locations': [{'latLng': {'lat': latitude, 'lng': longitude}, 'geocodeQualityCode': 'P1AAA'}]}]}
+        elif url.path != PATH or 'from' not in params or 'to' not in params:
+            body = {'info': {'statuscode': 400}}
+        else:
+            body = {'route': {'distance': fake_miles(params['from'][0], params['to'][0])}}
+        if self.latency:
+            time.sleep(self.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMapQuest:
+    '''Runs the fake API on a background thread. Use as a context manager or call start/stop.'''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        handler = type('Handler', (FakeMapQuestHandler,), {'latency': latency})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{PATH}'
+
+    @property
+    def geocode_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{GEOCODE_PATH}'
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves fake MapQuest directions and geocoding APIs.')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering.')
+    args = parser.parse_args()
+    fake = FakeMapQuest(port=args.port, latency=args.latency)
+    print(f'Fake MapQuest listening on {fake.url}, set MAPQUEST_URL to it (and MAPQUEST_GEOCODE_URL to {fake.geocode_url}).')
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''A local stand in for an alert webhook, to try ALERT_SINK=webhook without a real endpoint.
+
+Accepts the JSON posted by alerts.WebhookSink, keeps every alert it receives and prints a line per alert.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import argparse
+import json
+
+
+class FakeWebhookHandler(BaseHTTPRequestHandler):
+    received = None
+    lock = None
+    quiet = True
+
+    def do_POST(self):
+        try:
+            alerts = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['alerts']
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        with self.lock:
+            self.received.extend(alerts)
+        if not self.quiet:
+            for alert in alerts:
+                print(f"load {alert['load_id']} (user {alert['user_id']}): {alert['kind']}, due {alert['due_date']}, ETA {alert['eta']}")
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWebhook:
+    '''Runs the fake webhook on a background thread. Use as a context manager or call start/stop.'''
+
+    def __init__(self, host='127.0.0.1', port=0, quiet=True):
+        self.received = []
+        handler = type('Handler', (FakeWebhookHandler,), {'received': self.received, 'lock': Lock(), 'quiet': quiet})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/alerts'
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a fake alert webhook that prints what it receives.')
+    parser.add_argument('--port', type=int, default=8098)
+    args = parser.parse_args()
+    fake = FakeWebhook(port=args.port, quiet=False)
+    print(f'Fake webhook listening on {fake.url}, set ALERT_SINK=webhook and ALERT_WEBHOOK_URL to it.')
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''Builds benchmark users with carriers, DC's and anywhere from a thousand to a million loads.
+
+Rows are made inside PostgreSQL with generate_series, so a million loads takes seconds rather
+than minutes. The same seed always gives the same data.
+'''
+from sqlalchemy import text
+from models import db, User
+from passwords import hash_password
+from kpi import refresh_user_rollup
+import argparse
+
+PASSWORD = 'benchmark'
+
+# Real places, so the offline distance provider finds them.
+PLACES = [
+    ('Atlanta', 'GA'), ('Dallas', 'TX'), ('Houston', 'TX'), ('Chicago', 'IL'), ('Denver', 'CO'),
+    ('Phoenix', 'AZ'), ('Memphis', 'TN'), ('Columbus', 'OH'), ('Reno', 'NV'), ('Fresno', 'CA'),
+    ('Boise', 'ID'), ('Tulsa', 'OK'), ('Omaha', 'NE'), ('Charlotte', 'NC'), ('Jacksonville', 'FL'),
+    ('Louisville', 'KY'), ('Kansas City', 'MO'), ('Salt Lake City', 'UT'), ('Portland', 'OR'), ('Albany', 'NY'),
+]
+
+LOADS_SQL = text('''
+    INSERT INTO loads (po, name, pickup_city, pickup_state, due_date, temp, team, miles, delivered, user_id, carrier_id, d_c_id)
+    SELECT 'PO' || i, 'Load ' || i, (:cities)[place], (:states)[place], due, temp, team, miles, delivered, :user_id, (:carriers)[carrier], (:dcs)[dc]
+    FROM (
+        SELECT i,
+               1 + floor(random() * :places)::int AS place,
+               DATE '2024-01-01' + (i % 730) AS due,
+               floor(random() * 70)::int - 10 AS temp,
+               (random() < 0.2)::int AS team,
+               100 + floor(random() * 2400)::int AS miles,
+               (random() < :delivered)::int AS delivered,
+               1 + floor(random() * :carrier_count)::int AS carrier,
+               1 + floor(random() * :dc_count)::int AS dc
+        FROM generate_series(1, :loads) AS i
+    ) AS generated
+''')
+
+LOAD_DATA_SQL = text('''
+    INSERT INTO load_data (load_id, user_id, ontime, damges, breakdown, cost, pallets, weight, delivered)
+    SELECT id, user_id, (random() < 0.9)::int, (random() < 0.03)::int, (random() < 0.02)::int,
+           500 + floor(random() * 3000)::int, 1 + floor(random() * 25)::int, 1000 + floor(random() * 40000)::int, delivered
+    FROM loads WHERE user_id = :user_id ORDER BY id
+''')
+
+
+def _add_places(table, username, kind, count, user_id):
+    '''Inserts count carriers or DC's, returning their ids.'''
+    rows = db.session.execute(text(f'''
+        INSERT INTO {table} (name, address, city, state, zip, phone, user_id)
+        SELECT :username || ' {kind} ' || i, i || ' {kind} Way, ' || :username, (:cities)[1 + i % :places], (:states)[1 + i % :places], '00000', '555-0100', :user_id
+        FROM generate_series(1, :count) AS i
+        RETURNING id
+    '''), dict(username=username, count=count, user_id=user_id, places=len(PLACES),
+               cities=[city for city, state in PLACES], states=[state for city, state in PLACES]))
+    return [id for (id,) in rows]
+
+
+def generate(username, loads, carriers=25, dcs=5, delivered=0.8, seed=0.42):
+    '''Creates a user with carriers, DC's and loads (with load data and a KPI rollup). Returns the user.
+
+    delivered is the share of loads that are delivered, the rest make up the open load board.
+    '''
+    user = User(username=username, password=hash_password(PASSWORD))
+    db.session.add(user)
+    db.session.flush()
+    db.session.execute(text('SELECT setseed(:seed)'), {'seed': seed})
+    carrier_ids = _add_places('carriers', username, 'Carrier', carriers, user.id)
+    dc_ids = _add_places('distribution_centers', username, 'DC', dcs, user.id)
+    db.session.execute(LOADS_SQL, dict(
+        loads=loads, user_id=user.id, delivered=delivered, places=len(PLACES),
+        cities=[city for city, state in PLACES], states=[state for city, state in PLACES],
+        carriers=carrier_ids, carrier_count=len(carrier_ids), dcs=dc_ids, dc_count=len(dc_ids)))
+    db.session.execute(LOAD_DATA_SQL, {'user_id': user.id})
+    refresh_user_rollup(user.id)
+    db.session.commit()
+    return user
+
+
+def analyze():
+    '''Refreshes planner statistics after a bulk load, like autovacuum eventually would.'''
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Creates a benchmark user. Needs DATABASE_URL pointing at a scratch database.')
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--loads', type=int, default=10000)
+    parser.add_argument('--carriers', type=int, default=25)
+    parser.add_argument('--dcs', type=int, default=5)
+    parser.add_argument('--delivered', type=float, default=0.8)
+    parser.add_argument('--reset', action='store_true', help='Drops and recreates every table first.')
+    args = parser.parse_args()
+    from app import create_app
+    with create_app(web=False).app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        user = generate(args.username, args.loads, carriers=args.carriers, dcs=args.dcs, delivered=args.delivered)
+        analyze()
+        print(f'Created {args.username} (id {user.id}) with {args.loads} loads, password "{PASSWORD}".')
+
+
+if __name__ == '__main__':
+    main()
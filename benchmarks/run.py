@@ -0,0 +1,249 @@
+'''Runs the KPI microbenchmarks and the end to end route benchmarks, and writes the results as JSON.
+
+Every benchmark reports p50/p99/mean latency in milliseconds, SQL queries per call (from the
+metrics layer) and the peak Python memory of one call (from tracemalloc). Distances come from
+a local fake MapQuest server, so nothing leaves the machine.
+
+    python -m benchmarks.run --loads 1000 --loads 100000 --output results.json
+    python -m benchmarks.run --loads 100000 --compare results.json
+
+The database in --database-url is filled with benchmark users, use a scratch database.
+'''
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+DEFAULT_DATABASE_URL = 'postgresql:///freight_bench'
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(values, p):
+    '''Nearest rank percentile of a sorted list.'''
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(name, kind, loads, timings, queries, peak):
+    '''Builds one result row.'''
+    timings = sorted(timings)
+    return {
+        'name': name,
+        'kind': kind,
+        'loads': loads,
+        'runs': len(timings),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'queries': queries,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def peak_memory(call):
+    '''Returns the peak traced Python memory, in bytes, of one call.'''
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#
+# KPI MICROBENCHMARKS
+#
+
+def kpi_benchmarks(user_id):
+    '''(name, call) pairs for every KPI function.'''
+    from kpi import get_user_totals, get_user_kpis, get_grouped_kpis, refresh_user_rollup, find_rollup_drift
+    return [
+        ('kpi.get_user_totals', lambda: get_user_totals(user_id)),
+        ('kpi.get_user_kpis', lambda: get_user_kpis(user_id)),
+        ('kpi.get_grouped_kpis[carrier,dc]', lambda: get_grouped_kpis(user_id, group_by=('carrier', 'dc'))),
+        ('kpi.get_grouped_kpis[carrier,month]', lambda: get_grouped_kpis(user_id, group_by=('carrier',), period='month')),
+        ('kpi.refresh_user_rollup', lambda: refresh_user_rollup(user_id)),
+        ('kpi.find_rollup_drift', find_rollup_drift),
+    ]
+
+
+def run_kpi_benchmarks(app, user_id, loads, repeat, warmup):
+    from flask import g
+    from metrics import RequestStats
+    from models import db
+    results = []
+    # A request context, so the metrics layer counts the queries of each call.
+    with app.test_request_context():
+        for name, call in kpi_benchmarks(user_id):
+            timings = []
+            queries = 0
+            for i in range(warmup + repeat):
+                g._metrics = RequestStats()
+                started = time.perf_counter()
+                call()
+                elapsed = time.perf_counter() - started
+                queries = g._metrics.queries
+                db.session.rollback()
+                if i >= warmup:
+                    timings.append(elapsed)
+            peak = peak_memory(call)
+            db.session.rollback()
+            results.append(summarize(name, 'kpi', loads, timings, queries, peak))
+    return results
+
+#
+# ROUTE BENCHMARKS
+#
+
+def route_benchmarks(client, user_id, count):
+    '''(name, call) pairs that each make one request. call gets the run number within its benchmark.'''
+    from models import db, Carrier, DistributionCenter, Load
+    (carrier_id,) = db.session.query(Carrier.id).filter_by(user_id=user_id).first()
+    (d_c_id,) = db.session.query(DistributionCenter.id).filter_by(user_id=user_id).first()
+    open_ids = [id for (id,) in db.session.query(Load.id).filter(Load.user_id == user_id, Load.delivered == 0).order_by(Load.id).limit(count)]
+    db.session.rollback()
+    page = client.get('/api/v1/loads?per_page=50').get_json()
+
+    def new_load(city):
+        return lambda i: client.post('/manage', data=dict(po=f'B{i}', name='Benchmark', city=city(i), state='TX', due_date='01/15/2025',
+                                                          temp='35', team='0', carrier_id=carrier_id, d_c_id=d_c_id))
+
+    return [
+        ('GET /kpi', lambda i: client.get('/kpi')),
+        ('GET /kpi/breakdown', lambda i: client.get('/kpi/breakdown')),
+        ('GET /manage', lambda i: client.get('/manage')),
+        ('GET /manage page 2', lambda i: client.get(f'/manage?after={page["next"]}')),
+        ('GET /api/v1/loads', lambda i: client.get('/api/v1/loads?per_page=50')),
+        ('POST /manage cached lane', new_load(lambda i: 'Dallas')),
+        ('POST /manage new lane', new_load(lambda i: f'Benchtown {time.perf_counter_ns()}')),
+        ('POST /delivered', lambda i: client.post(f'/delivered/{open_ids[i % len(open_ids)]}')),
+    ]
+
+
+def run_route_benchmarks(app, username, user_id, loads, repeat, warmup):
+    from benchmarks.generate import PASSWORD
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': PASSWORD})
+    results = []
+    with app.app_context():
+        scenarios = route_benchmarks(client, user_id, warmup + repeat + 1)
+    for name, call in scenarios:
+        timings = []
+        queries = []
+        for i in range(warmup + repeat):
+            started = time.perf_counter()
+            response = call(i)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name} returned {response.status_code}')
+            if i >= warmup:
+                timings.append(elapsed)
+                match = QUERIES.search(response.headers.get('Server-Timing', ''))
+                queries.append(int(match.group(1)) if match else None)
+        peak = peak_memory(lambda: call(warmup + repeat))
+        known = sorted(count for count in queries if count is not None)
+        results.append(summarize(name, 'route', loads, timings, percentile(known, 50) if known else None, peak))
+    return results
+
+#
+# MAIN
+#
+
+def compare(results, baseline):
+    '''Prints the p50 change of every benchmark found in a baseline result file.'''
+    before = {(row['name'], row['loads']): row for row in baseline['results']}
+    for row in results:
+        old = before.get((row['name'], row['loads']))
+        if not old or not old['p50_ms']:
+            continue
+        change = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+        print(f'{row["name"]:<40} {row["loads"]:>8} loads  p50 {old["p50_ms"]:>9.3f} -> {row["p50_ms"]:>9.3f} ms  ({change:+.1f}%)  '
+              f'queries {old["queries"]} -> {row["queries"]}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the KPI engine and the busiest routes.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    parser.add_argument('--loads', type=int, action='append', help='Loads per benchmark user, repeat for several sizes (default 1000).')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the fake MapQuest server waits before answering.')
+    parser.add_argument('--reset', action='store_true', help='Drops and recreates every table first.')
+    parser.add_argument('--only', choices=('kpi', 'route'), help='Runs one kind of benchmark.')
+    parser.add_argument('--output', help='Writes the JSON here instead of stdout.')
+    parser.add_argument('--compare', help='A previous result file to compare p50 latencies against.')
+    args = parser.parse_args()
+    sizes = args.loads or [1000]
+
+    # The app reads its config from the environment.
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['METRICS_ENABLED'] = '1'
+    os.environ['METRICS_HEADER'] = '1'
+    os.environ['DISTANCE_PROVIDER'] = 'mapquest'
+    os.environ.pop('SQLALCHEMY_ECHO', None)
+    from benchmarks.fake_mapquest import FakeMapQuest
+    from benchmarks.generate import generate, analyze
+    from app import create_app
+    from models import db, User
+
+    app = create_app({'WTF_CSRF_ENABLED': False})
+    results = []
+    with FakeMapQuest(latency=args.latency) as fake:
+        app.config['MAPQUEST_URL'] = fake.url
+        with app.app_context():
+            if args.reset:
+                db.drop_all()
+            db.create_all()
+            users = {}
+            for loads in sizes:
+                username = f'bench_{loads}'
+                user = User.query.filter_by(username=username).first()
+                if user is None:
+                    started = time.perf_counter()
+                    user = generate(username, loads)
+                    analyze()
+                    print(f'Generated {loads} loads in {time.perf_counter() - started:.1f}s.', file=sys.stderr)
+                users[loads] = (username, user.id)
+        for loads, (username, user_id) in users.items():
+            if args.only != 'route':
+                results += run_kpi_benchmarks(app, user_id, loads, args.repeat, args.warmup)
+            if args.only != 'kpi':
+                results += run_route_benchmarks(app, username, user_id, loads, args.repeat, args.warmup)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'python': platform.python_version(),
+            'sizes': sizes,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'mapquest_latency': args.latency,
+        },
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''Cold start time: how long a fresh process takes to import the app, build it and answer its first requests.
+
+Every run is a new Python process, like a new gunicorn worker or flask command, so nothing is
+warm from the run before. Reported in milliseconds, the median and the slowest run of:
+
+ - import: importing app.py
+ - create_app: building the app with its pages, API and commands
+ - the first GET of the home page, the login page and a benchmark user's load board, in that order.
+   The load board opens the first database connection and loads NumPy for the forecasts.
+
+    python -m benchmarks.startup --runs 10 --imports 10
+    python -m benchmarks.startup --budget-ms 800
+
+With --budget-ms it exits with status 1 when the median total is over budget. The database in
+--database-url gets a small benchmark user if it has none, use a scratch database.
+'''
+from statistics import median
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+DEFAULT_DATABASE_URL = 'postgresql:///freight_bench'
+USERNAME = 'startup'
+LOADS = 1000
+REQUESTS = [('GET /', '/', False), ('GET /login', '/login', False), ('GET /manage', '/manage', True)]
+# A line of python -X importtime: self and cumulative microseconds, then the module indented by depth.
+IMPORT_TIME = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)$')
+
+
+def measure(user_id):
+    '''Runs in the child process. Prints the timings of one cold start as JSON.'''
+    started = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    flask_app = app.create_app({'WTF_CSRF_ENABLED': False})
+    created = time.perf_counter()
+    timings = {'import': imported - started, 'create_app': created - imported}
+    client = flask_app.test_client()
+    for name, path, login in REQUESTS:
+        if login:
+            with client.session_transaction() as session:
+                session['user_id'] = user_id
+        before = time.perf_counter()
+        response = client.get(path)
+        timings[name] = time.perf_counter() - before
+        if response.status_code != 200:
+            raise SystemExit(f'{path} answered {response.status_code}')
+    timings['total'] = sum(timings.values())
+    print(json.dumps({name: round(seconds * 1000, 2) for name, seconds in timings.items()}))
+
+
+def cold_start(user_id, importtime=False):
+    '''Starts a fresh process for one measurement. Returns its timings, and its -X importtime lines if asked for.'''
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-m', 'benchmarks.startup', '--child', str(user_id)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode:
+        raise SystemExit(f'Cold start failed:\n{result.stderr or result.stdout}')
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr.splitlines()
+
+
+def slowest_imports(lines, count):
+    '''Returns (milliseconds, module) of the slowest top level imports, those made by app.py or later on first use.'''
+    top = []
+    for line in lines:
+        match = IMPORT_TIME.match(line)
+        # Top level modules are indented by two spaces.
+        if match and len(match.group(2)) == 3:
+            top.append((int(match.group(1)) / 1000, match.group(3)))
+    return sorted(top, reverse=True)[:count]
+
+
+def benchmark_user():
+    '''Returns the id of the benchmark user, creating it the first time.'''
+    from benchmarks.generate import generate, analyze
+    from app import create_app
+    from models import db, User
+    with create_app(web=False).app_context():
+        db.create_all()
+        user = User.query.filter_by(username=USERNAME).first()
+        if user is None:
+            user = generate(USERNAME, LOADS)
+            analyze()
+        return user.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long a fresh process takes to start the app and serve its first requests.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    parser.add_argument('--runs', type=int, default=5, help='Cold starts to measure.')
+    parser.add_argument('--imports', type=int, default=0, help='Also list this many of the slowest top level imports.')
+    parser.add_argument('--budget-ms', type=float, help='Fail if the median total is slower than this.')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # The app reads its config from the environment, the children inherit it.
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.pop('SQLALCHEMY_ECHO', None)
+    if args.child is not None:
+        measure(args.child)
+        return
+
+    user_id = benchmark_user()
+    runs = [cold_start(user_id)[0] for i in range(args.runs)]
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        print(f'{name:<14} p50 {median(values):8.1f} ms   max {max(values):8.1f} ms')
+    if args.imports:
+        lines = cold_start(user_id, importtime=True)[1]
+        print('Slowest imports:')
+        for milliseconds, module in slowest_imports(lines, args.imports):
+            print(f'  {milliseconds:8.1f} ms  {module}')
+    total = median(run['total'] for run in runs)
+    if args.budget_ms is not None and total > args.budget_ms:
+        print(f'Cold start takes {total:.1f} ms, over the {args.budget_ms:.0f} ms budget.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
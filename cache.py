@@ -0,0 +1,62 @@
+'''In-process caches shared by the app's subsystems.'''
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache:
+    '''A thread safe, size bounded least recently used cache.
+
+    Entries older than ttl seconds are treated as missing. A ttl of None keeps entries
+    until they are evicted for space.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        '''Returns a cached value, or default if it is missing or expired.'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl is None or time.monotonic() - stored_at < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        '''Stores a value, evicting the least recently used entries if the cache is full.'''
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Removes a value from the cache.'''
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        '''Empties the cache and resets its counters.'''
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        '''Returns the size and hit/miss counters of the cache.'''
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
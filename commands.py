@@ -0,0 +1,160 @@
+'''flask commands. Registered on the app by create_app, run them with FLASK_APP=app.py.'''
+from flask import Blueprint
+from models import db, User, DistributionCenter
+from events import ensure_partitions
+from export import export_rows, csv_chunks, STATUSES
+from importer import import_loads
+from alerts import evaluate_alerts
+from lanes import rebuild_lanes
+from geocode import backfill_coordinates, DEFAULT_THREADS as GEOCODE_THREADS, DEFAULT_BATCH_SIZE as GEOCODE_BATCH_SIZE
+from scorecard import rebuild_carrier_scores
+from mileage import run_worker, dc_address_changed
+from migrations import migrate, pending_migrations, DEFAULT_BATCH_SIZE as MIGRATION_BATCH_SIZE
+from kpi import rebuild_rollups, find_rollup_drift
+import click
+import time
+
+# No group, so the commands are flask db-migrate and so on.
+commands = Blueprint('commands', __name__, cli_group=None)
+
+@commands.cli.command('db-migrate')
+@click.option('--to', 'to', type=int, help='Stop after this migration version.')
+@click.option('--batch-size', default=MIGRATION_BATCH_SIZE, help='Rows converted per transaction.')
+@click.option('--list', 'list_only', is_flag=True, help='Only list the pending migrations.')
+def db_migrate_command(to, batch_size, list_only):
+    '''Brings an existing database's schema up to date.'''
+    if list_only:
+        for migration in pending_migrations(to):
+            click.echo(f'{migration.version} {migration.name}')
+        return
+    count = migrate(to=to, batch_size=batch_size, echo=click.echo)
+    click.echo(f'Applied {count} migrations.')
+
+@commands.cli.command('evaluate-alerts')
+@click.option('--every', type=float, help='Keep evaluating, waiting this many seconds in between.')
+def evaluate_alerts_command(every):
+    '''Flags open loads that are overdue or won't make their due date.'''
+    while True:
+        result = evaluate_alerts()
+        if result.raised is None:
+            click.echo('Another evaluation is already running.')
+        else:
+            click.echo(f'{len(result.raised)} new alerts, {result.resolved} resolved, {result.total} open.')
+        if not every:
+            return
+        time.sleep(every)
+
+@commands.cli.command('event-partitions')
+@click.option('--months', default=3, help='Months ahead to create partitions for.')
+def event_partitions_command(months):
+    '''Creates the monthly load event partitions ahead of time.'''
+    made = ensure_partitions(months_ahead=months)
+    click.echo(f'Created {len(made)} partitions.' + (f' ({", ".join(made)})' if made else ''))
+
+@commands.cli.command('rebuild-kpis')
+def rebuild_kpis_command():
+    '''Rebuilds the KPI rollup table from the load data.'''
+    count = rebuild_rollups()
+    click.echo(f'Rebuilt KPI rollups for {count} users.')
+
+@commands.cli.command('rebuild-lanes')
+@click.option('--username', help="Only rebuild this user's lanes.")
+def rebuild_lanes_command(username):
+    '''Rebuilds the lane stats table from the delivered loads.'''
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.BadParameter(f'No user named {username}', param_hint='--username')
+        user_id = user.id
+    count = rebuild_lanes(user_id=user_id)
+    click.echo(f'Rebuilt {count} lanes.')
+
+@commands.cli.command('rebuild-carrier-scores')
+@click.option('--username', help="Only rebuild this user's carrier scores.")
+def rebuild_carrier_scores_command(username):
+    '''Rebuilds the carrier scores table from the delivered loads.'''
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.BadParameter(f'No user named {username}', param_hint='--username')
+        user_id = user.id
+    count = rebuild_carrier_scores(user_id=user_id)
+    click.echo(f'Rebuilt {count} carrier scores.')
+
+@commands.cli.command('geocode-places')
+@click.option('--kind', type=click.Choice(['dcs', 'carriers', 'all']), default='all')
+@click.option('--threads', default=GEOCODE_THREADS, help='Most geocoder calls at once.')
+@click.option('--batch-size', default=GEOCODE_BATCH_SIZE, help='Rows read and written at a time.')
+def geocode_places_command(kind, threads, batch_size):
+    '''Stores the coordinates of DC's and carriers added before they were geocoded.'''
+    for name in (('dcs', 'carriers') if kind == 'all' else (kind,)):
+        result = backfill_coordinates(name, threads=threads, batch_size=batch_size, echo=click.echo)
+        click.echo(f'{name}: located {result.located} ({result.approximate} only by state), could not find {result.not_found}, geocoder failed for {result.failed}.')
+
+@commands.cli.command('import-loads')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--username', required=True, help='User the loads belong to.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('--chunk-size', default=1000, help='Rows inserted per transaction.')
+def import_loads_command(path, username, fmt, chunk_size):
+    '''Imports loads from a CSV or JSON lines file.'''
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.BadParameter(f'No user named {username}', param_hint='--username')
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        result = import_loads(f, user_id=user.id, fmt=fmt, chunk_size=chunk_size)
+    for line_num, error in result.errors:
+        click.echo(f'line {line_num}: {error}')
+    click.echo(f'{result.imported} loads imported, {result.failed} rows skipped.')
+
+@commands.cli.command('export-loads')
+@click.option('--username', required=True, help='User whose loads are exported.')
+@click.option('--status', type=click.Choice(STATUSES), default='all')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='File to write, defaults to stdout.')
+def export_loads_command(username, status, output):
+    '''Exports a user's loads as CSV.'''
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.BadParameter(f'No user named {username}', param_hint='--username')
+    for chunk in csv_chunks(export_rows(user_id=user.id, status=status)):
+        output.write(chunk)
+
+@commands.cli.command('mileage-worker')
+@click.option('--threads', default=8, help='Distance lookups run at the same time.')
+@click.option('--batch-size', default=50, help='Jobs claimed at a time.')
+@click.option('--poll', default=2.0, help='Seconds to wait when the queue is empty.')
+@click.option('--once', is_flag=True, help='Stop when the queue is empty.')
+def mileage_worker_command(threads, batch_size, poll, once):
+    '''Recalculates the miles of loads whose location changed.'''
+    run_worker(threads=threads, batch_size=batch_size, poll=poll, once=once, log=click.echo)
+
+@commands.cli.command('reroute-dc')
+@click.argument('d_c_id', type=int)
+def reroute_dc_command(d_c_id):
+    '''Locates a DC again and queues a miles recalculation for its open loads, after its address changes.'''
+    dc = DistributionCenter.query.get(d_c_id)
+    if not dc:
+        raise click.BadParameter(f'No D.C. with id {d_c_id}', param_hint='DC_ID')
+    problem, count = dc_address_changed(dc)
+    db.session.commit()
+    if problem:
+        click.echo(f'{problem} Its coordinates were cleared, so distances use its city for now.')
+    click.echo(f'Queued {count} loads.')
+
+@commands.cli.command('check-kpis')
+@click.option('--fix', is_flag=True, help='Rebuild the rollups if any drift is found.')
+def check_kpis_command(fix):
+    '''Reports KPI rollup rows that no longer match the load data.'''
+    drift = find_rollup_drift()
+    for user_id, stored, actual in drift:
+        rollup = dict(stored._asdict()) if stored else 'missing'
+        click.echo(f'user {user_id}: rollup {rollup} != actual {dict(actual._asdict())}')
+    if not drift:
+        click.echo('KPI rollups match the load data.')
+    elif fix:
+        rebuild_rollups()
+        click.echo(f'Rebuilt KPI rollups, {len(drift)} users had drifted.')
+    else:
+        raise SystemExit(1)
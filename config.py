@@ -0,0 +1,22 @@
+'''Defaults of the settings create_app reads from the environment.
+
+They live here rather than in the modules that use them, so app.py can fill in its config without
+importing those modules (and what they import) before the app is built.
+'''
+
+# bcrypt work factor, and processes per worker that hash passwords (0 hashes on the request thread). See passwords.py.
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_POOL_SIZE = 2
+# Login attempts per minute, per username and per client IP.
+DEFAULT_RATE_PER_USER = 10
+DEFAULT_RATE_PER_IP = 120
+# Milliseconds a single statement may run while serving a request. 0 turns it off. See pooling.py.
+STATEMENT_TIMEOUT = 5000
+# Load events buffered before a write, seconds the oldest may wait, and most kept while writes fail. See events.py.
+DEFAULT_FLUSH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 0
+DEFAULT_MAX_BUFFER = 100000
+# Miles a solo or team driver covers in a day, for the late load alerts, and where alerts go. See alerts.py.
+DEFAULT_SOLO_MILES_PER_DAY = 500
+DEFAULT_TEAM_MILES_PER_DAY = 1000
+DEFAULT_SINK = 'log'
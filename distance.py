@@ -0,0 +1,326 @@
+'''Lane distance lookups.
+
+Distances come from a provider: an offline one that works from a bundled table of US city
+centroids, or MapQuest API. MapQuest results are cached per lane in memory and in the database.
+'''
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+from cache import LRUCache
+from models import db, DistanceCache
+from metrics import external_call
+import csv
+import os
+
+BASE_URL = 'http://www.mapquestapi.com/directions/v2/route'
+CENTROIDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'us_city_centroids.csv')
+EARTH_RADIUS_MILES = 3958.8
+
+# Defaults, overridable through app.config.
+DEFAULT_PROVIDER = 'offline'
+DEFAULT_CIRCUITY = 1.2
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60 * 60 * 24 * 30
+DEFAULT_TIMEOUT = 5
+
+# Words that are commonly abbreviated in city names.
+ABBREVIATIONS = {'saint': 'st', 'sainte': 'ste', 'fort': 'ft', 'mount': 'mt'}
+
+_memory = None
+# Counts lookups answered by the database tier and by MapQuest.
+_counters = {'db_hits': 0, 'api_calls': 0, 'api_failures': 0}
+
+
+def normalize_city(city):
+    '''Lower cases a city and collapses its whitespace.'''
+    return ' '.join(city.split()).lower()
+
+
+def normalize_state(state):
+    '''Upper cases a state code.'''
+    return state.strip().upper()
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    '''Great circle distance in miles. Works on scalars or NumPy arrays of degrees.'''
+    import numpy as np
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+#
+# CITY CENTROIDS
+#
+
+class CentroidTable:
+    '''Array backed table of US city centroids.
+
+    Coordinates live in two float arrays, with a dict mapping (city, state) to a row.
+    Cities that aren't in the table fall back to the average of their state's cities.
+    '''
+
+    def __init__(self, path=CENTROIDS_PATH):
+        # NumPy is only imported once the table is first needed, not by every process that imports this module.
+        import numpy as np
+        index = {}
+        latitudes = []
+        longitudes = []
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                index.setdefault(self.key(row['city'], row['state']), len(latitudes))
+                latitudes.append(float(row['latitude']))
+                longitudes.append(float(row['longitude']))
+        self.index = index
+        self.latitudes = np.array(latitudes)
+        self.longitudes = np.array(longitudes)
+        states = {}
+        for (city, state), row in index.items():
+            states.setdefault(state, []).append(row)
+        self.states = {state: (self.latitudes[rows].mean(), self.longitudes[rows].mean()) for state, rows in states.items()}
+
+    @staticmethod
+    def key(city, state):
+        '''Normalizes a city and state into a table key.'''
+        words = normalize_city(city).replace('.', '').split()
+        return (' '.join(ABBREVIATIONS.get(word, word) for word in words), normalize_state(state))
+
+    def locate(self, city, state):
+        '''Returns (latitude, longitude, exact) for a city, where exact is False for a state fallback.'''
+        key = self.key(city, state)
+        row = self.index.get(key)
+        if row is not None:
+            return self.latitudes[row], self.longitudes[row], True
+        if key[1] in self.states:
+            latitude, longitude = self.states[key[1]]
+            return latitude, longitude, False
+        raise LookupError(f'Unknown state: {state}')
+
+    def locate_many(self, places):
+        '''Returns latitude and longitude arrays for a list of (city, state) pairs.'''
+        import numpy as np
+        coordinates = np.array([self.locate(city, state)[:2] for city, state in places], dtype=float).reshape(-1, 2)
+        return coordinates[:, 0], coordinates[:, 1]
+
+#
+# DISTANCE PROVIDERS
+#
+
+def dc_coordinates(dc):
+    '''Returns a DC's stored (latitude, longitude), or None if it hasn't been geocoded.'''
+    latitude = getattr(dc, 'latitude', None)
+    longitude = getattr(dc, 'longitude', None)
+    return None if latitude is None or longitude is None else (latitude, longitude)
+
+
+def _dc_location(dc):
+    '''A DC as MapQuest takes it: its stored coordinates, or its city for DC's not geocoded yet.'''
+    coordinates = dc_coordinates(dc)
+    return f'{coordinates[0]},{coordinates[1]}' if coordinates else f'{dc.city}, {dc.state}'
+
+
+class DistanceUnavailable(Exception):
+    '''Raised when a provider can't work out a distance.'''
+
+
+class DistanceProvider:
+    '''Interface for things that know how far a location is from a DC.'''
+
+    # Remote providers are slow enough to be worth caching.
+    remote = False
+
+    def miles(self, city, state, dc):
+        '''Returns the driving miles from a city/state to a DC.'''
+        raise NotImplementedError
+
+    def miles_many(self, places, dc):
+        '''Returns the driving miles from each (city, state) pair to a DC.'''
+        return [self.miles(city, state, dc) for city, state in places]
+
+
+class OfflineProvider(DistanceProvider):
+    '''Estimates road miles as the great circle distance between centroids times a circuity factor.'''
+
+    def __init__(self, table, circuity=DEFAULT_CIRCUITY):
+        self.table = table
+        self.circuity = circuity
+
+    def miles(self, city, state, dc):
+        return self.miles_many([(city, state)], dc)[0]
+
+    def miles_many(self, places, dc):
+        latitudes, longitudes = self.table.locate_many(places)
+        dc_latitude, dc_longitude = dc_coordinates(dc) or self.table.locate(dc.city, dc.state)[:2]
+        miles = haversine_miles(latitudes, longitudes, dc_latitude, dc_longitude) * self.circuity
+        return [round(float(value), 2) for value in miles]
+
+
+class MapQuestProvider(DistanceProvider):
+    '''Asks MapQuest API for the route distance.'''
+
+    remote = True
+
+    def __init__(self, key, url=BASE_URL, timeout=DEFAULT_TIMEOUT):
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+
+    def miles(self, city, state, dc):
+        # Imported here so processes that never call MapQuest don't load requests.
+        import requests
+        try:
+            with external_call():
+                response = requests.get(url=self.url, params={'key': self.key, 'from': f'{city}, {state}', 'to': _dc_location(dc)}, timeout=self.timeout)
+            _counters['api_calls'] += 1
+            data = response.json()
+            return data['route']['distance']
+        except (requests.RequestException, ValueError, KeyError) as ex:
+            _counters['api_failures'] += 1
+            raise DistanceUnavailable(str(ex))
+
+
+def miles_or_none(provider, places, dc):
+    '''Returns the miles from each (city, state) pair to a DC, with None for places the provider can't locate.
+
+    The offline provider raises LookupError for a state it doesn't know, of a place or of the DC.
+    '''
+    try:
+        return provider.miles_many(places, dc)
+    except LookupError:
+        miles = []
+        for city, state in places:
+            try:
+                miles.append(provider.miles(city, state, dc))
+            except LookupError:
+                miles.append(None)
+        return miles
+
+
+def get_centroid_table():
+    '''Returns the centroid table, loading it on first use.'''
+    table = current_app.extensions.get('centroid_table')
+    if table is None:
+        table = current_app.extensions['centroid_table'] = CentroidTable(current_app.config.get('CENTROIDS_PATH', CENTROIDS_PATH))
+    return table
+
+
+def get_offline_provider():
+    '''Returns the app's offline provider, building it on first use.'''
+    provider = current_app.extensions.get('offline_distance_provider')
+    if provider is None:
+        provider = OfflineProvider(get_centroid_table(), circuity=current_app.config.get('DISTANCE_CIRCUITY', DEFAULT_CIRCUITY))
+        current_app.extensions['offline_distance_provider'] = provider
+    return provider
+
+
+def get_provider():
+    '''Returns the app's distance provider, building it from the config on first use.
+
+    DISTANCE_PROVIDER is 'offline' (the default) or 'mapquest'.
+    '''
+    provider = current_app.extensions.get('distance_provider')
+    if provider is None:
+        config = current_app.config
+        if config.get('DISTANCE_PROVIDER', DEFAULT_PROVIDER) == 'mapquest':
+            provider = MapQuestProvider(key=config.get('CONSUMER_KEY'), url=config.get('MAPQUEST_URL', BASE_URL),
+                                        timeout=config.get('MAPQUEST_TIMEOUT', DEFAULT_TIMEOUT))
+        else:
+            provider = get_offline_provider()
+        current_app.extensions['distance_provider'] = provider
+    return provider
+
+#
+# LANE CACHE
+#
+
+def _memory_cache():
+    '''Returns the in-process cache tier, creating it from the app config on first use.'''
+    global _memory
+    if _memory is None:
+        _memory = LRUCache(maxsize=current_app.config.get('DISTANCE_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+                           ttl=current_app.config.get('DISTANCE_CACHE_TTL', DEFAULT_CACHE_TTL))
+    return _memory
+
+
+def lane_key(city, state, dc):
+    '''Returns the cache key of a pickup location and a DC.
+
+    The DC's city and state are part of the key, so editing a DC's address stops old entries from matching.
+    '''
+    return (normalize_city(city), normalize_state(state), dc.id, normalize_city(dc.city), normalize_state(dc.state))
+
+
+def _read_db(lane):
+    '''Looks a lane up in the database tier, ignoring expired rows.'''
+    origin_city, origin_state, d_c_id, dc_city, dc_state = lane
+    ttl = current_app.config.get('DISTANCE_CACHE_TTL', DEFAULT_CACHE_TTL)
+    query = DistanceCache.query.with_entities(DistanceCache.miles).filter_by(
+        origin_city=origin_city, origin_state=origin_state, d_c_id=d_c_id, dc_city=dc_city, dc_state=dc_state)
+    if ttl is not None:
+        query = query.filter(DistanceCache.created_at >= datetime.utcnow() - timedelta(seconds=ttl))
+    row = query.first()
+    return None if row is None else row[0]
+
+
+def _write_db(lane, miles):
+    '''Stores a lane in the database tier as part of the current transaction.'''
+    origin_city, origin_state, d_c_id, dc_city, dc_state = lane
+    stmt = insert(DistanceCache.__table__).values(origin_city=origin_city, origin_state=origin_state, d_c_id=d_c_id,
+                                                  dc_city=dc_city, dc_state=dc_state, miles=miles, created_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(constraint='uq_distance_cache_lane',
+                                      set_={'miles': stmt.excluded.miles, 'created_at': stmt.excluded.created_at})
+    db.session.execute(stmt)
+
+
+def lookup_cached_miles(city, state, dc):
+    '''Returns a lane's distance from the memory or database cache, or None if it isn't cached.'''
+    lane = lane_key(city, state, dc)
+    memory = _memory_cache()
+    miles = memory.get(lane)
+    if miles is None:
+        miles = _read_db(lane)
+        if miles is not None:
+            _counters['db_hits'] += 1
+            memory.set(lane, miles)
+    return miles
+
+
+def remember_miles(city, state, dc, miles):
+    '''Stores a lane's distance in both cache tiers. The database row is part of the current transaction.'''
+    lane = lane_key(city, state, dc)
+    _write_db(lane, miles)
+    _memory_cache().set(lane, miles)
+
+
+def cached_miles(city, state, dc):
+    '''Returns the distance between a location and a DC.
+
+    Remote providers are only asked about lanes that aren't in the memory or database cache.
+    If a remote provider fails, the offline estimate is returned without being cached.
+    Returns None if the location or the DC can't be placed at all.
+    '''
+    provider = get_provider()
+    try:
+        if not provider.remote:
+            return provider.miles(city, state, dc)
+        miles = lookup_cached_miles(city, state, dc)
+        if miles is None:
+            try:
+                miles = provider.miles(city, state, dc)
+            except DistanceUnavailable:
+                return get_offline_provider().miles(city, state, dc)
+            remember_miles(city, state, dc, miles)
+        return miles
+    except LookupError:
+        # Not even the state is in the centroid table.
+        return None
+
+
+def cache_stats():
+    '''Returns the hit/miss counters of both cache tiers.'''
+    stats = _memory_cache().stats()
+    return {'memory_hits': stats['hits'], 'memory_misses': stats['misses'], 'memory_size': stats['size'], **_counters}
+
+
+def clear_memory_cache():
+    '''Empties the in-process tier.'''
+    _memory_cache().clear()
@@ -0,0 +1,224 @@
+'''Load lifecycle events: an append only history of where each load was and what changed when.
+
+Code that changes a load calls record_event inside its transaction. Events wait in the session
+until it commits (a rollback drops them), then move to a per process buffer that is written with
+multi-row INSERTs on a separate connection:
+
+ - at the end of every request or CLI command, by default;
+ - with LOAD_EVENTS_FLUSH_INTERVAL (seconds) above 0, only once the oldest buffered event is that
+   old, so quiet periods batch events across requests;
+ - whenever LOAD_EVENTS_FLUSH_SIZE events are buffered, so big imports write as they go.
+
+A failed write is logged and its events are kept for the next flush, the request that happened to
+flush them carries on. While the database is down the buffer holds at most LOAD_EVENTS_MAX_BUFFER
+events, the oldest are dropped (and counted) to make room.
+
+load_events is partitioned by month on created_at. flask event-partitions creates the coming
+months' partitions ahead of time, anything outside them lands in load_events_default.
+'''
+from collections import namedtuple
+from datetime import date, datetime
+from threading import Lock
+from flask import current_app
+from sqlalchemy import event, text
+from models import db, LoadEvent
+from config import DEFAULT_FLUSH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_BUFFER
+import atexit
+import logging
+import time
+
+# Partitions made ahead of the current month.
+DEFAULT_MONTHS_AHEAD = 3
+KINDS = ('created', 'location', 'miles', 'data', 'delivered')
+FIELDS = ('load_id', 'user_id', 'kind', 'created_at', 'pickup_city', 'pickup_state', 'miles', 'detail')
+
+# A load's timeline, and the hours from its first event to its delivery (None until delivered).
+Timeline = namedtuple('Timeline', ['load_id', 'events', 'transit_hours'])
+
+
+class EventWriter:
+    '''Buffers committed events and writes them in batches.'''
+
+    def __init__(self, engine, flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, max_buffer=DEFAULT_MAX_BUFFER, log=None):
+        self.engine = engine
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.log = log or logging.getLogger(__name__)
+        self.lock = Lock()
+        self.buffer = []
+        self.oldest = None
+        self.written = 0
+        self.dropped = 0
+
+    def _trim(self):
+        '''Drops the oldest events over max_buffer. Called with the lock held.'''
+        over = len(self.buffer) - self.max_buffer
+        if over > 0:
+            del self.buffer[:over]
+            self.dropped += over
+            self.log.error(f'Load event buffer full, dropped the {over} oldest events ({self.dropped} so far)')
+
+    def add(self, events):
+        '''Buffers committed events, writing them if the buffer is full.'''
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.extend(events)
+            self._trim()
+            full = len(self.buffer) >= self.flush_size
+        if full:
+            self.flush()
+
+    def flush(self, due_only=False):
+        '''Writes everything buffered. With due_only, only if the oldest event has waited flush_interval.
+
+        Returns the number of events written. Never raises, a failed write is logged and retried next time.
+        '''
+        with self.lock:
+            if not self.buffer or (due_only and self.flush_interval and time.monotonic() - self.oldest < self.flush_interval):
+                return 0
+            events, self.buffer = self.buffer, []
+        table = LoadEvent.__table__
+        try:
+            with self.engine.begin() as connection:
+                for start in range(0, len(events), self.flush_size):
+                    connection.execute(table.insert().values(events[start:start + self.flush_size]))
+        except Exception as ex:
+            self.log.error(f'Could not write {len(events)} load events, keeping them for the next flush: {ex}')
+            # Kept for the next flush rather than lost, unless newer events have filled the buffer since.
+            with self.lock:
+                self.buffer[:0] = events
+                self._trim()
+            return 0
+        with self.lock:
+            self.written += len(events)
+        return len(events)
+
+
+_writer_lock = Lock()
+
+
+def get_writer():
+    '''Returns the app's event writer, creating it from the config on first use.'''
+    writer = current_app.extensions.get('event_writer')
+    if writer is None:
+        with _writer_lock:
+            writer = current_app.extensions.get('event_writer')
+            if writer is None:
+                config = current_app.config
+                writer = EventWriter(db.engine, flush_size=config.get('LOAD_EVENTS_FLUSH_SIZE', DEFAULT_FLUSH_SIZE),
+                                     flush_interval=config.get('LOAD_EVENTS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+                                     max_buffer=config.get('LOAD_EVENTS_MAX_BUFFER', DEFAULT_MAX_BUFFER), log=current_app.logger)
+                # Whatever is still buffered when the process stops.
+                atexit.register(writer.flush)
+                current_app.extensions['event_writer'] = writer
+    return writer
+
+
+def _pending(session):
+    return session.info.setdefault('load_events', [])
+
+
+def record_event(load_id, user_id, kind, pickup_city=None, pickup_state=None, miles=None, detail=None):
+    '''Records an event in the current transaction. It is written once the transaction commits.'''
+    _pending(db.session()).append(dict(load_id=load_id, user_id=user_id, kind=kind, created_at=datetime.utcnow(),
+                                       pickup_city=pickup_city, pickup_state=pickup_state, miles=miles, detail=detail))
+
+
+def _committed(session):
+    events = session.info.get('load_events')
+    if events:
+        session.info['load_events'] = []
+        get_writer().add(events)
+
+
+def _rolled_back(session):
+    session.info.pop('load_events', None)
+
+
+def flush_events():
+    '''Writes buffered events if they are due, for long running commands that never end their app context.'''
+    writer = current_app.extensions.get('event_writer')
+    if writer is not None:
+        writer.flush(due_only=True)
+
+
+def init_events(app):
+    '''Hands committed events to the writer and flushes it at the end of each request or command.'''
+    event.listen(db.session, 'after_commit', _committed)
+    event.listen(db.session, 'after_rollback', _rolled_back)
+
+    @app.teardown_appcontext
+    def flush_at_teardown(exc):
+        # Anything still pending never committed. Errors here would replace the response, so they are only logged.
+        try:
+            _rolled_back(db.session())
+            flush_events()
+        except Exception as ex:
+            current_app.logger.error(f'Could not flush load events: {ex}')
+
+#
+# TIMELINES
+#
+
+def get_timeline(load_id):
+    '''Returns a load's events in order, read with one index range per partition.'''
+    events = (db.session.query(LoadEvent.kind, LoadEvent.created_at, LoadEvent.pickup_city, LoadEvent.pickup_state, LoadEvent.miles, LoadEvent.detail)
+              .filter(LoadEvent.load_id == load_id).order_by(LoadEvent.created_at, LoadEvent.id).all())
+    transit_hours = None
+    delivered = [row.created_at for row in events if row.kind == 'delivered']
+    if events and delivered:
+        transit_hours = round((delivered[-1] - events[0].created_at).total_seconds() / 3600, 2)
+    return Timeline(load_id, events, transit_hours)
+
+
+def timeline_to_dict(timeline):
+    '''Turns a timeline into compact JSON, leaving out empty fields.'''
+    events = []
+    for row in timeline.events:
+        item = {'kind': row.kind, 'at': row.created_at.isoformat() + 'Z'}
+        if row.pickup_city:
+            item['location'] = f'{row.pickup_city}, {row.pickup_state}'
+        if row.miles is not None:
+            item['miles'] = row.miles
+        if row.detail:
+            item['detail'] = row.detail
+        events.append(item)
+    return {'load_id': timeline.load_id, 'events': events, 'transit_hours': timeline.transit_hours}
+
+#
+# PARTITIONS
+#
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'load_events_{month.year}_{month.month:02d}'
+
+
+def ensure_partitions(months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    '''Creates the monthly partitions from this month to months_ahead from now. Returns the ones it made.
+
+    Events already in the default partition for a new month are moved into it.
+    '''
+    today = today or date.today()
+    this_month = date(today.year, today.month, 1)
+    made = []
+    for offset in range(months_ahead + 1):
+        start = _add_months(this_month, offset)
+        name = partition_name(start)
+        if db.session.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar():
+            continue
+        end = _add_months(start, 1)
+        bounds = {'start': start, 'end': end}
+        db.session.execute(f'CREATE TABLE {name} (LIKE load_events INCLUDING DEFAULTS)')
+        db.session.execute(text(f'WITH moved AS (DELETE FROM load_events_default WHERE created_at >= :start AND created_at < :end RETURNING *) '
+                                f'INSERT INTO {name} SELECT * FROM moved'), bounds)
+        db.session.execute(f"ALTER TABLE load_events ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+        made.append(name)
+    db.session.commit()
+    return made
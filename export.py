@@ -0,0 +1,67 @@
+'''Load exports. Streams loads joined with their data, carrier and DC as CSV without holding them in memory.'''
+from models import db, Carrier, DistributionCenter, Load, LoadData
+import csv
+import io
+
+# Rows fetched from the server side cursor at a time.
+DEFAULT_BATCH_SIZE = 2000
+
+COLUMNS = [
+    ('load_id', Load.id),
+    ('po', Load.po),
+    ('name', Load.name),
+    ('pickup_city', Load.pickup_city),
+    ('pickup_state', Load.pickup_state),
+    ('due_date', Load.due_date),
+    ('day_of_week', Load.day_of_week),
+    ('temp', Load.temp),
+    ('team', Load.team),
+    ('miles', Load.miles),
+    ('delivered', Load.delivered),
+    ('carrier', Carrier.name),
+    ('distribution_center', DistributionCenter.name),
+    ('dc_city', DistributionCenter.city),
+    ('dc_state', DistributionCenter.state),
+    ('ontime', LoadData.ontime),
+    ('damages', LoadData.damges),
+    ('breakdown', LoadData.breakdown),
+    ('cost', LoadData.cost),
+    ('pallets', LoadData.pallets),
+    ('weight', LoadData.weight),
+]
+
+STATUSES = ('all', 'delivered', 'open')
+
+
+def export_rows(user_id, status='all', batch_size=DEFAULT_BATCH_SIZE):
+    '''Yields a user's loads as tuples, in COLUMNS order.
+
+    Rows come from a server side cursor a batch at a time, so memory stays flat however many loads there are.
+    '''
+    # Every join is scoped to the user, so no table is read past the user's own rows.
+    query = (db.session.query(*[column for name, column in COLUMNS])
+             .join(Carrier, (Carrier.id == Load.carrier_id) & (Carrier.user_id == user_id))
+             .join(DistributionCenter, (DistributionCenter.id == Load.d_c_id) & (DistributionCenter.user_id == user_id))
+             .outerjoin(LoadData, (LoadData.load_id == Load.id) & (LoadData.user_id == user_id))
+             .for_user(user_id))
+    if status == 'delivered':
+        query = query.filter(Load.delivered == 1)
+    elif status == 'open':
+        query = query.filter(Load.delivered == 0)
+    return query.order_by(Load.id).yield_per(batch_size)
+
+
+def csv_chunks(rows, batch_size=DEFAULT_BATCH_SIZE):
+    '''Yields CSV text a batch of rows at a time, starting with the header.'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, column in COLUMNS])
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,268 @@
+'''Cost and on time forecasts for open loads.
+
+A ridge regression on miles, team, temperature and day of the week, plus a per carrier offset, fitted
+on a user's delivered loads. The fit only needs running sums (X'X, X'y and per carrier totals), which
+PostgreSQL adds up in one aggregate query and which deliveries add to in place, so refitting never
+loops over loads in Python. Open loads are scored as one NumPy batch.
+
+Fitted models are cached per user and checked against the user's KPI rollup on every use: a model
+whose delivered count, on time count and cost don't match the rollup is refitted. NumPy is imported
+by the functions that need it, so processes that never forecast (workers, most commands) don't load it.
+'''
+from collections import namedtuple
+from threading import Lock
+from flask import current_app
+from sqlalchemy import Float, case, cast, extract, func, literal
+from cache import LRUCache
+from models import db, Load, LoadData, KPIRollup
+from kpi import get_user_totals
+
+# Monday is the baseline day, the others each get a feature. Their ISO days of the week count from Monday = 1.
+DAYS = ['Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+FEATURES = ['intercept', 'miles', 'team', 'temp'] + DAYS
+# Ridge penalty on the features other than the intercept.
+RIDGE = 1.0
+# Carriers with few deliveries are pulled toward the fleet average, as if they had this many average loads.
+CARRIER_PRIOR = 5
+# Fewest delivered loads worth forecasting from.
+MIN_HISTORY = 10
+DEFAULT_CACHE_SIZE = 256
+
+# One load's forecast.
+Forecast = namedtuple('Forecast', ['load_id', 'cost', 'ontime'])
+# Forecasts of all of a user's open loads as arrays, and the model that made them.
+OpenForecasts = namedtuple('OpenForecasts', ['model', 'ids', 'carrier_ids', 'cost', 'ontime'])
+
+_cache = None
+_lock = Lock()
+
+
+def _model_cache():
+    '''Returns the model cache, creating it from the app config on first use.'''
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(maxsize=current_app.config.get('FORECAST_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return _cache
+
+
+def features(miles, team, temp, due_date):
+    '''Builds the feature matrix of many loads from arrays of their columns.'''
+    import numpy as np
+    miles = np.asarray(miles, dtype=float)
+    x = np.zeros((len(miles), len(FEATURES)))
+    x[:, 0] = 1
+    x[:, 1] = np.nan_to_num(miles) / 1000
+    x[:, 2] = np.asarray(team, dtype=float)
+    x[:, 3] = np.asarray(temp, dtype=float) / 10
+    # From the date itself, day names depend on the locale.
+    isodow = np.array([day.isoweekday() if day else 0 for day in due_date])
+    for i in range(len(DAYS)):
+        x[:, 4 + i] = isodow == i + 2
+    return x
+
+
+def _sql_features():
+    '''The same features as SQL expressions over loads.'''
+    return ([literal(1.0), cast(func.coalesce(Load.miles, 0), Float) / 1000, cast(Load.team, Float), cast(Load.temp, Float) / 10]
+            + [case([(extract('isodow', Load.due_date) == i + 2, 1.0)], else_=0.0) for i in range(len(DAYS))])
+
+
+class ForecastModel:
+    '''Running sums of a user's delivered loads, and the coefficients fitted from them.'''
+
+    def __init__(self, signature, xtx, xty, carrier_ids, carrier_xsum, carrier_ysum):
+        # (delivered, ontime, cost) of the KPI rollup these sums match.
+        self.signature = signature
+        self.xtx = xtx
+        self.xty = xty
+        self.carriers = {id: i for i, id in enumerate(carrier_ids)}
+        self.carrier_xsum = carrier_xsum
+        self.carrier_ysum = carrier_ysum
+        self.fit()
+
+    @property
+    def history(self):
+        '''Number of delivered loads the model was fitted on.'''
+        return int(round(self.xtx[0, 0]))
+
+    def fit(self):
+        '''Solves the ridge normal equations and works out the carrier offsets.'''
+        import numpy as np
+        penalty = np.eye(len(FEATURES)) * RIDGE
+        penalty[0, 0] = 0
+        try:
+            self.beta = np.linalg.solve(self.xtx + penalty, self.xty)
+        except np.linalg.LinAlgError:
+            self.beta = np.linalg.lstsq(self.xtx + penalty, self.xty, rcond=None)[0]
+        # Each carrier's mean residual: (sum of y - (sum of x) . beta) / (loads + prior).
+        counts = self.carrier_xsum[:, 0]
+        self.offsets = (self.carrier_ysum - self.carrier_xsum @ self.beta) / (counts + CARRIER_PRIOR)[:, None]
+
+    def add(self, carrier_ids, x, y):
+        '''Adds newly delivered loads to the sums and refits.
+
+        Builds new arrays rather than changing them in place, so threads scoring with the model meanwhile see a consistent one.
+        '''
+        import numpy as np
+        carriers = dict(self.carriers)
+        for id in carrier_ids:
+            carriers.setdefault(id, len(carriers))
+        grow = len(carriers) - len(self.carriers)
+        carrier_xsum = np.vstack([self.carrier_xsum, np.zeros((grow, x.shape[1]))])
+        carrier_ysum = np.vstack([self.carrier_ysum, np.zeros((grow, y.shape[1]))])
+        rows = np.array([carriers[id] for id in carrier_ids], dtype=int)
+        np.add.at(carrier_xsum, rows, x)
+        np.add.at(carrier_ysum, rows, y)
+        self.xtx = self.xtx + x.T @ x
+        self.xty = self.xty + x.T @ y
+        self.carrier_xsum = carrier_xsum
+        self.carrier_ysum = carrier_ysum
+        self.fit()
+        self.carriers = carriers
+
+    def predict(self, carrier_ids, x):
+        '''Returns (cost, ontime probability) arrays for a feature matrix.'''
+        import numpy as np
+        y = x @ self.beta
+        rows = np.array([self.carriers.get(id, -1) for id in carrier_ids], dtype=int)
+        known = rows >= 0
+        y[known] += self.offsets[rows[known]]
+        return np.maximum(y[:, 0], 0), np.clip(y[:, 1], 0, 1)
+
+#
+# FITTING
+#
+
+def _signature(user_id):
+    '''Returns the (delivered, ontime, cost) of the user's KPI rollup, summed from the load data if they have none yet.'''
+    row = db.session.query(KPIRollup.delivered, KPIRollup.ontime, KPIRollup.cost).filter(KPIRollup.user_id == user_id).first()
+    if row is None:
+        totals = get_user_totals(user_id)
+        row = (totals.delivered, totals.ontime, totals.cost)
+    return tuple(int(value) for value in row)
+
+
+def fit_model(user_id, signature=None):
+    '''Fits a model from the user's delivered loads with one aggregate query, grouped by carrier.'''
+    import numpy as np
+    signature = signature or _signature(user_id)
+    xs = _sql_features()
+    size = len(xs)
+    pairs = [(i, j) for i in range(size) for j in range(i, size)]
+    ontime = cast(case([(LoadData.ontime == 1, 1.0)], else_=0.0), Float)
+    cost = cast(func.coalesce(LoadData.cost, 0), Float)
+    columns = ([func.sum(xs[i] * xs[j]) for i, j in pairs]
+               + [func.sum(x * cost) for x in xs] + [func.sum(x * ontime) for x in xs])
+    rows = (db.session.query(Load.carrier_id, *columns)
+            .join(LoadData, LoadData.load_id == Load.id)
+            .filter(LoadData.user_id == user_id, LoadData.delivered == 1, Load.user_id == user_id)
+            .group_by(Load.carrier_id).all())
+    carrier_ids = [row[0] for row in rows]
+    sums = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), -1)
+    # Per carrier X'X, then the user's X'X is their sum.
+    xtx = np.zeros((len(rows), size, size))
+    for k, (i, j) in enumerate(pairs):
+        xtx[:, i, j] = xtx[:, j, i] = sums[:, k]
+    xty = np.stack([sums[:, len(pairs):len(pairs) + size], sums[:, len(pairs) + size:]], axis=2)
+    # Row 0 of each carrier's X'X is its sum of x (x[0] is always 1), and likewise for X'y.
+    return ForecastModel(signature, xtx.sum(axis=0), xty.sum(axis=0), carrier_ids, xtx[:, 0, :], xty[:, 0, :])
+
+
+def get_model(user_id):
+    '''Returns the user's model, refitting it if deliveries have happened elsewhere since it was cached.
+
+    Returns None while the user has too few delivered loads to forecast from.
+    '''
+    signature = _signature(user_id)
+    if signature[0] < MIN_HISTORY:
+        return None
+    cache = _model_cache()
+    model = cache.get(user_id)
+    if model is None or model.signature != signature:
+        model = fit_model(user_id, signature)
+        cache.set(user_id, model)
+    return model
+
+
+def observe_deliveries(user_id, rows, delta):
+    '''Adds freshly delivered loads to the user's cached model, if there is one.
+
+    rows have the load's carrier_id, miles, team, temp and due_date and the data's cost and ontime,
+    delta is what the deliveries added to the KPI rollup. Should the transaction roll back, the model's
+    signature no longer matches the rollup and it is simply refitted on next use.
+    '''
+    if not rows:
+        return
+    model = _model_cache().get(user_id)
+    if model is None:
+        return
+    import numpy as np
+    x = features([row.miles for row in rows], [row.team for row in rows], [row.temp for row in rows], [row.due_date for row in rows])
+    y = np.array([[row.cost or 0, 1 if row.ontime == 1 else 0] for row in rows], dtype=float)
+    with _lock:
+        model.add([row.carrier_id for row in rows], x, y)
+        model.signature = (model.signature[0] + delta.delivered, model.signature[1] + delta.ontime, model.signature[2] + delta.cost)
+
+#
+# SCORING
+#
+
+def score_loads(user_id, loads):
+    '''Forecasts a list of loads. Returns {load id: Forecast}, empty without enough history.'''
+    model = get_model(user_id)
+    if model is None or not loads:
+        return {}
+    x = features([load.miles for load in loads], [load.team for load in loads], [load.temp for load in loads], [load.due_date for load in loads])
+    cost, ontime = model.predict([load.carrier_id for load in loads], x)
+    return {load.id: Forecast(load.id, round(float(c), 2), round(float(p) * 100, 1)) for load, c, p in zip(loads, cost, ontime)}
+
+
+def score_open_loads(user_id):
+    '''Forecasts every open load of a user in one batch.
+
+    Returns OpenForecasts, or None without enough history.
+    '''
+    model = get_model(user_id)
+    if model is None:
+        return None
+    import numpy as np
+    rows = (db.session.query(Load.id, Load.carrier_id, Load.miles, Load.team, Load.temp, Load.due_date)
+            .filter(Load.user_id == user_id, Load.delivered == 0).all())
+    if not rows:
+        empty = np.array([], dtype=float)
+        return OpenForecasts(model, np.array([], dtype=int), np.array([], dtype=int), empty, empty)
+    ids, carrier_ids, miles, team, temp, due_date = zip(*rows)
+    cost, ontime = model.predict(carrier_ids, features(miles, team, temp, due_date))
+    return OpenForecasts(model, np.array(ids), np.array(carrier_ids), cost, ontime)
+
+
+def summarize_open_loads(user_id, riskiest=20):
+    '''Totals of the open load forecasts, per carrier and overall, and the loads least likely to be on time.
+
+    Returns None without enough history.
+    '''
+    scored = score_open_loads(user_id)
+    if scored is None:
+        return None
+    import numpy as np
+    model, ids, carrier_ids, cost, ontime = scored
+    carriers, index = np.unique(carrier_ids, return_inverse=True)
+    counts = np.bincount(index, minlength=len(carriers))
+    costs = np.bincount(index, weights=cost, minlength=len(carriers))
+    late = np.bincount(index, weights=1 - ontime, minlength=len(carriers))
+    by_carrier = [dict(carrier_id=int(carrier), loads=int(n), cost=round(float(c), 2), late=round(float(l), 1))
+                  for carrier, n, c, l in zip(carriers, counts, costs, late)]
+    worst = np.argsort(ontime, kind='stable')[:riskiest]
+    return dict(
+        loads=len(ids),
+        cost=round(float(cost.sum()), 2),
+        late=round(float((1 - ontime).sum()), 1),
+        history=model.history,
+        by_carrier=sorted(by_carrier, key=lambda row: -row['cost']),
+        riskiest=[Forecast(int(ids[i]), round(float(cost[i]), 2), round(float(ontime[i]) * 100, 1)) for i in worst],
+    )
+
+
+def cache_stats():
+    '''Returns the size and hit/miss counters of the model cache.'''
+    return _model_cache().stats()
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, SelectField, IntegerField, DateField
 from wtforms.validators import DataRequired, EqualTo, Length
 
@@ -36,7 +37,6 @@ class LoadForm(FlaskForm):
     city = StringField('City', validators=[DataRequired()])
     state = SelectField('State', choices=[(st, st) for st in states])
     due_date = DateField('Due Date', validators=[DataRequired()], format='%m/%d/%Y')
-    day_of_week = SelectField('Day Of Week', choices=[(d, d) for d in days])
     temp = IntegerField('Temperture (F)', validators=[DataRequired()])
     team = SelectField('Team', choices=[c for c in choice], coerce=int)
     carrier_id = SelectField('Carrier', coerce=int)
@@ -54,3 +54,6 @@ class LoadDataForm(FlaskForm):
     pallets = IntegerField('Pallets', validators=[DataRequired()])
     weight = IntegerField('Weight (LBS)', validators=[DataRequired()])
     
+class LoadImportForm(FlaskForm):
+    file = FileField('Loads File', validators=[FileRequired()])
+    format = SelectField('Format', choices=[('csv', 'CSV'), ('jsonl', 'JSON Lines')])
@@ -0,0 +1,168 @@
+'''Geocoding of DC and carrier addresses.
+
+DC's and carriers are located once, when they are added, and their latitude and longitude are
+stored with them, so distance lookups never have to resolve the DC's city again. A city that can't
+be found is placed in the middle of its state and flagged as approximate, so the user can be told
+and the place found again later; only an unknown state is refused.
+Rows added before coordinates were stored are located by flask geocode-places, which calls the
+geocoder from a bounded pool of threads and writes each batch with one executemany UPDATE.
+
+The geocoder is offline (the bundled city centroids, the default) or MapQuest (GEOCODER).
+'''
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import bindparam
+from models import db, Carrier, DistributionCenter
+from metrics import external_call
+from distance import DEFAULT_TIMEOUT, get_centroid_table
+
+GEOCODE_URL = 'http://www.mapquestapi.com/geocoding/v1/address'
+DEFAULT_GEOCODER = 'offline'
+DEFAULT_THREADS = 8
+DEFAULT_BATCH_SIZE = 500
+# MapQuest granularities that only place an address in a country or state.
+COARSE_QUALITIES = ('A1', 'A3')
+
+MODELS = {'dcs': DistributionCenter, 'carriers': Carrier}
+
+# Where an address is, and whether the city itself was found rather than just its state.
+Coordinates = namedtuple('Coordinates', ['latitude', 'longitude', 'exact'])
+
+# What a backfill did: rows located (approximate ones included), rows only placed in their state,
+# rows that couldn't be found, rows whose lookup failed.
+BackfillResult = namedtuple('BackfillResult', ['located', 'approximate', 'not_found', 'failed'])
+
+
+class GeocodeUnavailable(Exception):
+    '''Raised when a geocoder can't be reached.'''
+
+
+class Geocoder:
+    '''Interface for things that turn an address into coordinates.'''
+
+    def locate(self, address, city, state, zip=None):
+        '''Returns the Coordinates of an address. Raises LookupError if the state is unknown.'''
+        raise NotImplementedError
+
+
+class OfflineGeocoder(Geocoder):
+    '''Places an address at its city's centroid.'''
+
+    def __init__(self, table):
+        self.table = table
+
+    def locate(self, address, city, state, zip=None):
+        latitude, longitude, exact = self.table.locate(city, state)
+        return Coordinates(float(latitude), float(longitude), exact)
+
+
+class MapQuestGeocoder(Geocoder):
+    '''Asks MapQuest's geocoding API. Thread safe, every call is its own request.'''
+
+    def __init__(self, key, url=GEOCODE_URL, timeout=DEFAULT_TIMEOUT):
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+
+    def locate(self, address, city, state, zip=None):
+        import requests
+        location = ', '.join(part for part in (address, city, state, zip) if part)
+        try:
+            with external_call():
+                response = requests.get(url=self.url, params={'key': self.key, 'location': location}, timeout=self.timeout)
+            found = response.json()['results'][0]['locations']
+        except (requests.RequestException, ValueError, KeyError, IndexError) as ex:
+            raise GeocodeUnavailable(str(ex))
+        if not found:
+            raise LookupError(f'Could not find {location}')
+        best = found[0]
+        return Coordinates(best['latLng']['lat'], best['latLng']['lng'], best.get('geocodeQualityCode', '')[:2] not in COARSE_QUALITIES)
+
+
+def get_geocoder():
+    '''Returns the app's geocoder, building it from the config on first use.'''
+    geocoder = current_app.extensions.get('geocoder')
+    if geocoder is None:
+        config = current_app.config
+        if config.get('GEOCODER', DEFAULT_GEOCODER) == 'mapquest':
+            geocoder = MapQuestGeocoder(key=config.get('CONSUMER_KEY'), url=config.get('MAPQUEST_GEOCODE_URL', GEOCODE_URL),
+                                        timeout=config.get('MAPQUEST_TIMEOUT', DEFAULT_TIMEOUT))
+        else:
+            geocoder = OfflineGeocoder(get_centroid_table())
+        current_app.extensions['geocoder'] = geocoder
+    return geocoder
+
+
+def geocode_place(place):
+    '''Locates a new DC or carrier and stores its coordinates on it.
+
+    Returns an error message if it can't be found at all. A place only found in its state is stored
+    there with approximate set. If the geocoder is down the place is kept without coordinates, for
+    flask geocode-places to fill in later.
+    '''
+    try:
+        coordinates = get_geocoder().locate(place.address, place.city, place.state, place.zip)
+    except GeocodeUnavailable:
+        return None
+    except LookupError:
+        return f'Could not find {place.city}, {place.state}. Please check the state.'
+    place.latitude, place.longitude = coordinates.latitude, coordinates.longitude
+    place.approximate = 0 if coordinates.exact else 1
+    return None
+
+#
+# BACKFILL
+#
+
+def _locate(geocoder, row):
+    '''Locates one row for the pool, returning Coordinates, None if it wasn't found, or the exception.'''
+    id, address, city, state, zip = row
+    try:
+        coordinates = geocoder.locate(address, city, state, zip)
+    except GeocodeUnavailable as ex:
+        return ex
+    except LookupError:
+        return None
+    return coordinates
+
+
+def backfill_coordinates(kind, threads=DEFAULT_THREADS, batch_size=DEFAULT_BATCH_SIZE, echo=print):
+    '''Locates every DC or carrier ('dcs' or 'carriers') without coordinates. Returns a BackfillResult.
+
+    Rows are read a batch at a time in id order and located by at most threads concurrent calls.
+    Rows only found in their state are stored there as approximate, rows that can't be found at all
+    are reported and left without coordinates.
+    '''
+    model = MODELS[kind]
+    table = model.__table__
+    geocoder = get_geocoder()
+    update = (table.update().where(table.c.id == bindparam('b_id'))
+              .values(latitude=bindparam('b_latitude'), longitude=bindparam('b_longitude'), approximate=bindparam('b_approximate')))
+    located = approximate = not_found = failed = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            rows = (db.session.query(model.id, model.address, model.city, model.state, model.zip)
+                    .filter(model.latitude.is_(None), model.id > last_id).order_by(model.id).limit(batch_size).all())
+            if not rows:
+                break
+            last_id = rows[-1].id
+            params = []
+            for row, result in zip(rows, pool.map(lambda row: _locate(geocoder, row), rows)):
+                if isinstance(result, Coordinates):
+                    params.append({'b_id': row.id, 'b_latitude': result.latitude, 'b_longitude': result.longitude, 'b_approximate': 0 if result.exact else 1})
+                    if not result.exact:
+                        approximate += 1
+                        echo(f'{kind} {row.id}: could not find {row.city}, placed in the middle of {row.state}')
+                elif result is None:
+                    not_found += 1
+                    echo(f'{kind} {row.id}: could not find {row.city}, {row.state}')
+                else:
+                    failed += 1
+            if params:
+                db.session.execute(update, params)
+            db.session.commit()
+            located += len(params)
+            echo(f'{kind}: done up to id {last_id}, {located} located so far')
+    return BackfillResult(located, approximate, not_found, failed)
@@ -0,0 +1,25 @@
+'''gunicorn settings. Worker and thread counts come from WEB_CONCURRENCY and GUNICORN_THREADS,
+the same numbers pooling.py sizes each worker's connection pool from.'''
+from pooling import concurrency
+import os
+
+workers, threads = concurrency()
+# Threads let a worker keep serving while a request waits on PostgreSQL or MapQuest.
+worker_class = 'gthread'
+bind = f'0.0.0.0:{os.environ.get("PORT", "8000")}'
+# Loads the app once in the master so workers share its memory.
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Recycles workers now and then so slow leaks can't build up. The jitter stops them all restarting together.
+max_requests = 2000
+max_requests_jitter = 200
+
+
+def post_fork(server, worker):
+    '''Drops any connections the master opened, so workers never share a socket with it.'''
+    from models import db
+    from wsgi import app
+    with app.app_context():
+        db.engine.dispose()
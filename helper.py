@@ -1,125 +1,81 @@
 '''Below are functions that help with app functionality.'''
+from datetime import date, timedelta
 from flask import flash, redirect, session
-from models import Carrier, DistributionCenter, LoadData, db
-import requests
+from models import DistributionCenter, db
+from distance import cached_miles
+from refdata import get_choices
 
-BASE_URL = 'http://www.mapquestapi.com/directions/v2/route'
+def tenant_query(*entities):
+    '''Starts a query for models or columns, scoped to the logged in user's rows.'''
+    return db.session.query(*entities).for_user(session.get('user_id'))
 
 def get_user_carriers():
     '''Creates a tuple per user to create a selectfield with WTForms'''
-    carriers = Carrier.get_carrier_by_user(user_id=session['user_id'])
-    tup_carriers = []
-    for carrier in carriers:
-        tup_carriers.append((carrier.id, carrier.name))    
-    return tup_carriers
+    return get_choices(user_id=session['user_id'], kind='carriers')
 
 def get_dc():
     '''Creates a tuple per user to create a selectfield with WTForms'''
-    dc = DistributionCenter.get_dist_by_user(user_id=session['user_id'])
-    tup_dc = []
-    for d in dc:
-        tup_dc.append((d.id, d.name))
-    return tup_dc
-
-def get_miles(app, dc_id, city, state):
-    '''Calls MapQuest API to get current location.'''
+    return get_choices(user_id=session['user_id'], kind='dcs')
+
+def get_miles(dc_id, city, state):
+    '''Gets the distance from a location to a DC using the configured distance provider.'''
     dc = DistributionCenter.query.filter_by(id=dc_id).first()
-    response = requests.get(url=BASE_URL, params={'key': app, 'from': f'{city}, {state}', 'to': f'{dc.city}, {dc.state}'})
-    data = response.json()
-    return data['route']['distance']
-
-def ontime_KPI():
-    '''Returns the AVG of ontime loads.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum = 0
-    count = 0
-    for load in load_data:
-        if load.ontime == 1:
-            sum = sum + 1
-            count += 1
-        else:
-            count += 1
-    try:
-        avg = (sum / count) * 100
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
-
-def damages_KPI():
-    '''Returns the AVG of damaged loads.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum = 0
-    count = 0
-    for load in load_data:
-        if load.damges == 1:
-            sum = sum + 1
-            count += 1
-        else:
-            count += 1
-    try:
-        avg = (sum / count) * 100
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
-
-def breakdown_KPI():
-    '''Returns the AVG of brokendown loads.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum = 0
-    count = 0
-    for load in load_data:
-        if load.breakdown == 1:
-            sum = sum + 1
-            count += 1
-        else:
-            count += 1
-    try:
-        avg = (sum / count) * 100
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
-
-def avg_cost_load():
-    '''Returns the AVG cost of loads.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum = 0
-    count = 0
-    for load in load_data:
-        sum += load.cost
-        count += 1
-    try:
-        avg = sum / count
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
-
-def cost_per_pallet():
-    '''Returns the AVG cost per pallet.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum_cost = 0
-    sum_pallets = 0
-    for load in load_data:
-        sum_cost += load.cost
-        sum_pallets += load.pallets
+    return cached_miles(city=city, state=state, dc=dc)
+
+BOARD_PAGE_SIZE = 50
+BOARD_MAX_PAGE_SIZE = 200
+
+def _int_arg(args, name):
+    '''Reads an optional whole number from the query string.'''
     try:
-        avg = sum_cost / sum_pallets
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
-
-def cost_per_lbs():
-    '''Returns the AVG cost oer pound.'''
-    load_data = LoadData.query.filter(LoadData.delivered==1, LoadData.user_id == session['user_id']).all()
-    sum_cost = 0
-    sum_weight = 0
-    for load in load_data:
-        sum_cost += load.cost
-        sum_weight += load.weight
+        return int(args[name])
+    except (KeyError, ValueError):
+        return None
+
+# Load board due date filters, as (first day, day after the last) counted from today. None is open ended.
+DUE_WINDOWS = {
+    'overdue': (None, 0),
+    'today': (0, 1),
+    'week': (0, 7),
+}
+
+def get_due_range(due, today=None):
+    '''Turns a due date filter into the (due_after, due_before) dates it covers.'''
+    if due not in DUE_WINDOWS:
+        return None, None
+    today = today or date.today()
+    return tuple(None if days is None else today + timedelta(days=days) for days in DUE_WINDOWS[due])
+
+def get_board_filters(args):
+    '''Reads the load board filters from the query string.'''
+    due_after, due_before = get_due_range(args.get('due'))
+    return {
+        'carrier_id': _int_arg(args, 'carrier_id'),
+        'd_c_id': _int_arg(args, 'd_c_id'),
+        'state': args.get('state') or None,
+        'team': _int_arg(args, 'team'),
+        'temp_min': _int_arg(args, 'temp_min'),
+        'temp_max': _int_arg(args, 'temp_max'),
+        'due_after': due_after,
+        'due_before': due_before,
+    }
+
+def get_page_size(args):
+    '''Reads the load board page size from the query string.'''
+    size = _int_arg(args, 'per_page') or BOARD_PAGE_SIZE
+    return max(1, min(size, BOARD_MAX_PAGE_SIZE))
+
+def encode_cursor(load):
+    '''Turns the last load on a page into the cursor of the next page. An undated load has an empty date.'''
+    return f'{load.due_date or ""}|{load.miles}|{load.id}'
+
+def decode_cursor(value):
+    '''Turns a cursor back into a (due_date, miles, id) tuple. Bad cursors start from the first page.'''
     try:
-        avg = sum_cost / sum_weight
-    except ZeroDivisionError:
-        avg = 0
-    return round(avg , 2)
+        due_date, miles, id = value.split('|')
+        return (date.fromisoformat(due_date) if due_date else None, int(miles), int(id))
+    except (AttributeError, ValueError):
+        return None
 
 def try_commit(success, fail):
     '''Tries to commit changes to DB. If something goes wrong, will redirect.'''
@@ -0,0 +1,217 @@
+'''Bulk load importer. Streams CSV or JSON lines files into the loads and load_data tables.'''
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from models import db, DistributionCenter
+from refdata import get_choices
+from forms import states
+from distance import get_provider, cached_miles, miles_or_none
+from events import record_event
+import csv
+import io
+import json
+import shutil
+import tempfile
+
+DEFAULT_CHUNK_SIZE = 1000
+# Only the first few bad rows are reported back.
+MAX_ERRORS = 100
+
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d')
+YES_NO = {'0': 0, '1': 1, 'no': 0, 'yes': 1, 'false': 0, 'true': 1}
+
+ImportResult = namedtuple('ImportResult', ['imported', 'failed', 'errors'])
+
+
+class RowError(Exception):
+    '''Raised when an imported row doesn't pass validation.'''
+
+
+def read_rows(stream, fmt='csv'):
+    '''Yields (line number, row dict) pairs from a text stream, one row at a time.'''
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt in ('json', 'jsonl'):
+        for line_num, line in enumerate(stream, start=1):
+            if line.strip():
+                try:
+                    yield line_num, json.loads(line)
+                except ValueError:
+                    yield line_num, None
+    else:
+        raise ValueError(f'Unknown import format: {fmt}')
+
+
+def text_stream(binary):
+    '''Wraps an uploaded file's binary stream so it can be read as text.
+
+    Werkzeug keeps uploads in a SpooledTemporaryFile, which before Python 3.11 lacks the readable()
+    and readinto() TextIOWrapper needs, so the upload is copied into a real temporary file first.
+    '''
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(binary, spooled)
+    spooled.seek(0)
+    return io.TextIOWrapper(spooled, encoding='utf-8-sig', newline='')
+
+
+def name_map(kind, user_id):
+    '''Maps lower cased names to ids for a user's 'carriers' or 'dcs'.
+
+    Names used by more than one row map to None so they can be reported as ambiguous.
+    '''
+    names = {}
+    for id, name in get_choices(user_id=user_id, kind=kind):
+        key = name.strip().lower()
+        names[key] = None if key in names else id
+    return names
+
+
+def _text(row, field):
+    '''Returns a required text value from a row.'''
+    value = str(row.get(field) or '').strip()
+    if not value:
+        raise RowError(f'{field} is required.')
+    return value
+
+
+def _lookup(row, field, names, label):
+    '''Resolves a carrier or DC name (or id) to an id.'''
+    value = _text(row, field).lower()
+    if value not in names:
+        raise RowError(f'Unknown {label}: {row.get(field)}')
+    if names[value] is None:
+        raise RowError(f'More than one {label} is named {row.get(field)}')
+    return names[value]
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    '''Parses a due date in any of the accepted formats. Imports repeat dates a lot, so results are cached.'''
+    for fmt in DATE_FORMATS:
+        try:
+            return str(datetime.strptime(value, fmt).date())
+        except ValueError:
+            pass
+    raise RowError(f'Not a valid date: {value}')
+
+
+def validate_row(row, carriers, dcs):
+    '''Checks a row against the same rules as LoadForm and returns the load's column values.'''
+    if not isinstance(row, dict):
+        raise RowError('Row is not a JSON object.')
+    values = {
+        'po': _text(row, 'po'),
+        'name': _text(row, 'name'),
+        'pickup_city': _text(row, 'city'),
+    }
+    state = _text(row, 'state').upper()
+    if state not in states:
+        raise RowError(f'Not a valid state: {state}')
+    values['pickup_state'] = state
+    # The day of the week comes from the due date, a day_of_week column is ignored.
+    values['due_date'] = parse_date(_text(row, 'due_date'))
+    try:
+        values['temp'] = int(_text(row, 'temp'))
+    except ValueError:
+        raise RowError('temp must be a whole number.')
+    # LoadForm's DataRequired rejects a temperature of 0, so we do too.
+    if not values['temp']:
+        raise RowError('temp is required.')
+    team = _text(row, 'team').lower()
+    if team not in YES_NO:
+        raise RowError(f'Not a valid team value: {team}')
+    values['team'] = YES_NO[team]
+    values['carrier_id'] = _lookup(row, 'carrier', carriers, 'carrier')
+    values['d_c_id'] = _lookup(row, 'dc', dcs, 'distribution center')
+    return values
+
+
+def _add_miles(loads, dcs):
+    '''Fills in the miles of a chunk of loads, one provider call per DC.'''
+    provider = get_provider()
+    by_dc = {}
+    for load in loads:
+        by_dc.setdefault(load['d_c_id'], []).append(load)
+    for d_c_id, dc_loads in by_dc.items():
+        dc = dcs[d_c_id]
+        places = [(load['pickup_city'], load['pickup_state']) for load in dc_loads]
+        if provider.remote:
+            miles = [cached_miles(city=city, state=state, dc=dc) for city, state in places]
+        else:
+            miles = miles_or_none(provider, places, dc)
+        # loads.miles is a whole number column. None is left for places that couldn't be located.
+        for load, value in zip(dc_loads, miles):
+            load['miles'] = None if value is None else int(round(value))
+
+
+LOAD_COLUMNS = ('po', 'name', 'pickup_city', 'pickup_state', 'due_date', 'temp', 'team', 'miles', 'carrier_id', 'd_c_id')
+
+
+def _copy_rows(cursor, table, columns, rows):
+    '''Streams rows into a table with COPY, the fastest way into PostgreSQL.'''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def _insert_chunk(loads, user_id):
+    '''Inserts a chunk of loads and their empty load data.
+
+    Load ids are reserved from the sequence up front so both tables can be written with COPY.
+    '''
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence('loads', 'id')) FROM generate_series(1, %s)", (len(loads),))
+        ids = [id for (id,) in cursor.fetchall()]
+        _copy_rows(cursor, 'loads', ('id',) + LOAD_COLUMNS + ('user_id', 'delivered'),
+                   ((id,) + tuple(load[column] for column in LOAD_COLUMNS) + (user_id, 0) for id, load in zip(ids, loads)))
+        _copy_rows(cursor, 'load_data', ('load_id', 'user_id', 'ontime', 'damges', 'breakdown', 'cost', 'pallets', 'weight', 'delivered'),
+                   ((id, user_id, 0, 0, 0, 0, 0, 0, 0) for id in ids))
+    finally:
+        cursor.close()
+    for id, load in zip(ids, loads):
+        record_event(id, user_id, 'created', pickup_city=load['pickup_city'], pickup_state=load['pickup_state'], miles=load['miles'])
+    return len(ids)
+
+
+def import_loads(stream, user_id, fmt='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Imports loads for a user from a text stream.
+
+    Rows are validated and inserted a chunk at a time, each chunk in its own transaction,
+    so memory use doesn't depend on the size of the file. Bad rows are skipped and reported.
+    '''
+    carriers = name_map('carriers', user_id)
+    dcs = name_map('dcs', user_id)
+    dc_rows = {dc.id: dc for dc in DistributionCenter.query.filter_by(user_id=user_id)}
+    imported = 0
+    failed = 0
+    errors = []
+    rows = read_rows(stream, fmt)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        loads = []
+        for line_num, row in chunk:
+            try:
+                loads.append((line_num, validate_row(row, carriers, dcs)))
+            except RowError as ex:
+                failed += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append((line_num, str(ex)))
+        if loads:
+            _add_miles([load for line_num, load in loads], dc_rows)
+            for line_num, load in loads:
+                if load['miles'] is None:
+                    failed += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append((line_num, f'Could not find {load["pickup_city"]}, {load["pickup_state"]}.'))
+            loads = [load for line_num, load in loads if load['miles'] is not None]
+        if loads:
+            imported += _insert_chunk(loads, user_id)
+            db.session.commit()
+    return ImportResult(imported=imported, failed=failed, errors=errors)
@@ -0,0 +1,194 @@
+'''KPI engine. Computes the load KPI's inside the database instead of in Python.'''
+from collections import namedtuple
+from sqlalchemy import Date, cast, func
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Carrier, DistributionCenter, Load, LoadData, KPIRollup
+from totals import flag_sum, value_sum
+
+# The six figures rendered on the KPI page.
+KPIs = namedtuple('KPIs', ['ontime', 'breakdown', 'damages', 'avg_load', 'avg_pallet', 'avg_weight'])
+
+# Raw counters the KPI's are derived from.
+KPITotals = namedtuple('KPITotals', ['delivered', 'ontime', 'damages', 'breakdown', 'cost', 'pallets', 'weight'])
+
+# One row of a grouped KPI breakdown. Fields that are not grouped on are None.
+KPIGroup = namedtuple('KPIGroup', ['carrier_id', 'carrier', 'd_c_id', 'dc', 'period', 'delivered', 'kpis'])
+
+GROUPINGS = ('carrier', 'dc')
+PERIODS = ('week', 'month')
+
+
+def totals_columns():
+    '''Aggregate columns that build a KPITotals row, in field order.'''
+    return [
+        func.count(LoadData.id),
+        flag_sum(LoadData.ontime),
+        flag_sum(LoadData.damges),
+        flag_sum(LoadData.breakdown),
+        value_sum(LoadData.cost),
+        value_sum(LoadData.pallets),
+        value_sum(LoadData.weight),
+    ]
+
+
+def _ratio(numerator, denominator, scale=1):
+    '''Divides two totals, returning 0 when there is nothing to divide by.'''
+    try:
+        avg = (numerator / denominator) * scale
+    except ZeroDivisionError:
+        avg = 0
+    return round(avg, 2)
+
+
+def kpis_from_totals(totals):
+    '''Turns raw counters into the KPI figures.'''
+    return KPIs(
+        ontime=_ratio(totals.ontime, totals.delivered, 100),
+        breakdown=_ratio(totals.breakdown, totals.delivered, 100),
+        damages=_ratio(totals.damages, totals.delivered, 100),
+        avg_load=_ratio(totals.cost, totals.delivered),
+        avg_pallet=_ratio(totals.cost, totals.pallets),
+        avg_weight=_ratio(totals.cost, totals.weight),
+    )
+
+
+def get_user_totals(user_id):
+    '''Sums every delivered load of a user in a single aggregate query.'''
+    row = db.session.query(*totals_columns()).filter(LoadData.delivered == 1, LoadData.user_id == user_id).one()
+    return KPITotals(*[int(value) for value in row])
+
+
+def get_user_kpis(user_id):
+    '''Returns the KPI's of a user from their rollup row.
+    
+    Users without a rollup row yet get KPI's computed from their load data. Nothing is written, the
+    row is created by their next delivery or by flask rebuild-kpis.
+    '''
+    rollup = KPIRollup.query.get(user_id)
+    if rollup is None:
+        return kpis_from_totals(get_user_totals(user_id))
+    return kpis_from_totals(KPITotals(*[getattr(rollup, field) for field in KPITotals._fields]))
+
+
+def get_grouped_kpis(user_id, group_by=GROUPINGS, period=None, since=None):
+    '''Returns the KPI's of a user grouped by carrier, DC and/or due date period.
+    
+    Everything is computed in one GROUP BY query over load_data joined with loads.
+    group_by is any of 'carrier' and 'dc', period is None, 'week' or 'month'
+    and since limits the loads to those due on or after a date.
+    '''
+    due_date = Load.due_date
+    keys = []
+    if 'carrier' in group_by:
+        keys += [Carrier.id, Carrier.name]
+    if 'dc' in group_by:
+        keys += [DistributionCenter.id, DistributionCenter.name]
+    if period in PERIODS:
+        keys.append(cast(func.date_trunc(period, due_date), Date))
+    query = (db.session.query(*keys, *totals_columns())
+             .join(Load, Load.id == LoadData.load_id)
+             .filter(LoadData.delivered == 1, LoadData.user_id == user_id, Load.user_id == user_id))
+    # The joins are scoped to the user too, so they read the user's carriers and DC's from their index.
+    if 'carrier' in group_by:
+        query = query.join(Carrier, (Carrier.id == Load.carrier_id) & (Carrier.user_id == user_id))
+    if 'dc' in group_by:
+        query = query.join(DistributionCenter, (DistributionCenter.id == Load.d_c_id) & (DistributionCenter.user_id == user_id))
+    if since:
+        query = query.filter(due_date >= since)
+    query = query.group_by(*keys)
+    if period in PERIODS:
+        query = query.order_by(keys[-1].desc(), *keys[:-1])
+    else:
+        query = query.order_by(*keys)
+    groups = []
+    for row in query:
+        row = list(row)
+        values = dict(carrier_id=None, carrier=None, d_c_id=None, dc=None, period=None)
+        if 'carrier' in group_by:
+            values['carrier_id'], values['carrier'] = row.pop(0), row.pop(0)
+        if 'dc' in group_by:
+            values['d_c_id'], values['dc'] = row.pop(0), row.pop(0)
+        if period in PERIODS:
+            values['period'] = row.pop(0)
+        totals = KPITotals(*[int(value) for value in row])
+        groups.append(KPIGroup(delivered=totals.delivered, kpis=kpis_from_totals(totals), **values))
+    return groups
+
+# 
+# ROLLUP MAINTENANCE
+# 
+
+def load_data_counters(data):
+    '''Returns what a single delivered load data row adds to the rollup.'''
+    return KPITotals(
+        delivered=1,
+        ontime=1 if data.ontime == 1 else 0,
+        damages=1 if data.damges == 1 else 0,
+        breakdown=1 if data.breakdown == 1 else 0,
+        cost=data.cost or 0,
+        pallets=data.pallets or 0,
+        weight=data.weight or 0,
+    )
+
+
+def apply_rollup_delta(user_id, delta):
+    '''Adds a delta to a user's rollup inside the current transaction.
+    
+    Must be called after the load data change itself has been made on the session.
+    If the user has no rollup row yet, it is built from the (flushed) load data instead.
+    '''
+    values = {field: getattr(KPIRollup, field) + amount for field, amount in delta._asdict().items()}
+    updated = KPIRollup.query.filter_by(user_id=user_id).update(values, synchronize_session=False)
+    if not updated:
+        db.session.flush()
+        refresh_user_rollup(user_id)
+
+
+def refresh_user_rollup(user_id):
+    '''Rebuilds one user's rollup row from their load data.'''
+    totals = get_user_totals(user_id)
+    _upsert_rollups([dict(user_id=user_id, **totals._asdict())])
+
+
+def _upsert_rollups(rows):
+    '''Inserts rollup rows, overwriting any that already exist.'''
+    if not rows:
+        return
+    stmt = insert(KPIRollup.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(index_elements=['user_id'], set_={field: stmt.excluded[field] for field in KPITotals._fields})
+    db.session.execute(stmt)
+
+
+def _all_user_totals():
+    '''Sums the delivered load data of every user in one grouped query.'''
+    rows = db.session.query(LoadData.user_id, *totals_columns()).filter(LoadData.delivered == 1).group_by(LoadData.user_id)
+    return {row[0]: KPITotals(*[int(value) for value in row[1:]]) for row in rows}
+
+
+def rebuild_rollups():
+    '''Rebuilds every rollup row from the load data. Returns the number of rows written.'''
+    totals = _all_user_totals()
+    # Users whose loads are gone (or were never delivered) are reset to zero.
+    zero = KPITotals(*[0] * len(KPITotals._fields))
+    for (user_id,) in db.session.query(KPIRollup.user_id):
+        totals.setdefault(user_id, zero)
+    _upsert_rollups([dict(user_id=user_id, **row._asdict()) for user_id, row in totals.items()])
+    db.session.commit()
+    return len(totals)
+
+
+def find_rollup_drift():
+    '''Compares every user's rollup row with their load data.
+    
+    Returns a list of (user_id, rollup totals, actual totals) for users that disagree. Users with
+    delivered loads but no rollup row are included, with None as their rollup totals.
+    '''
+    actual = _all_user_totals()
+    stored = {rollup.user_id: KPITotals(*[getattr(rollup, field) for field in KPITotals._fields]) for rollup in KPIRollup.query.all()}
+    zero = KPITotals(*[0] * len(KPITotals._fields))
+    drift = []
+    for user_id in sorted(set(actual) | set(stored)):
+        expected = actual.get(user_id, zero)
+        if stored.get(user_id) != expected:
+            drift.append((user_id, stored.get(user_id), expected))
+    return drift
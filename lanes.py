@@ -0,0 +1,104 @@
+'''Lane analytics. Keeps running sums per lane (pickup city/state to DC) of delivered loads, so what a lane
+usually costs and how often it runs late is a primary key lookup instead of a scan of every load.
+
+Lanes are updated in the same transaction as the delivery or load data change that affects them.
+They reflect each load's location and miles when it was delivered; flask rebuild-lanes recomputes
+them from the current loads, for instance after moving delivered loads.
+'''
+from collections import namedtuple
+from math import sqrt
+from sqlalchemy import BigInteger, cast, func
+from models import db, DistributionCenter, Load, LoadData, LaneStat
+from distance import normalize_city, normalize_state
+from totals import flag_sum, value_sum, apply_deltas, rebuild_totals
+
+# Running sums of one lane, or the change to them.
+LaneTotals = namedtuple('LaneTotals', ['loads', 'ontime', 'cost', 'cost_squares', 'miles'])
+# The columns of a lane's key, as lane_of returns them.
+LANE_KEY = ('d_c_id', 'pickup_state', 'pickup_city')
+
+# The figures shown for a lane.
+LaneSummary = namedtuple('LaneSummary', ['pickup_city', 'pickup_state', 'd_c_id', 'dc', 'loads', 'avg_cost', 'cost_stddev', 'cost_per_mile', 'ontime'])
+
+# Most lanes listed at once by a search.
+SEARCH_LIMIT = 100
+
+
+def lane_of(city, state, d_c_id):
+    '''Returns the (d_c_id, state, city) key of a lane.'''
+    return (d_c_id, normalize_state(state), normalize_city(city))
+
+
+def lane_counters(data, miles):
+    '''Returns what a single delivered load adds to its lane.'''
+    cost = data.cost or 0
+    return LaneTotals(loads=1, ontime=1 if data.ontime == 1 else 0, cost=cost, cost_squares=cost * cost, miles=miles or 0)
+
+
+def apply_lane_deltas(user_id, deltas):
+    '''Adds (lane, LaneTotals) deltas to the lane table inside the current transaction, one upsert for all lanes.'''
+    apply_deltas(LaneStat, LANE_KEY, user_id, deltas)
+
+
+def summarize_lane(stat, dc=None):
+    '''Turns a lane's running sums into averages.'''
+    loads = stat.loads
+    # Worked out on whole numbers first, so big sums don't lose precision.
+    variance = (loads * stat.cost_squares - stat.cost * stat.cost) / (loads * (loads - 1)) if loads > 1 else 0
+    return LaneSummary(
+        pickup_city=stat.pickup_city.title(),
+        pickup_state=stat.pickup_state,
+        d_c_id=stat.d_c_id,
+        dc=dc,
+        loads=loads,
+        avg_cost=round(stat.cost / loads, 2) if loads else 0,
+        cost_stddev=round(sqrt(max(variance, 0)), 2),
+        cost_per_mile=round(stat.cost / stat.miles, 2) if stat.miles else 0,
+        ontime=round(stat.ontime / loads * 100, 2) if loads else 0,
+    )
+
+
+def get_lane(user_id, city, state, d_c_id):
+    '''Returns the summary of one lane, or None if no load on it has been delivered.'''
+    stat = LaneStat.query.get(lane_of(city, state, d_c_id))
+    if stat is None or stat.user_id != user_id or not stat.loads:
+        return None
+    return summarize_lane(stat)
+
+
+def search_lanes(user_id, city=None, state=None, d_c_id=None, limit=SEARCH_LIMIT):
+    '''Returns a user's busiest lanes matching a pickup city, state and/or DC.'''
+    query = (db.session.query(LaneStat, DistributionCenter.name)
+             .join(DistributionCenter, DistributionCenter.id == LaneStat.d_c_id)
+             .for_user(user_id).filter(LaneStat.loads > 0))
+    if state:
+        query = query.filter(LaneStat.pickup_state == normalize_state(state))
+    if city:
+        query = query.filter(LaneStat.pickup_city == normalize_city(city))
+    if d_c_id:
+        query = query.filter(LaneStat.d_c_id == d_c_id)
+    return [summarize_lane(stat, dc=name) for stat, name in query.order_by(LaneStat.loads.desc()).limit(limit)]
+
+#
+# REBUILDS
+#
+
+def _normalized_city():
+    '''SQL version of normalize_city.'''
+    return func.lower(func.regexp_replace(func.btrim(Load.pickup_city), r'\s+', ' ', 'g'))
+
+
+def rebuild_lanes(user_id=None):
+    '''Recomputes lane stats from the delivered loads, for one user or everyone. Returns the number of lanes.'''
+    city = _normalized_city()
+    state = func.upper(func.btrim(Load.pickup_state))
+    cost = cast(func.coalesce(LoadData.cost, 0), BigInteger)
+    query = (db.session.query(Load.d_c_id, state, city, Load.user_id,
+                              func.count(LoadData.id), flag_sum(LoadData.ontime), value_sum(cost), value_sum(cost * cost),
+                              value_sum(func.coalesce(Load.miles, 0)))
+             .join(LoadData, LoadData.load_id == Load.id)
+             .filter(LoadData.delivered == 1)
+             .group_by(Load.d_c_id, state, city, Load.user_id))
+    if user_id is not None:
+        query = query.filter(Load.user_id == user_id)
+    return rebuild_totals(LaneStat, [*LANE_KEY, 'user_id', *LaneTotals._fields], query, user_id)
@@ -0,0 +1,222 @@
+'''Set based load lifecycle changes: deliveries, location updates and load data updates for many loads at once.
+
+None of these commit; the caller owns the transaction.
+'''
+from types import SimpleNamespace
+from sqlalchemy import bindparam
+from sqlalchemy.orm import joinedload
+from models import db, DistributionCenter, Load, LoadData
+from forms import states
+from distance import get_provider, miles_or_none
+from mileage import enqueue_mileage
+from kpi import KPITotals, load_data_counters, apply_rollup_delta
+from forecast import observe_deliveries
+from alerts import clear_alerts
+from events import record_event
+from lanes import lane_of, lane_counters, apply_lane_deltas
+from scorecard import carrier_counters, apply_carrier_deltas
+from totals import subtract_totals
+
+# Load data fields that can be set, and the column each is stored in.
+LOAD_DATA_FIELDS = {'ontime': 'ontime', 'damages': 'damges', 'breakdown': 'breakdown', 'cost': 'cost', 'pallets': 'pallets', 'weight': 'weight'}
+FLAG_FIELDS = ('ontime', 'damages', 'breakdown')
+
+
+def _sum_counters(counters):
+    '''Adds up a list of KPI counters.'''
+    return KPITotals(*[sum(values) for values in zip(*counters)]) if counters else None
+
+
+def deliver_loads(user_id, load_ids):
+    '''Marks a user's loads as delivered with one UPDATE per table.
+
+    Returns {load id: 'delivered' | 'already_delivered' | 'not_found'}.
+    The load data UPDATE only touches rows that weren't delivered yet and returns them, so each
+    load is added to the KPI rollup once, in a single delta, even if two requests race.
+    '''
+    load_ids = set(load_ids)
+    results = {id: 'not_found' for id in load_ids}
+    if not load_ids:
+        return results
+    loads = Load.__table__
+    data = LoadData.__table__
+    delivered = db.session.execute(
+        loads.update()
+        .where(loads.c.user_id == user_id).where(loads.c.id.in_(load_ids)).where(loads.c.delivered != 1)
+        .values(delivered=1).returning(loads.c.id)).fetchall()
+    # Also returns each load's lane and forecast features, read from loads in the same statement.
+    counted = db.session.execute(
+        data.update()
+        .where(data.c.user_id == user_id).where(data.c.load_id.in_(load_ids)).where(data.c.delivered != 1)
+        .where(loads.c.id == data.c.load_id)
+        .values(delivered=1).returning(data.c.load_id, data.c.ontime, data.c.damges, data.c.breakdown, data.c.cost, data.c.pallets, data.c.weight,
+                                       loads.c.pickup_city, loads.c.pickup_state, loads.c.d_c_id, loads.c.miles,
+                                       loads.c.carrier_id, loads.c.team, loads.c.temp, loads.c.due_date)).fetchall()
+    for id in {row.id for row in delivered} | {row.load_id for row in counted}:
+        results[id] = 'delivered'
+    delivered_ids = [id for id, status in results.items() if status == 'delivered']
+    clear_alerts(delivered_ids)
+    for id in delivered_ids:
+        record_event(id, user_id, 'delivered')
+    leftover = [id for id, status in results.items() if status == 'not_found']
+    if leftover:
+        for (id,) in db.session.query(Load.id).filter(Load.user_id == user_id, Load.id.in_(leftover)):
+            results[id] = 'already_delivered'
+    if counted:
+        delta = _sum_counters([load_data_counters(row) for row in counted])
+        apply_rollup_delta(user_id=user_id, delta=delta)
+        observe_deliveries(user_id, counted, delta)
+        apply_lane_deltas(user_id, [(lane_of(row.pickup_city, row.pickup_state, row.d_c_id), lane_counters(row, row.miles)) for row in counted])
+        apply_carrier_deltas(user_id, [((row.carrier_id, row.d_c_id), carrier_counters(row, row.miles)) for row in counted])
+    return results
+
+
+def update_locations(user_id, updates):
+    '''Moves many loads to new pickup locations and recalculates their miles.
+
+    updates is a list of {'id', 'city', 'state'} dicts. With the offline provider, miles are worked
+    out per DC in one batch and written with the locations in a single executemany UPDATE. With a
+    remote provider the locations are written straight away and the miles are queued for a
+    background worker.
+    Returns {load id: 'updated' | 'pending' | 'not_found' | error message}.
+    '''
+    results = {}
+    valid = {}
+    for update in updates:
+        id = update.get('id')
+        city = str(update.get('city') or '').strip()
+        state = str(update.get('state') or '').strip().upper()
+        if not city:
+            results[id] = 'city is required.'
+        elif state not in states:
+            results[id] = f'Not a valid state: {state}'
+        else:
+            valid[id] = (city, state)
+            results[id] = 'not_found'
+    if not valid:
+        return results
+    # Each load comes back with its DC in the same query, the offline provider needs the DC's location.
+    loads = db.session.query(Load.id, DistributionCenter).join(Load.dc).filter(Load.user_id == user_id, Load.id.in_(valid.keys())).all()
+    provider = get_provider()
+    table = Load.__table__
+    if provider.remote:
+        params = [{'b_id': id, 'b_city': valid[id][0], 'b_state': valid[id][1]} for id, dc in loads]
+        if params:
+            stmt = table.update().where(table.c.id == bindparam('b_id')).values(pickup_city=bindparam('b_city'), pickup_state=bindparam('b_state'))
+            db.session.execute(stmt, params)
+            enqueue_mileage([id for id, dc in loads])
+        for id, dc in loads:
+            results[id] = 'pending'
+            record_event(id, user_id, 'location', pickup_city=valid[id][0], pickup_state=valid[id][1])
+        return results
+    by_dc = {}
+    for id, dc in loads:
+        by_dc.setdefault(dc, []).append(id)
+    params = []
+    for dc, ids in by_dc.items():
+        places = [valid[id] for id in ids]
+        miles = miles_or_none(provider, places, dc)
+        for id, (city, state), value in zip(ids, places, miles):
+            if value is None:
+                results[id] = f'Could not find {city}, {state}.'
+                continue
+            params.append({'b_id': id, 'b_city': city, 'b_state': state, 'b_miles': int(round(value))})
+            results[id] = 'updated'
+            record_event(id, user_id, 'location', pickup_city=city, pickup_state=state, miles=int(round(value)))
+    if params:
+        stmt = (table.update().where(table.c.id == bindparam('b_id'))
+                .values(pickup_city=bindparam('b_city'), pickup_state=bindparam('b_state'), miles=bindparam('b_miles')))
+        db.session.execute(stmt, params)
+    return results
+
+
+def _load_data_values(record):
+    '''Validates the load data fields of a record, returning {column: value}.'''
+    values = {}
+    for field, column in LOAD_DATA_FIELDS.items():
+        if field not in record:
+            continue
+        value = record[field]
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, int):
+            raise ValueError(f'{field} must be a whole number.')
+        if field in FLAG_FIELDS and value not in (0, 1):
+            raise ValueError(f'{field} must be 0 or 1.')
+        if field not in FLAG_FIELDS and value < 0:
+            raise ValueError(f'{field} can not be negative.')
+        values[column] = value
+    if not values:
+        raise ValueError('No load data fields given.')
+    return values
+
+
+def upsert_load_data(user_id, records):
+    '''Sets the load data of many loads, creating rows that don't exist yet.
+
+    records is a list of dicts with a load_id and any of ontime, damages, breakdown, cost, pallets and weight.
+    Existing rows are changed with one executemany UPDATE, new ones with one multi-row INSERT, and the
+    KPI rollup gets a single delta for loads that are already delivered.
+    Returns {load id: 'updated' | 'created' | 'not_found' | error message}.
+    '''
+    results = {}
+    changes = {}
+    for record in records:
+        load_id = record.get('load_id')
+        try:
+            changes[load_id] = _load_data_values(record)
+            results[load_id] = 'not_found'
+        except ValueError as ex:
+            results[load_id] = str(ex)
+    if not changes:
+        return results
+    # Existing rows are locked so concurrent updates can't both apply a rollup delta from the same starting values.
+    # Each row comes with its load, for the lane; only the load data rows are locked.
+    existing = {data.load_id: data for data in LoadData.query.options(joinedload(LoadData.load))
+                .filter(LoadData.user_id == user_id, LoadData.load_id.in_(changes.keys())).with_for_update(of=LoadData)}
+    updates = []
+    inserts = []
+    deltas = []
+    lane_deltas = []
+    carrier_deltas = []
+    missing = [load_id for load_id in changes if load_id not in existing]
+    if missing:
+        for load in Load.query.filter(Load.user_id == user_id, Load.id.in_(missing)):
+            row = dict(load_id=load.id, user_id=user_id, ontime=0, damges=0, breakdown=0, cost=0, pallets=0, weight=0, delivered=load.delivered or 0)
+            row.update(changes[load.id])
+            inserts.append(row)
+            results[load.id] = 'created'
+            if row['delivered'] == 1:
+                deltas.append(load_data_counters(SimpleNamespace(**row)))
+                lane_deltas.append((lane_of(load.pickup_city, load.pickup_state, load.d_c_id), lane_counters(SimpleNamespace(**row), load.miles)))
+                carrier_deltas.append(((load.carrier_id, load.d_c_id), carrier_counters(SimpleNamespace(**row), load.miles)))
+    for load_id, data in existing.items():
+        values = changes[load_id]
+        before = load_data_counters(data)
+        row = {column: getattr(data, column) for column in set(LOAD_DATA_FIELDS.values())}
+        row.update(values)
+        updates.append(dict({f'b_{column}': value for column, value in row.items()}, b_id=data.id))
+        results[load_id] = 'updated'
+        if data.delivered == 1:
+            deltas.append(subtract_totals(load_data_counters(SimpleNamespace(**row)), before))
+            load = data.load
+            lane_deltas.append((lane_of(load.pickup_city, load.pickup_state, load.d_c_id),
+                                subtract_totals(lane_counters(SimpleNamespace(**row), load.miles), lane_counters(data, load.miles))))
+            carrier_deltas.append(((load.carrier_id, load.d_c_id),
+                                   subtract_totals(carrier_counters(SimpleNamespace(**row), load.miles), carrier_counters(data, load.miles))))
+    fields = {column: field for field, column in LOAD_DATA_FIELDS.items()}
+    for load_id, status in results.items():
+        if status in ('updated', 'created'):
+            record_event(load_id, user_id, 'data', detail={fields[column]: value for column, value in changes[load_id].items()})
+    table = LoadData.__table__
+    if updates:
+        columns = set(LOAD_DATA_FIELDS.values())
+        stmt = table.update().where(table.c.id == bindparam('b_id')).values({column: bindparam(f'b_{column}') for column in columns})
+        db.session.execute(stmt, updates)
+    if inserts:
+        db.session.execute(table.insert().values(inserts))
+    if deltas:
+        apply_rollup_delta(user_id=user_id, delta=_sum_counters(deltas))
+    apply_lane_deltas(user_id, lane_deltas)
+    apply_carrier_deltas(user_id, carrier_deltas)
+    return results
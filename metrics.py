@@ -0,0 +1,244 @@
+'''Per route instrumentation: SQL query counts and time, slowest statement, MapQuest time and template render time.
+
+Turned on with METRICS_ENABLED. When it's off nothing is hooked up, so the only cost is a flag check
+around outbound calls. Totals are kept per process, so with several gunicorn workers each worker
+reports its own numbers; Prometheus adds them up across scrapes.
+
+Exposed as Prometheus text at /metrics and, with METRICS_HEADER, as a Server-Timing header on every response.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from flask import Response, before_render_template, g, has_request_context, request, signals_available, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import time
+
+# Longest statement text kept for the slowest query of an endpoint.
+STATEMENT_LENGTH = 200
+
+_enabled = False
+_header = False
+
+
+class EndpointStats:
+    '''Running totals for one endpoint.'''
+
+    __slots__ = ('requests', 'seconds', 'queries', 'db_seconds', 'slowest', 'slowest_statement',
+                 'external_calls', 'external_seconds', 'template_seconds')
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = ''
+        self.external_calls = 0
+        self.external_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class RequestStats:
+    '''What one request has done so far. Lives in g.'''
+
+    __slots__ = ('started', 'queries', 'db_seconds', 'slowest', 'slowest_statement',
+                 'external_calls', 'external_seconds', 'template_seconds', 'template_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = ''
+        self.external_calls = 0
+        self.external_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_started = []
+
+
+class Registry:
+    '''Thread safe per endpoint totals.'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._endpoints = defaultdict(EndpointStats)
+
+    def add(self, endpoint, stats, seconds):
+        with self._lock:
+            total = self._endpoints[endpoint]
+            total.requests += 1
+            total.seconds += seconds
+            total.queries += stats.queries
+            total.db_seconds += stats.db_seconds
+            total.external_calls += stats.external_calls
+            total.external_seconds += stats.external_seconds
+            total.template_seconds += stats.template_seconds
+            if stats.slowest > total.slowest:
+                total.slowest = stats.slowest
+                total.slowest_statement = stats.slowest_statement
+
+    def snapshot(self):
+        '''Returns {endpoint: dict of totals}.'''
+        with self._lock:
+            return {endpoint: {name: getattr(stats, name) for name in EndpointStats.__slots__}
+                    for endpoint, stats in self._endpoints.items()}
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+registry = Registry()
+
+
+def _current():
+    '''Returns the stats of the request being handled, or None outside of an instrumented request.'''
+    if not has_request_context():
+        return None
+    return g.get('_metrics')
+
+
+#
+# HOOKS
+#
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('_metrics_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats = _current()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if elapsed > stats.slowest:
+        stats.slowest = elapsed
+        stats.slowest_statement = statement
+
+
+def _handle_error(context):
+    started = context.connection.info.get('_metrics_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _current()
+    if stats is not None:
+        stats.template_started.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _current()
+    if stats is not None and stats.template_started:
+        stats.template_seconds += time.perf_counter() - stats.template_started.pop()
+
+
+def _start_request():
+    g._metrics = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop('_metrics', None)
+    if stats is None:
+        return response
+    seconds = time.perf_counter() - stats.started
+    registry.add(request.endpoint or 'not_found', stats, seconds)
+    if _header:
+        response.headers['Server-Timing'] = server_timing(stats, seconds)
+    return response
+
+
+@contextmanager
+def external_call():
+    '''Times an outbound API call (MapQuest) against the current request.'''
+    stats = _current() if _enabled else None
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.external_calls += 1
+        stats.external_seconds += time.perf_counter() - started
+
+
+def server_timing(stats, seconds):
+    '''Formats a request's numbers as a Server-Timing header.'''
+    return (f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.queries} queries", '
+            f'db-slowest;dur={stats.slowest * 1000:.2f}, '
+            f'mapquest;dur={stats.external_seconds * 1000:.2f};desc="{stats.external_calls} calls", '
+            f'render;dur={stats.template_seconds * 1000:.2f}, '
+            f'total;dur={seconds * 1000:.2f}')
+
+#
+# PROMETHEUS
+#
+
+METRICS = [
+    ('requests', 'counter', 'freight_requests_total', 'Requests handled.'),
+    ('seconds', 'counter', 'freight_request_seconds_total', 'Time spent handling requests.'),
+    ('queries', 'counter', 'freight_db_queries_total', 'SQL statements executed.'),
+    ('db_seconds', 'counter', 'freight_db_seconds_total', 'Time spent executing SQL statements.'),
+    ('external_calls', 'counter', 'freight_mapquest_calls_total', 'MapQuest API calls.'),
+    ('external_seconds', 'counter', 'freight_mapquest_seconds_total', 'Time spent waiting on MapQuest.'),
+    ('template_seconds', 'counter', 'freight_template_seconds_total', 'Time spent rendering templates.'),
+]
+
+
+def _label(value):
+    '''Escapes a Prometheus label value.'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(snapshot=None):
+    '''Renders the per endpoint totals in the Prometheus text format.'''
+    snapshot = registry.snapshot() if snapshot is None else snapshot
+    lines = []
+    for field, kind, name, help in METRICS:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for endpoint, totals in sorted(snapshot.items()):
+            lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {totals[field]}')
+    lines.append('# HELP freight_db_slowest_seconds Slowest SQL statement seen per endpoint.')
+    lines.append('# TYPE freight_db_slowest_seconds gauge')
+    for endpoint, totals in sorted(snapshot.items()):
+        statement = ' '.join(totals['slowest_statement'].split())[:STATEMENT_LENGTH]
+        lines.append(f'freight_db_slowest_seconds{{endpoint="{_label(endpoint)}",statement="{_label(statement)}"}} {totals["slowest"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    '''Serves the Prometheus text.'''
+    return Response(prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+#
+# SETUP
+#
+
+
+def init_metrics(app):
+    '''Hooks up instrumentation when METRICS_ENABLED is set. Does nothing otherwise.'''
+    global _enabled, _header
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    _header = bool(app.config.get('METRICS_HEADER'))
+    if not _enabled:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        # Template signals need blinker, without it render time just isn't recorded.
+        if signals_available:
+            before_render_template.connect(_before_render)
+            template_rendered.connect(_rendered)
+        _enabled = True
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
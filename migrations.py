@@ -0,0 +1,342 @@
+'''Schema migrations for databases created before a model changed.
+
+New databases get the current schema from db.create_all() and are stamped as fully migrated.
+Existing ones are brought up to date with flask db-migrate, which runs every migration not yet
+recorded in schema_migrations, in order.
+
+Column type changes run online, without holding a lock on the table for more than a moment:
+
+ 1. A new column is added next to the old one, with a trigger that fills it in on every write.
+ 2. Existing rows are converted in batches of ids, each batch its own transaction.
+ 3. Indexes on the old column are built again on the new one, CONCURRENTLY.
+ 4. In one short transaction the old column is dropped and the new one renamed in its place.
+
+A migration that is interrupted can simply be run again.
+'''
+from collections import namedtuple
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from models import db, SchemaMigration, KPIRollup, DistanceCache, MileageJob, LaneStat, LoadAlert, LoadEvent, CarrierScore
+from events import ensure_partitions
+from kpi import rebuild_rollups
+from lanes import rebuild_lanes
+from scorecard import rebuild_carrier_scores
+import re
+import time
+
+DEFAULT_BATCH_SIZE = 5000
+# The swap waits this long for its lock, so it never queues up requests behind a slow query.
+LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 10
+
+# A column's new type, the SQL that converts an old value ({0} is the old column), and whether it is NOT NULL and its default.
+ColumnChange = namedtuple('ColumnChange', ['type', 'using', 'not_null', 'default'])
+
+Migration = namedtuple('Migration', ['version', 'name', 'run'])
+
+DATE_FROM_TEXT = (r"CASE WHEN {0} ~ '^\d{{4}}-\d{{1,2}}-\d{{1,2}}$' THEN CAST({0} AS date) "
+                  r"WHEN {0} ~ '^\d{{1,2}}/\d{{1,2}}/\d{{4}}$' THEN to_date({0}, 'MM/DD/YYYY') END")
+SMALLINT = 'CAST({0} AS smallint)'
+
+
+def _autocommit():
+    '''A connection where every statement commits on its own, as batches and CONCURRENTLY need.'''
+    return db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def _column_type(connection, table, column):
+    '''Returns a column's type, or None if the table has no such column.'''
+    return connection.execute(text('SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = :column'),
+                              table=table, column=column).scalar()
+
+
+def create_index_concurrently(connection, name, sql):
+    '''Builds an index without blocking writes. sql is the CREATE INDEX statement without CONCURRENTLY.
+
+    A failed concurrent build leaves an invalid index behind, which is dropped and built again.
+    '''
+    valid = connection.execute(text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), name=name).scalar()
+    if valid:
+        return
+    if valid is not None:
+        connection.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    connection.execute(re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX CONCURRENTLY ', sql))
+
+
+def _rename_columns(sql, names):
+    '''Points an index definition at the new columns.'''
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(column) for column in names) + r')\b')
+    head, on, tail = sql.partition(' ON ')
+    return head + on + pattern.sub(lambda match: names[match.group(1)], tail)
+
+
+def _swap(table, changes, new, indexes):
+    '''Drops the old columns and renames the new ones into place, in one short transaction.'''
+    for attempt in range(SWAP_ATTEMPTS):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                connection.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+                connection.execute(f'DROP TRIGGER IF EXISTS {table}_migrate_sync ON {table}')
+                connection.execute(f'DROP FUNCTION IF EXISTS {table}_migrate_sync()')
+                for column, change in changes.items():
+                    # Also drops the old column's indexes, the new ones are already built.
+                    connection.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+                    connection.execute(f'ALTER TABLE {table} RENAME COLUMN {new[column]} TO {column}')
+                    if change.default is not None:
+                        connection.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {change.default}')
+                    if change.not_null:
+                        # Instant, PostgreSQL takes the validated check constraint as proof.
+                        connection.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL')
+                        connection.execute(f'ALTER TABLE {table} DROP CONSTRAINT {new[column]}_not_null')
+                for name in indexes:
+                    connection.execute(f'ALTER INDEX {name}_new RENAME TO {name}')
+            return
+        except OperationalError:
+            if attempt == SWAP_ATTEMPTS - 1:
+                raise
+            time.sleep(1)
+
+
+def change_columns(table, changes, batch_size=DEFAULT_BATCH_SIZE, echo=print):
+    '''Changes the type of some of a table's columns online. changes maps column names to ColumnChange.
+
+    Raises LookupError if one of the columns doesn't exist, the migration that adds it hasn't run.
+    '''
+    connection = _autocommit()
+    try:
+        types = {column: _column_type(connection, table, column) for column in changes}
+        missing = [column for column, type in types.items() if type is None]
+        if missing:
+            raise LookupError(f'{table} has no column {", ".join(missing)}')
+        changes = {column: change for column, change in changes.items()
+                   if types[column] != change.type or _column_type(connection, table, f'{column}_new') is not None}
+        if not changes:
+            return
+        new = {column: f'{column}_new' for column in changes}
+
+        # 1. New columns, kept in step with the old ones by a trigger from the same transaction on.
+        with db.engine.begin() as begun:
+            for column, change in changes.items():
+                begun.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new[column]} {change.type}')
+            sync = '; '.join(f'NEW.{new[column]} := {change.using.format(f"NEW.{column}")}' for column, change in changes.items())
+            begun.execute(f'CREATE OR REPLACE FUNCTION {table}_migrate_sync() RETURNS trigger AS $$ BEGIN {sync}; RETURN NEW; END $$ LANGUAGE plpgsql')
+            begun.execute(f'DROP TRIGGER IF EXISTS {table}_migrate_sync ON {table}')
+            begun.execute(f'CREATE TRIGGER {table}_migrate_sync BEFORE INSERT OR UPDATE ON {table} FOR EACH ROW EXECUTE PROCEDURE {table}_migrate_sync()')
+
+        # 2. Existing rows, a batch of ids at a time.
+        low, high = connection.execute(f'SELECT min(id), max(id) FROM {table}').first()
+        if low is not None:
+            assignments = ', '.join(f'{new[column]} = {change.using.format(column)}' for column, change in changes.items())
+            update = text(f'UPDATE {table} SET {assignments} WHERE id >= :start AND id < :stop')
+            for start in range(low, high + 1, batch_size):
+                connection.execute(update, start=start, stop=start + batch_size)
+                echo(f'{table}: converted ids up to {min(start + batch_size - 1, high)} of {high}')
+
+        # 3. NOT NULL checks and indexes on the new columns, neither of which blocks writes.
+        for column, change in changes.items():
+            if change.not_null:
+                constraint = f'{new[column]}_not_null'
+                if not connection.execute(text('SELECT 1 FROM pg_constraint WHERE conname = :name'), name=constraint).scalar():
+                    connection.execute(f'ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({new[column]} IS NOT NULL) NOT VALID')
+                connection.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}')
+        pattern = re.compile(r'\b(' + '|'.join(changes) + r')\b')
+        indexes = []
+        for name, sql in connection.execute(text('SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table'), table=table).fetchall():
+            if name.endswith('_new') or not pattern.search(sql.partition(' ON ')[2]):
+                continue
+            echo(f'{table}: building {name} on the new columns')
+            create_index_concurrently(connection, f'{name}_new', _rename_columns(sql.replace(f'INDEX {name} ON', f'INDEX {name}_new ON', 1), new))
+            indexes.append(name)
+
+        # 4. The swap.
+        _swap(table, changes, new, indexes)
+        echo(f'{table}: switched {", ".join(changes)} over')
+        # The batches left a dead copy of every row behind.
+        connection.execute(f'VACUUM ANALYZE {table}')
+    finally:
+        connection.close()
+
+#
+# MIGRATIONS
+#
+
+def _kpi_rollups(batch_size, echo):
+    '''Adds the kpi_rollups table and fills it from the delivered loads.'''
+    KPIRollup.__table__.create(bind=db.engine, checkfirst=True)
+    echo(f'Rolled up the KPI\'s of {rebuild_rollups()} users')
+
+
+def _kpi_indexes(batch_size, echo):
+    '''Indexes loads and load data for the KPI's and their per carrier / DC breakdowns.'''
+    connection = _autocommit()
+    try:
+        create_index_concurrently(connection, 'ix_loads_user_carrier_dc_due', 'CREATE INDEX ix_loads_user_carrier_dc_due ON loads (user_id, carrier_id, d_c_id, due_date)')
+        create_index_concurrently(connection, 'ix_load_data_user_delivered', 'CREATE INDEX ix_load_data_user_delivered ON load_data (user_id, delivered, load_id)')
+    finally:
+        connection.close()
+
+
+def _distance_cache(batch_size, echo):
+    '''Adds the distance_cache table.'''
+    DistanceCache.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _open_board_index(batch_size, echo):
+    '''Indexes the open loads in the order the board pages through them.'''
+    connection = _autocommit()
+    try:
+        create_index_concurrently(connection, 'ix_loads_open_board', 'CREATE INDEX ix_loads_open_board ON loads (user_id, due_date, miles, id) WHERE delivered = 0')
+    finally:
+        connection.close()
+
+
+def _mileage_jobs(batch_size, echo):
+    '''Adds loads.miles_pending and the mileage_jobs table.'''
+    with db.engine.begin() as connection:
+        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        # A constant default doesn't rewrite the table.
+        connection.execute('ALTER TABLE loads ADD COLUMN IF NOT EXISTS miles_pending smallint NOT NULL DEFAULT 0')
+    MileageJob.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _ref_version(batch_size, echo):
+    '''Adds users.ref_version, which the carrier and DC choice caches are keyed on.'''
+    with db.engine.begin() as connection:
+        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        connection.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS ref_version integer NOT NULL DEFAULT 0')
+
+
+def _lane_stats(batch_size, echo):
+    '''Adds the lane_stats table and fills it from the delivered loads.'''
+    LaneStat.__table__.create(bind=db.engine, checkfirst=True)
+    echo(f'Found {rebuild_lanes()} lanes')
+
+def _typed_loads(batch_size, echo):
+    '''Stores the due date as a DATE and the yes/no columns of loads as SMALLINT.'''
+    change_columns('loads', {
+        'due_date': ColumnChange('date', DATE_FROM_TEXT, False, None),
+        'team': ColumnChange('smallint', SMALLINT, True, None),
+        'delivered': ColumnChange('smallint', SMALLINT, False, None),
+        'miles_pending': ColumnChange('smallint', SMALLINT, True, '0'),
+    }, batch_size=batch_size, echo=echo)
+
+
+def _typed_load_data(batch_size, echo):
+    '''Stores the yes/no columns of load_data as SMALLINT.'''
+    change_columns('load_data', {column: ColumnChange('smallint', SMALLINT, False, None)
+                                 for column in ('ontime', 'damges', 'breakdown', 'delivered')}, batch_size=batch_size, echo=echo)
+
+
+def _due_date_brin(batch_size, echo):
+    '''Adds a BRIN index on due dates, loads are mostly added in due date order.'''
+    connection = _autocommit()
+    try:
+        create_index_concurrently(connection, 'ix_loads_due_brin', 'CREATE INDEX ix_loads_due_brin ON loads USING brin (due_date)')
+    finally:
+        connection.close()
+
+
+def _drop_day_of_week(batch_size, echo):
+    '''Drops loads.day_of_week, which is now worked out from the due date.'''
+    with db.engine.begin() as connection:
+        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        connection.execute('ALTER TABLE loads DROP COLUMN IF EXISTS day_of_week')
+
+
+def _load_alerts(batch_size, echo):
+    '''Adds the load_alerts table.'''
+    LoadAlert.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _load_events(batch_size, echo):
+    '''Adds the partitioned load_events table and its first monthly partitions.'''
+    LoadEvent.__table__.create(bind=db.engine, checkfirst=True)
+    ensure_partitions()
+
+
+def _carrier_scores(batch_size, echo):
+    '''Adds the carrier_scores table and fills it from the delivered loads.'''
+    CarrierScore.__table__.create(bind=db.engine, checkfirst=True)
+    echo(f'Scored {rebuild_carrier_scores()} carriers by D.C.')
+
+
+def _tenant_indexes(batch_size, echo):
+    '''Indexes carriers, DC's and loads on their user, for the per user reads.'''
+    connection = _autocommit()
+    try:
+        create_index_concurrently(connection, 'ix_carriers_user', 'CREATE INDEX ix_carriers_user ON carriers (user_id, id, name)')
+        create_index_concurrently(connection, 'ix_distribution_centers_user', 'CREATE INDEX ix_distribution_centers_user ON distribution_centers (user_id, id, name)')
+        create_index_concurrently(connection, 'ix_loads_user_id', 'CREATE INDEX ix_loads_user_id ON loads (user_id, id)')
+    finally:
+        connection.close()
+
+
+def _place_coordinates(batch_size, echo):
+    '''Adds latitude and longitude to DC's and carriers. flask geocode-places fills them in.'''
+    with db.engine.begin() as connection:
+        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        for table in ('distribution_centers', 'carriers'):
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS latitude double precision, ADD COLUMN IF NOT EXISTS longitude double precision')
+
+
+def _approximate_places(batch_size, echo):
+    '''Adds approximate to DC's and carriers, set when only their state could be found.'''
+    with db.engine.begin() as connection:
+        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        for table in ('distribution_centers', 'carriers'):
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS approximate smallint NOT NULL DEFAULT 0')
+
+
+MIGRATIONS = [
+    Migration(1, 'kpi_rollups', _kpi_rollups),
+    Migration(2, 'kpi_indexes', _kpi_indexes),
+    Migration(3, 'distance_cache', _distance_cache),
+    Migration(4, 'open_board_index', _open_board_index),
+    Migration(5, 'mileage_jobs', _mileage_jobs),
+    Migration(6, 'ref_version', _ref_version),
+    Migration(7, 'lane_stats', _lane_stats),
+    Migration(8, 'typed_loads', _typed_loads),
+    Migration(9, 'typed_load_data', _typed_load_data),
+    Migration(10, 'due_date_brin', _due_date_brin),
+    Migration(11, 'load_alerts', _load_alerts),
+    Migration(12, 'load_events', _load_events),
+    Migration(13, 'carrier_scores', _carrier_scores),
+    Migration(14, 'tenant_indexes', _tenant_indexes),
+    Migration(15, 'place_coordinates', _place_coordinates),
+    Migration(16, 'approximate_places', _approximate_places),
+    # Always last, and only once no running code writes day_of_week any more. Everything before it is
+    # additive, so it can all run before the new code is deployed.
+    Migration(17, 'drop_day_of_week', _drop_day_of_week),
+]
+
+
+def applied_versions():
+    '''Returns the versions recorded in schema_migrations, creating the table if it isn't there yet.'''
+    SchemaMigration.__table__.create(bind=db.engine, checkfirst=True)
+    return {version for (version,) in db.session.query(SchemaMigration.version)}
+
+
+def pending_migrations(to=None):
+    '''Returns the migrations not applied yet, up to version to.'''
+    applied = applied_versions()
+    return [migration for migration in MIGRATIONS if migration.version not in applied and (to is None or migration.version <= to)]
+
+
+def migrate(to=None, batch_size=DEFAULT_BATCH_SIZE, echo=print):
+    '''Runs the pending migrations in order, recording each one as it finishes. Returns how many ran.'''
+    pending = pending_migrations(to)
+    db.session.commit()
+    for migration in pending:
+        echo(f'Migrating to {migration.version} ({migration.name})')
+        migration.run(batch_size, echo)
+        db.session.add(SchemaMigration(version=migration.version, name=migration.name))
+        db.session.commit()
+    return len(pending)
+
+
+def stamp():
+    '''Records every migration as applied, for a database just made by db.create_all().'''
+    for migration in pending_migrations():
+        db.session.add(SchemaMigration(version=migration.version, name=migration.name))
+    db.session.commit()
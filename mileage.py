@@ -0,0 +1,179 @@
+'''Background mileage recalculation.
+
+Location changes enqueue a row in mileage_jobs and commit straight away. Workers
+(flask mileage-worker) claim jobs with SKIP LOCKED, work out distances on a thread pool
+and write the miles back to the loads.
+'''
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from sqlalchemy import bindparam, literal, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from models import db, DistributionCenter, Load, MileageJob
+from events import record_event, flush_events
+from geocode import geocode_place
+from distance import DistanceUnavailable, get_provider, get_offline_provider, lookup_cached_miles, remember_miles
+import time
+
+DEFAULT_THREADS = 8
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_TIMEOUT = 10
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled on every attempt after that.
+RETRY_DELAY = 30
+# Jobs claimed this long ago by a worker that never finished them are claimed again.
+LEASE = timedelta(minutes=5)
+
+
+def _upsert_jobs(stmt):
+    '''Adds the conflict handling that resets an existing job for the same load.'''
+    return stmt.on_conflict_do_update(index_elements=['load_id'], set_={
+        'status': 'pending', 'attempts': 0, 'run_after': stmt.excluded.run_after, 'claimed_at': None, 'last_error': None})
+
+
+def enqueue_mileage(load_ids):
+    '''Queues loads for a miles recalculation and flags them as pending.'''
+    load_ids = list(load_ids)
+    if not load_ids:
+        return
+    now = datetime.utcnow()
+    db.session.execute(_upsert_jobs(insert(MileageJob.__table__).values(
+        [dict(load_id=id, status='pending', attempts=0, run_after=now) for id in load_ids])))
+    Load.query.filter(Load.id.in_(load_ids)).update({Load.miles_pending: 1}, synchronize_session=False)
+
+
+def enqueue_dc_reroute(d_c_id):
+    '''Queues every open load going to a DC, for when the DC's address changes. Returns the number of loads.'''
+    open_loads = select([Load.id, literal('pending'), literal(0), literal(datetime.utcnow())]).where(Load.d_c_id == d_c_id).where(Load.delivered == 0)
+    db.session.execute(_upsert_jobs(insert(MileageJob.__table__).from_select(['load_id', 'status', 'attempts', 'run_after'], open_loads)))
+    return Load.query.filter(Load.d_c_id == d_c_id, Load.delivered == 0).update({Load.miles_pending: 1}, synchronize_session=False)
+
+
+def dc_address_changed(dc):
+    '''Locates a DC again after its address was edited and queues its open loads for new miles.
+
+    Returns (a problem message or None, the number of loads queued). The caller commits.
+    '''
+    dc.latitude = dc.longitude = None
+    problem = geocode_place(dc)
+    db.session.flush()
+    return problem, enqueue_dc_reroute(dc.id)
+
+
+def claim_jobs(limit=DEFAULT_BATCH_SIZE):
+    '''Claims up to limit ready jobs and commits, so other workers skip them.
+
+    Returns the jobs with a snapshot of their load's location and DC, safe to hand to other threads.
+    '''
+    now = datetime.utcnow()
+    ready = (db.session.query(MileageJob.id)
+             .filter(or_(db.and_(MileageJob.status == 'pending', MileageJob.run_after <= now),
+                         db.and_(MileageJob.status == 'running', MileageJob.claimed_at < now - LEASE)))
+             .order_by(MileageJob.run_after).limit(limit).with_for_update(skip_locked=True))
+    ids = [id for (id,) in ready]
+    if not ids:
+        db.session.commit()
+        return []
+    MileageJob.query.filter(MileageJob.id.in_(ids)).update({MileageJob.status: 'running', MileageJob.claimed_at: now}, synchronize_session=False)
+    rows = (db.session.query(MileageJob.id, MileageJob.attempts, Load.id, Load.user_id, Load.pickup_city, Load.pickup_state,
+                             DistributionCenter.id, DistributionCenter.city, DistributionCenter.state, DistributionCenter.latitude, DistributionCenter.longitude)
+            .join(Load, Load.id == MileageJob.load_id)
+            .join(DistributionCenter, DistributionCenter.id == Load.d_c_id)
+            .filter(MileageJob.id.in_(ids)).all())
+    db.session.commit()
+    return [SimpleNamespace(id=job_id, attempts=attempts, load_id=load_id, user_id=user_id, city=city, state=state,
+                            dc=SimpleNamespace(id=dc_id, city=dc_city, state=dc_state, latitude=dc_latitude, longitude=dc_longitude))
+            for job_id, attempts, load_id, user_id, city, state, dc_id, dc_city, dc_state, dc_latitude, dc_longitude in rows]
+
+
+def _finish(done):
+    '''Writes miles back for jobs that are still ours. Jobs enqueued again while running are left for the next pass.'''
+    if not done:
+        return
+    jobs = MileageJob.__table__
+    finished = {row.id for row in db.session.execute(
+        jobs.delete().where(jobs.c.id.in_(list(done))).where(jobs.c.status == 'running').returning(jobs.c.id))}
+    params = [{'b_id': job.load_id, 'b_miles': int(round(miles))} for job_id, (job, miles) in done.items() if job_id in finished]
+    for job_id, (job, miles) in done.items():
+        if job_id in finished:
+            record_event(job.load_id, job.user_id, 'miles', pickup_city=job.city, pickup_state=job.state, miles=int(round(miles)))
+    if params:
+        loads = Load.__table__
+        db.session.execute(loads.update().where(loads.c.id == bindparam('b_id')).values(miles=bindparam('b_miles'), miles_pending=0), params)
+
+
+def _retry(failed):
+    '''Schedules failed jobs again with exponential backoff, giving up after MAX_ATTEMPTS.
+
+    Loads whose job gives up get the offline estimate so they aren't stuck as pending, or keep their
+    old miles if even that can't place them.
+    '''
+    now = datetime.utcnow()
+    gave_up = {}
+    for job, error in failed:
+        attempts = job.attempts + 1
+        values = {'attempts': attempts, 'last_error': error[:500]}
+        if attempts >= MAX_ATTEMPTS:
+            values['status'] = 'failed'
+        else:
+            values['status'] = 'pending'
+            values['run_after'] = now + timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+        updated = MileageJob.query.filter(MileageJob.id == job.id, MileageJob.status == 'running').update(values, synchronize_session=False)
+        if updated and values['status'] == 'failed':
+            try:
+                gave_up[job.id] = (job, get_offline_provider().miles(job.city, job.state, job.dc))
+            except LookupError:
+                gave_up[job.id] = (job, None)
+    estimated = [(job, miles) for job, miles in gave_up.values() if miles is not None]
+    unplaced = [job.load_id for job, miles in gave_up.values() if miles is None]
+    loads = Load.__table__
+    if estimated:
+        for job, miles in estimated:
+            record_event(job.load_id, job.user_id, 'miles', pickup_city=job.city, pickup_state=job.state, miles=int(round(miles)))
+        db.session.execute(loads.update().where(loads.c.id == bindparam('b_id')).values(miles=bindparam('b_miles'), miles_pending=0),
+                           [{'b_id': job.load_id, 'b_miles': int(round(miles))} for job, miles in estimated])
+    if unplaced:
+        db.session.execute(loads.update().where(loads.c.id.in_(unplaced)).values(miles_pending=0))
+
+
+def process_jobs(jobs, pool, timeout=DEFAULT_TIMEOUT):
+    '''Works out the miles of claimed jobs, calling the provider concurrently for lanes that aren't cached.'''
+    provider = get_provider()
+    done = {}
+    failed = []
+    pending = []
+    for job in jobs:
+        miles = lookup_cached_miles(job.city, job.state, job.dc) if provider.remote else None
+        if miles is not None:
+            done[job.id] = (job, miles)
+        else:
+            pending.append((job, pool.submit(provider.miles, job.city, job.state, job.dc)))
+    for job, future in pending:
+        try:
+            miles = future.result(timeout=timeout)
+        except (DistanceUnavailable, FutureTimeout, LookupError) as ex:
+            failed.append((job, str(ex) or ex.__class__.__name__))
+            continue
+        if provider.remote:
+            remember_miles(job.city, job.state, job.dc, miles)
+        done[job.id] = (job, miles)
+    _finish(done)
+    _retry(failed)
+    db.session.commit()
+    # The worker runs for hours inside one app context.
+    flush_events()
+    return len(done), len(failed)
+
+
+def run_worker(threads=DEFAULT_THREADS, batch_size=DEFAULT_BATCH_SIZE, poll=2.0, once=False, timeout=DEFAULT_TIMEOUT, log=print):
+    '''Processes mileage jobs until stopped. With once, stops as soon as the queue is empty.'''
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            jobs = claim_jobs(batch_size)
+            if jobs:
+                done, failed = process_jobs(jobs, pool, timeout=timeout)
+                log(f'Recalculated miles for {done} loads, {failed} failed.')
+            elif once:
+                return
+            else:
+                time.sleep(poll)
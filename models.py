@@ -1,13 +1,34 @@
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from datetime import datetime
+from flask_sqlalchemy import SQLAlchemy, BaseQuery
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.hybrid import hybrid_property
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()
+class TenantQuery(BaseQuery):
+    '''Query class of every model and of db.session.query, adding for_user.'''
+
+    def for_user(self, user_id):
+        '''Keeps only one user's rows, filtering on the user_id of the query's first entity.
+
+        Raises ValueError without a user id, so a missing id can never mean every user's rows.
+        '''
+        if user_id is None:
+            raise ValueError('A user id is needed to scope a query.')
+        return self.filter(self.column_descriptions[0]['entity'].user_id == user_id)
+
+db = SQLAlchemy(query_class=TenantQuery)
 
 def connect_db(app):
     db.app = app
     db.init_app(app)
 
+# Day names in English whatever the locale, as PostgreSQL's to_char spells them. Monday first, like date.weekday().
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def day_name(due_date):
+    '''SQL for the name of the day of a date, like Monday.'''
+    return db.func.to_char(due_date, 'FMDay')
+
 # 
 # USER MODEL
 #   
@@ -20,6 +41,8 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.Text, unique=True, nullable=False)
     password = db.Column(db.Text, nullable=False)
+    # Bumped whenever the user's carriers or DCs change, so cached select choices can be thrown away.
+    ref_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     @classmethod
     def singup(cls, username, password):
@@ -27,7 +50,9 @@ class User(db.Model):
         
         Uses Bcrypt to hash a password for security!
         '''
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        # Imported here so loading the models doesn't load password hashing.
+        from passwords import hash_password
+        hashed_pwd = hash_password(password)
         
         user = cls(username=username, password=hashed_pwd)
         
@@ -41,12 +66,22 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
-        '''Authenticates users.'''
+        '''Authenticates users.
+        
+        Passwords hashed with an old work factor are hashed again with the current one.
+        '''
+        from passwords import hash_password, check_password, needs_rehash
         user = cls.query.filter_by(username=username).first()
         
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
+                    try:
+                        db.session.commit()
+                    except Exception as ex:
+                        db.session.rollback()
                 return user
             
         return False
@@ -61,6 +96,10 @@ class DistributionCenter(db.Model):
     '''Creates a DC (load destination) table in SQLAlchemy & PostgreSQL.'''    
     
     __tablename__ = 'distribution_centers'
+    __table_args__ = (
+        # Backs listing a user's DC's, the id and name choices are read from the index alone.
+        db.Index('ix_distribution_centers_user', 'user_id', 'id', 'name'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  
     name = db.Column(db.Text, unique=True, nullable=False)
@@ -70,12 +109,20 @@ class DistributionCenter(db.Model):
     zip = db.Column(db.Text, nullable=False)
     phone = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Located once when the DC is added, see geocode.py. Distances are worked out from these.
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    # 1 when only the state was found, and the coordinates are the middle of it.
+    approximate = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+    
+    # A DC can have years of loads, so they are only ever queried, never loaded whole.
+    loads = db.relationship('Load', back_populates='dc', lazy='dynamic')
     
     @classmethod
     def get_dist_by_user(cls, user_id):
         '''Gets a list of distrubution centers that is linked to a user.'''
         
-        dist_centers = cls.query.filter_by(user_id=user_id).all()
+        dist_centers = cls.query.for_user(user_id).all()
         return dist_centers
     
     def __repr__(self):
@@ -88,6 +135,10 @@ class Carrier(db.Model):
     '''Creates a carrier table in SQLAlchemy & PostgreSQL.'''
     
     __tablename__ = 'carriers'
+    __table_args__ = (
+        # Backs listing a user's carriers, the id and name choices are read from the index alone.
+        db.Index('ix_carriers_user', 'user_id', 'id', 'name'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True) 
     name = db.Column(db.Text, nullable=False)
@@ -97,12 +148,20 @@ class Carrier(db.Model):
     zip = db.Column(db.Text, nullable=False)
     phone = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Located once when the carrier is added, see geocode.py.
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    # 1 when only the state was found, and the coordinates are the middle of it.
+    approximate = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+    
+    # A carrier can have years of loads, so they are only ever queried, never loaded whole.
+    loads = db.relationship('Load', back_populates='carrier', lazy='dynamic')
     
     @classmethod
     def get_carrier_by_user(cls, user_id):
         '''Gets a list of carriers that is linked to a user.'''
         
-        carriers = cls.query.filter_by(user_id=user_id).all()
+        carriers = cls.query.for_user(user_id).all()
         return carriers
     
     def __repr__(self):
@@ -116,22 +175,88 @@ class Load(db.Model):
     '''Creates a load table in SQLAlchemy & PostgreSQL.'''
     
     __tablename__ = 'loads'
+    __table_args__ = (
+        # Backs the per carrier / DC KPI breakdowns.
+        db.Index('ix_loads_user_carrier_dc_due', 'user_id', 'carrier_id', 'd_c_id', 'due_date'),
+        # Backs the paginated board of open loads.
+        db.Index('ix_loads_open_board', 'user_id', 'due_date', 'miles', 'id', postgresql_where=db.text('delivered = 0')),
+        # Tiny index for due date ranges across all loads, which are mostly added in due date order.
+        db.Index('ix_loads_due_brin', 'due_date', postgresql_using='brin'),
+        # Backs reading all of a user's loads in id order, like the export does.
+        db.Index('ix_loads_user_id', 'user_id', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     po = db.Column(db.Text, nullable=False)
     name = db.Column(db.Text, nullable=False)   
     pickup_city = db.Column(db.Text, nullable=False)   
     pickup_state = db.Column(db.Text, nullable=False)
-    due_date = db.Column(db.Text, nullable=True)
-    day_of_week = db.Column(db.Text, nullable=True)
+    due_date = db.Column(db.Date, nullable=True)
     temp = db.Column(db.Integer, nullable=False)
-    team = db.Column(db.Integer, nullable=False)
+    # 0 = NO | 1 = YES
+    team = db.Column(db.SmallInteger, nullable=False)
     miles = db.Column(db.Integer, nullable=False, default=0)
-    delivered = db.Column(db.Integer, default=0)
+    # 1 while a background worker is recalculating miles after a location change.
+    miles_pending = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+    delivered = db.Column(db.SmallInteger, default=0)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     carrier_id = db.Column(db.Integer, db.ForeignKey('carriers.id'), nullable=False)
     d_c_id = db.Column(db.Integer, db.ForeignKey('distribution_centers.id'), nullable=False)
     
+    # Loaded on access by default, the board lists thousands of loads and needs none of these.
+    # Routes that do need them ask for joinedload/selectinload in the same query.
+    carrier = db.relationship('Carrier', back_populates='loads')
+    dc = db.relationship('DistributionCenter', back_populates='loads')
+    data = db.relationship('LoadData', back_populates='load', uselist=False, cascade='all, delete-orphan')
+    
+    @hybrid_property
+    def day_of_week(self):
+        '''The day the load is due, worked out from its due date.'''
+        return DAY_NAMES[self.due_date.weekday()] if self.due_date else None
+    
+    @day_of_week.expression
+    def day_of_week(cls):
+        return day_name(cls.due_date)
+    
+    @classmethod
+    def get_open_loads_page(cls, user_id, after=None, limit=50, carrier_id=None, d_c_id=None, state=None, team=None, temp_min=None, temp_max=None,
+                            due_after=None, due_before=None):
+        '''Gets one page of a user's undelivered loads, ordered by due date, miles and id.
+        
+        Uses keyset pagination: after is the (due_date, miles, id) of the last load on the previous page.
+        Loads without a due date (ones whose date couldn't be read when it was migrated) come last.
+        due_after and due_before keep loads due on or after and before those dates.
+        Returns up to limit + 1 loads, the extra one tells the caller there is another page.
+        '''
+        
+        query = cls.query.for_user(user_id).filter(cls.delivered == 0)
+        if carrier_id is not None:
+            query = query.filter(cls.carrier_id == carrier_id)
+        if d_c_id is not None:
+            query = query.filter(cls.d_c_id == d_c_id)
+        if state:
+            query = query.filter(cls.pickup_state == state)
+        if team is not None:
+            query = query.filter(cls.team == team)
+        if temp_min is not None:
+            query = query.filter(cls.temp >= temp_min)
+        if temp_max is not None:
+            query = query.filter(cls.temp <= temp_max)
+        if due_after is not None:
+            query = query.filter(cls.due_date >= due_after)
+        if due_before is not None:
+            query = query.filter(cls.due_date < due_before)
+        if after:
+            due_date, miles, id = after
+            # A comparison with NULL is never true, so undated loads are matched on their own.
+            if due_date is None:
+                query = query.filter(cls.due_date.is_(None), db.tuple_(cls.miles, cls.id) > db.tuple_(miles, id))
+            else:
+                query = query.filter(db.or_(db.tuple_(cls.due_date, cls.miles, cls.id) > db.tuple_(due_date, miles, id), cls.due_date.is_(None)))
+        # Ascending puts NULLs last, as ix_loads_open_board stores them.
+        loads = query.order_by(cls.due_date.asc().nullslast(), cls.miles, cls.id).limit(limit + 1).all()
+        return loads
+    
     @classmethod
     def get_load_by_carrier(cls, carrier_id):
         '''Gets a list of loads that is linked to a carrier.'''
@@ -155,6 +280,10 @@ class LoadData(db.Model):
     '''Creates a Data table for the loads in SQLAlchemy & PostgreSQL.'''
 
     __tablename__ = 'load_data'
+    __table_args__ = (
+        # Backs the KPI queries, which only look at a user's delivered loads.
+        db.Index('ix_load_data_user_delivered', 'user_id', 'delivered', 'load_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True) 
     load_id = db.Column(db.Integer, db.ForeignKey('loads.id'), nullable=False, unique=True)
@@ -164,15 +293,17 @@ class LoadData(db.Model):
     # 
     # 0 = NO | 1 = YES
     # 
-    ontime = db.Column(db.Integer, default=0)
-    damges = db.Column(db.Integer, default=0)
-    breakdown = db.Column(db.Integer, default=0)
+    ontime = db.Column(db.SmallInteger, default=0)
+    damges = db.Column(db.SmallInteger, default=0)
+    breakdown = db.Column(db.SmallInteger, default=0)
 
     # Normal Int values
     cost = db.Column(db.Integer, default=0)
     pallets = db.Column(db.Integer, default=0)
     weight = db.Column(db.Integer, default=0)
-    delivered = db.Column(db.Integer, default=0)
+    delivered = db.Column(db.SmallInteger, default=0)
+    
+    load = db.relationship('Load', back_populates='data')
     
     @classmethod
     def get_load_data_by_load(cls, load_id):
@@ -185,11 +316,211 @@ class LoadData(db.Model):
     def get_load_data_by_user(cls, user_id):
         '''Gets a list of loads that is linked to a user.'''
         
-        loads = cls.query.filter_by(user_id=user_id).all()
+        loads = cls.query.for_user(user_id).all()
         return loads
     
     def __repr__(self):
         return f'<Load Data id:{self.id}, load_id: {self.load_id}, user_id:{self.user_id}>'
 
+# 
+# KPI ROLLUP MODEL
+# 
+class KPIRollup(db.Model):
+    '''Creates a per user table of delivered load counters in SQLAlchemy & PostgreSQL.
+    
+    Kept up to date as loads are delivered so the KPI page is a primary key lookup.
+    '''
+
+    __tablename__ = 'kpi_rollups'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    delivered = db.Column(db.BigInteger, nullable=False, default=0)
+    ontime = db.Column(db.BigInteger, nullable=False, default=0)
+    damages = db.Column(db.BigInteger, nullable=False, default=0)
+    breakdown = db.Column(db.BigInteger, nullable=False, default=0)
+    cost = db.Column(db.BigInteger, nullable=False, default=0)
+    pallets = db.Column(db.BigInteger, nullable=False, default=0)
+    weight = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<KPI Rollup user_id:{self.user_id}, delivered: {self.delivered}>'
+# 
+# DISTANCE CACHE MODEL
+# 
+class DistanceCache(db.Model):
+    '''Creates a table of previously calculated lane distances in SQLAlchemy & PostgreSQL.
+    
+    Keyed on the normalized pickup city/state and the DC's id, city and state.
+    '''
+
+    __tablename__ = 'distance_cache'
+    __table_args__ = (
+        db.UniqueConstraint('origin_city', 'origin_state', 'd_c_id', 'dc_city', 'dc_state', name='uq_distance_cache_lane'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    origin_city = db.Column(db.Text, nullable=False)
+    origin_state = db.Column(db.Text, nullable=False)
+    d_c_id = db.Column(db.Integer, db.ForeignKey('distribution_centers.id', ondelete='CASCADE'), nullable=False)
+    dc_city = db.Column(db.Text, nullable=False)
+    dc_state = db.Column(db.Text, nullable=False)
+    miles = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Distance Cache id:{self.id}, {self.origin_city}, {self.origin_state} -> dc {self.d_c_id}: {self.miles}>'
+# 
+# MILEAGE JOB MODEL
+# 
+class MileageJob(db.Model):
+    '''Creates a queue table of loads waiting for their miles to be recalculated in SQLAlchemy & PostgreSQL.'''
+
+    __tablename__ = 'mileage_jobs'
+    __table_args__ = (
+        db.Index('ix_mileage_jobs_ready', 'status', 'run_after'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # A load has at most one job, enqueueing it again resets the job.
+    load_id = db.Column(db.Integer, db.ForeignKey('loads.id', ondelete='CASCADE'), nullable=False, unique=True)
+    # pending -> running -> (deleted when done) | failed
+    status = db.Column(db.Text, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
     
-    
\ No newline at end of file
+    def __repr__(self):
+        return f'<Mileage Job id:{self.id}, load_id: {self.load_id}, status: {self.status}>'
+# 
+# LANE STATS MODEL
+# 
+class LaneStat(db.Model):
+    '''Creates a table of delivered load statistics per lane (pickup city/state to DC) in SQLAlchemy & PostgreSQL.
+    
+    Holds running sums, kept up to date as loads are delivered, so a lane's averages are a primary key lookup.
+    Cities are stored normalized (lower cased, single spaced) and states upper cased.
+    '''
+
+    __tablename__ = 'lane_stats'
+    __table_args__ = (
+        # Backs searching a user's lanes by pickup location.
+        db.Index('ix_lane_stats_user_origin', 'user_id', 'pickup_state', 'pickup_city'),
+    )
+    
+    d_c_id = db.Column(db.Integer, db.ForeignKey('distribution_centers.id', ondelete='CASCADE'), primary_key=True)
+    pickup_state = db.Column(db.Text, primary_key=True)
+    pickup_city = db.Column(db.Text, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    loads = db.Column(db.BigInteger, nullable=False, default=0)
+    ontime = db.Column(db.BigInteger, nullable=False, default=0)
+    cost = db.Column(db.BigInteger, nullable=False, default=0)
+    # Sum of each load's cost squared, for the variance.
+    cost_squares = db.Column(db.BigInteger, nullable=False, default=0)
+    miles = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<Lane Stat {self.pickup_city}, {self.pickup_state} -> dc {self.d_c_id}: {self.loads} loads>'
+# 
+# CARRIER SCORES MODEL
+# 
+class CarrierScore(db.Model):
+    '''Creates a table of delivered load statistics per carrier and DC in SQLAlchemy & PostgreSQL.
+    
+    Running sums, kept up to date as loads are delivered, that carrier rankings are worked out from.
+    '''
+
+    __tablename__ = 'carrier_scores'
+    __table_args__ = (
+        # Backs reading all of a user's scores at once to rank their carriers.
+        db.Index('ix_carrier_scores_user', 'user_id'),
+    )
+    
+    carrier_id = db.Column(db.Integer, db.ForeignKey('carriers.id', ondelete='CASCADE'), primary_key=True)
+    d_c_id = db.Column(db.Integer, db.ForeignKey('distribution_centers.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    loads = db.Column(db.BigInteger, nullable=False, default=0)
+    ontime = db.Column(db.BigInteger, nullable=False, default=0)
+    damages = db.Column(db.BigInteger, nullable=False, default=0)
+    breakdowns = db.Column(db.BigInteger, nullable=False, default=0)
+    cost = db.Column(db.BigInteger, nullable=False, default=0)
+    miles = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<Carrier Score carrier {self.carrier_id} -> dc {self.d_c_id}: {self.loads} loads>'
+# 
+# SCHEMA MIGRATIONS MODEL
+# 
+class SchemaMigration(db.Model):
+    '''Creates a table recording which migrations in migrations.py have run, in SQLAlchemy & PostgreSQL.'''
+
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.Text, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Schema Migration {self.version}: {self.name}>'
+# 
+# LOAD ALERT MODEL
+# 
+class LoadAlert(db.Model):
+    '''Creates a table of open loads that are overdue or won't make their due date, in SQLAlchemy & PostgreSQL.
+    
+    Written by alerts.evaluate_alerts, one row per flagged load, so the load board reads them by primary key.
+    '''
+
+    __tablename__ = 'load_alerts'
+    __table_args__ = (
+        # Backs the alert counts on the load board.
+        db.Index('ix_load_alerts_user_kind', 'user_id', 'kind'),
+    )
+    
+    load_id = db.Column(db.Integer, db.ForeignKey('loads.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # 'overdue' or 'at_risk'
+    kind = db.Column(db.Text, nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    # When the load would arrive if it left today.
+    eta = db.Column(db.Date, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Load Alert load_id:{self.load_id}, kind: {self.kind}, eta: {self.eta}>'
+# 
+# LOAD EVENT MODEL
+# 
+class LoadEvent(db.Model):
+    '''Creates an append only log of load lifecycle changes in SQLAlchemy & PostgreSQL.
+    
+    Partitioned by month on created_at, see events.py. Rows are never updated, so a load's history
+    (where it was picked up, when its data changed, when it was delivered) survives the changes.
+    '''
+
+    __tablename__ = 'load_events'
+    __table_args__ = (
+        # Backs a load's timeline, one index range per monthly partition.
+        db.Index('ix_load_events_load_time', 'load_id', 'created_at'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+    
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    # Part of the primary key because it is the partition key.
+    created_at = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
+    load_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    # 'created', 'location', 'miles' (worked out later by the mileage worker), 'data' or 'delivered'
+    kind = db.Column(db.Text, nullable=False)
+    pickup_city = db.Column(db.Text, nullable=True)
+    pickup_state = db.Column(db.Text, nullable=True)
+    miles = db.Column(db.Integer, nullable=True)
+    # Whatever else the change set, like the new load data.
+    detail = db.Column(JSONB(none_as_null=True), nullable=True)
+    
+    def __repr__(self):
+        return f'<Load Event id:{self.id}, load_id: {self.load_id}, kind: {self.kind}>'
+
+# Catches events outside the monthly partitions, so writes never fail for want of one.
+event.listen(LoadEvent.__table__, 'after_create', DDL('CREATE TABLE IF NOT EXISTS load_events_default PARTITION OF load_events DEFAULT'))
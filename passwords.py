@@ -0,0 +1,126 @@
+'''Password hashing and login throttling.
+
+bcrypt is slow on purpose, so a burst of logins can tie up every worker. Three things keep that in check:
+
+ - BCRYPT_LOG_ROUNDS sets the work factor. Hashes made with another factor are redone on the next
+   successful login, so the factor can be raised or lowered without a migration.
+ - With BCRYPT_POOL_SIZE above 0, hashing runs in a small process pool per worker, so request threads
+   stay free. At most BCRYPT_MAX_PENDING hashes wait for the pool; past that logins are turned away
+   with PasswordsBusy instead of queueing forever. 0 hashes on the request thread.
+ - Token buckets per username and per client IP (LOGIN_RATE_PER_USER, LOGIN_RATE_PER_IP, in attempts
+   per minute) shed floods before anything is hashed.
+'''
+from threading import BoundedSemaphore, Lock
+from flask import current_app, request
+from ratelimit import TokenBucketLimiter, check_limits
+from config import DEFAULT_LOG_ROUNDS, DEFAULT_RATE_PER_USER, DEFAULT_RATE_PER_IP
+import hmac
+
+# Seconds a login waits for a free spot in the pool before giving up.
+POOL_WAIT = 5
+
+_pool_lock = Lock()
+
+
+class PasswordsBusy(Exception):
+    '''Raised when too many passwords are already waiting to be hashed.'''
+
+
+def _hashpw(password, salt_or_hash):
+    # bcrypt and the pool are imported on the first hash, not by every process that imports models.
+    import bcrypt
+    return bcrypt.hashpw(password, salt_or_hash)
+
+
+def _pool():
+    '''Returns this process's hashing pool and its semaphore, starting them on first use.
+
+    Started lazily so that gunicorn workers each get their own after forking.
+    '''
+    extensions = current_app.extensions
+    pool = extensions.get('password_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = extensions.get('password_pool')
+            if pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                import multiprocessing
+                size = current_app.config['BCRYPT_POOL_SIZE']
+                pending = current_app.config.get('BCRYPT_MAX_PENDING') or size * 4
+                # forkserver, because forking a process that already runs threads isn't safe.
+                executor = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('forkserver'))
+                pool = extensions['password_pool'] = (executor, BoundedSemaphore(size + pending))
+    return pool
+
+
+def _run(password, salt_or_hash):
+    '''Runs bcrypt inline or in the pool, depending on BCRYPT_POOL_SIZE.'''
+    password = password.encode('UTF-8')
+    salt_or_hash = salt_or_hash.encode('UTF-8') if isinstance(salt_or_hash, str) else salt_or_hash
+    if not current_app.config.get('BCRYPT_POOL_SIZE'):
+        return _hashpw(password, salt_or_hash)
+    executor, slots = _pool()
+    if not slots.acquire(timeout=POOL_WAIT):
+        raise PasswordsBusy()
+    try:
+        return executor.submit(_hashpw, password, salt_or_hash).result()
+    finally:
+        slots.release()
+
+
+def log_rounds():
+    '''Returns the configured bcrypt work factor.'''
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(password):
+    '''Hashes a password with the configured work factor.'''
+    import bcrypt
+    return _run(password, bcrypt.gensalt(rounds=log_rounds())).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    '''Checks a password against its hash.'''
+    try:
+        return hmac.compare_digest(_run(password, hashed), hashed.encode('UTF-8'))
+    except ValueError:
+        return False
+
+
+def needs_rehash(hashed):
+    '''Tells if a hash was made with a different work factor than the configured one.'''
+    try:
+        return int(hashed.split('$')[2]) != log_rounds()
+    except (IndexError, ValueError):
+        return True
+
+#
+# THROTTLING
+#
+
+def _limiters():
+    '''Returns the per username and per IP limiters, building them from the config on first use.'''
+    limiters = current_app.extensions.get('login_limiters')
+    if limiters is None:
+        config = current_app.config
+        per_user = config.get('LOGIN_RATE_PER_USER', DEFAULT_RATE_PER_USER)
+        per_ip = config.get('LOGIN_RATE_PER_IP', DEFAULT_RATE_PER_IP)
+        # Bursts of half a minute's worth; a whole dispatch office logging in at once shares one IP.
+        limiters = current_app.extensions['login_limiters'] = (
+            TokenBucketLimiter(rate=per_user / 60, burst=max(1, per_user // 2)),
+            TokenBucketLimiter(rate=per_ip / 60, burst=max(1, per_ip // 2)))
+    return limiters
+
+
+def login_wait(username=None):
+    '''Counts a login (or signup) attempt. Returns 0 if it may go ahead, otherwise the seconds to wait.
+
+    Nothing is limited when LOGIN_RATE_LIMIT is off.
+    '''
+    if not current_app.config.get('LOGIN_RATE_LIMIT', True):
+        return 0
+    per_user, per_ip = _limiters()
+    limits = [(per_ip, request.remote_addr)]
+    if username:
+        limits.append((per_user, username.strip().lower()))
+    return check_limits(limits)
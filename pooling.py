@@ -0,0 +1,84 @@
+'''Database connection settings for running under gunicorn.
+
+Every gunicorn worker process has its own connection pool, so the pool is sized from the worker and
+thread counts to keep the total under what PostgreSQL (or PgBouncer) will accept:
+
+    workers * (pool size + overflow) <= DATABASE_MAX_CONNECTIONS
+
+gunicorn.conf.py reads the same WEB_CONCURRENCY and GUNICORN_THREADS, so the two always agree.
+With DATABASE_PGBOUNCER set the app keeps no pool of its own and leaves pooling to PgBouncer.
+'''
+from flask import current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+import os
+
+DEFAULT_WORKERS = 2
+DEFAULT_THREADS = 4
+# Connections this app may open in total, across every worker. Leave room for workers, migrations and psql.
+DEFAULT_MAX_CONNECTIONS = 40
+# Extra connections a worker may open past its pool during a spike, budget permitting.
+MAX_OVERFLOW = 2
+# Seconds a request waits for a free connection before failing, instead of piling up.
+POOL_TIMEOUT = 10
+# Connections are replaced after this many seconds, before firewalls or PgBouncer drop them.
+POOL_RECYCLE = 1800
+
+
+def _env_int(name, default):
+    '''Reads a whole number from the environment.'''
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def concurrency():
+    '''Returns the (workers, threads) gunicorn runs with.'''
+    return max(1, _env_int('WEB_CONCURRENCY', DEFAULT_WORKERS)), max(1, _env_int('GUNICORN_THREADS', DEFAULT_THREADS))
+
+
+def pool_options(workers, threads, max_connections=DEFAULT_MAX_CONNECTIONS, pgbouncer=False):
+    '''Returns SQLALCHEMY_ENGINE_OPTIONS for a worker.
+
+    Each thread gets a pooled connection where the budget allows it, plus a little overflow.
+    If the budget is smaller than workers * threads, threads wait up to POOL_TIMEOUT for a connection.
+    '''
+    if pgbouncer:
+        # PgBouncer already pools; connections are cheap to open against it and must not be held between requests.
+        return {'poolclass': NullPool}
+    per_worker = max(1, max_connections // workers)
+    pool_size = min(threads, per_worker)
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max(0, min(MAX_OVERFLOW, per_worker - pool_size)),
+        'pool_timeout': _env_int('DATABASE_POOL_TIMEOUT', POOL_TIMEOUT),
+        'pool_recycle': POOL_RECYCLE,
+        # Drops connections PostgreSQL closed (restarts, idle timeouts) before a request gets one.
+        'pool_pre_ping': True,
+    }
+
+
+def engine_options():
+    '''Builds SQLALCHEMY_ENGINE_OPTIONS from the environment.'''
+    workers, threads = concurrency()
+    return pool_options(workers, threads,
+                        max_connections=_env_int('DATABASE_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS),
+                        pgbouncer=os.environ.get('DATABASE_PGBOUNCER') == '1')
+
+
+def _set_statement_timeout(conn):
+    '''Limits statements run by a request. SET LOCAL only lasts for the transaction, so it is safe behind PgBouncer.'''
+    if not has_request_context():
+        return
+    timeout = int(current_app.config.get('STATEMENT_TIMEOUT') or 0)
+    if timeout > 0:
+        conn.execute(f'SET LOCAL statement_timeout = {timeout}')
+
+
+def init_statement_timeout(app):
+    '''Gives every transaction opened while serving a request a statement timeout.
+
+    CLI commands and the mileage worker run outside of requests, so long imports and rebuilds aren't cut off.
+    '''
+    if int(app.config.get('STATEMENT_TIMEOUT') or 0) > 0 and not event.contains(Engine, 'begin', _set_statement_timeout):
+        event.listen(Engine, 'begin', _set_statement_timeout)
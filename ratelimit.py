@@ -0,0 +1,49 @@
+'''In-memory token bucket rate limiting, used to turn away login floods before any password is hashed.
+
+Buckets live in the worker process, so with several gunicorn workers each one limits on its own.
+That still caps a brute force run at workers x the configured rate, which is the point.
+'''
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TokenBucketLimiter:
+    '''Allows bursts of up to burst hits per key, refilled at rate hits per second.
+
+    Keys that haven't been seen in a while are evicted once there are more than maxsize of them.
+    An evicted bucket was full anyway unless it was hit very recently.
+    '''
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def hit(self, key, now=None):
+        '''Takes a token for key. Returns 0 if allowed, otherwise the seconds until a token is free.'''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+def check_limits(limits):
+    '''Hits every (limiter, key) pair. Returns 0 if all allowed, otherwise the longest wait in seconds.'''
+    return max([limiter.hit(key) for limiter, key in limits] or [0])
@@ -0,0 +1,63 @@
+'''Cache of the (id, name) choices of a user's carriers and DCs.
+
+Entries are keyed on the user's ref_version, which is bumped in the same flush as any write to
+carriers or distribution_centers. Every worker reads the version (a primary key lookup) once per
+request, so a stale entry is never served, and old versions age out of the size bounded cache.
+'''
+from flask import current_app, g
+from sqlalchemy import event
+from cache import LRUCache
+from models import db, User, Carrier, DistributionCenter
+
+DEFAULT_CACHE_SIZE = 2048
+
+MODELS = {'carriers': Carrier, 'dcs': DistributionCenter}
+
+_cache = None
+
+
+def _choices_cache():
+    '''Returns the choices cache, creating it from the app config on first use.'''
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(maxsize=current_app.config.get('REFDATA_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return _cache
+
+
+def _version(user_id):
+    '''Returns the user's reference data version, read at most once per request.'''
+    versions = g.setdefault('ref_versions', {})
+    if user_id not in versions:
+        versions[user_id] = db.session.query(User.ref_version).filter(User.id == user_id).scalar() or 0
+    return versions[user_id]
+
+
+def get_choices(user_id, kind):
+    '''Returns a list of (id, name) tuples of a user's 'carriers' or 'dcs'.'''
+    model = MODELS[kind]
+    key = (user_id, kind, _version(user_id))
+    cache = _choices_cache()
+    choices = cache.get(key)
+    if choices is None:
+        choices = [(id, name) for id, name in db.session.query(model.id, model.name).for_user(user_id).order_by(model.id)]
+        cache.set(key, choices)
+    return choices
+
+
+def cache_stats():
+    '''Returns the size and hit/miss counters of the choices cache.'''
+    return _choices_cache().stats()
+
+
+def _bump_version(mapper, connection, target):
+    '''Invalidates the cached choices of the user that owns a changed carrier or DC.'''
+    users = User.__table__
+    connection.execute(users.update().where(users.c.id == target.user_id).values(ref_version=users.c.ref_version + 1))
+    versions = g.get('ref_versions') if g else None
+    if versions:
+        versions.pop(target.user_id, None)
+
+
+for model in MODELS.values():
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, _bump_version)
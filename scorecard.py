@@ -0,0 +1,116 @@
+'''Carrier scorecards. Keeps running sums per carrier and DC of delivered loads, and ranks a user's
+carriers from them when a load is entered.
+
+A carrier's on time, damage and breakdown rates and cost per mile at a DC are shrunk towards its
+rates at every DC, and those towards the user's rates over all carriers, so a carrier with a
+couple of lucky loads doesn't jump to the top. Each is weighted into a 0-100 score (SCORE_WEIGHTS).
+
+Scores are updated in the same transaction as the delivery or load data change that affects them,
+and ranking reads one user's rows with a single index scan, so it stays a few milliseconds.
+flask rebuild-carrier-scores recomputes them from the loads.
+'''
+from collections import namedtuple
+from sqlalchemy import BigInteger, cast, func
+from models import db, Load, LoadData, CarrierScore
+from totals import flag_sum, value_sum, add_totals, apply_deltas, rebuild_totals
+
+# Running sums of one carrier at one DC, or the change to them.
+CarrierTotals = namedtuple('CarrierTotals', ['loads', 'ontime', 'damages', 'breakdowns', 'cost', 'miles'])
+
+# A ranked carrier. Rates are fractions, after shrinking; loads were delivered at the DC (or anywhere), total_loads anywhere.
+CarrierRank = namedtuple('CarrierRank', ['carrier_id', 'score', 'loads', 'total_loads', 'ontime', 'damages', 'breakdowns', 'cost_per_mile'])
+
+# How many loads' worth of weight the broader rates get when shrinking.
+PRIOR_LOADS = 10
+SCORE_WEIGHTS = {'ontime': 0.4, 'damages': 0.2, 'breakdowns': 0.2, 'cost': 0.2}
+DEFAULT_TOP = 5
+
+_EMPTY = CarrierTotals(0, 0, 0, 0, 0, 0)
+
+
+def carrier_counters(data, miles):
+    '''Returns what a single delivered load adds to its carrier's scores.'''
+    return CarrierTotals(loads=1, ontime=1 if data.ontime == 1 else 0, damages=1 if data.damges == 1 else 0,
+                         breakdowns=1 if data.breakdown == 1 else 0, cost=data.cost or 0, miles=miles or 0)
+
+
+def apply_carrier_deltas(user_id, deltas):
+    '''Adds ((carrier_id, d_c_id), CarrierTotals) deltas to the score table inside the current transaction, one upsert for all rows.'''
+    apply_deltas(CarrierScore, ('carrier_id', 'd_c_id'), user_id, deltas)
+
+#
+# RANKING
+#
+
+
+def _rates(totals, prior):
+    '''Returns [ontime, damages, breakdowns, cost per mile, miles per load], shrunk towards prior, a list of the same.'''
+    loads = totals.loads + PRIOR_LOADS
+    rates = [(getattr(totals, field) + PRIOR_LOADS * rate) / loads for field, rate in zip(('ontime', 'damages', 'breakdowns'), prior)]
+    # Cost per mile is shrunk by miles, the prior counting as PRIOR_LOADS loads of the average length.
+    prior_miles = PRIOR_LOADS * prior[4]
+    cost_per_mile = (totals.cost + prior_miles * prior[3]) / (totals.miles + prior_miles) if totals.miles + prior_miles else prior[3]
+    return rates + [cost_per_mile, prior[4]]
+
+
+def _score(rates, average_cost_per_mile):
+    ontime, damages, breakdowns, cost_per_mile = rates[:4]
+    # 0.5 at the user's average cost per mile, towards 1 for cheaper carriers and 0 for dearer ones.
+    cost = average_cost_per_mile / (average_cost_per_mile + cost_per_mile) if average_cost_per_mile + cost_per_mile else 0.5
+    return 100 * (SCORE_WEIGHTS['ontime'] * ontime + SCORE_WEIGHTS['damages'] * (1 - damages)
+                  + SCORE_WEIGHTS['breakdowns'] * (1 - breakdowns) + SCORE_WEIGHTS['cost'] * cost)
+
+
+def rank_carriers(user_id, carrier_ids, d_c_id=None, limit=None):
+    '''Ranks carriers for a load going to d_c_id (or anywhere), best first. Returns a list of CarrierRank.
+
+    Carriers without delivered loads get the user's average rates, and ties keep the order of carrier_ids.
+    '''
+    overall = {}
+    at_dc = {}
+    user = _EMPTY
+    columns = [getattr(CarrierScore, field) for field in CarrierTotals._fields]
+    for carrier_id, row_dc_id, *values in db.session.query(CarrierScore.carrier_id, CarrierScore.d_c_id, *columns).for_user(user_id):
+        totals = CarrierTotals(*values)
+        overall[carrier_id] = add_totals(overall.get(carrier_id, _EMPTY), totals)
+        if row_dc_id == d_c_id:
+            at_dc[carrier_id] = totals
+        user = add_totals(user, totals)
+    loads = user.loads or 1
+    user_rates = [user.ontime / loads, user.damages / loads, user.breakdowns / loads,
+                  user.cost / user.miles if user.miles else 0, user.miles / loads]
+    ranks = []
+    for order, carrier_id in enumerate(carrier_ids):
+        total = overall.get(carrier_id, _EMPTY)
+        rates = _rates(total, user_rates)
+        loads = total.loads
+        if d_c_id is not None:
+            rates = _rates(at_dc.get(carrier_id, _EMPTY), rates)
+            loads = at_dc.get(carrier_id, _EMPTY).loads
+        score = round(_score(rates, user_rates[3]), 1)
+        ranks.append((-score, order, CarrierRank(carrier_id, score, loads, total.loads, round(rates[0], 3), round(rates[1], 3), round(rates[2], 3), round(rates[3], 2))))
+    ranks.sort(key=lambda rank: rank[:2])
+    return [rank for score, order, rank in ranks[:limit]]
+
+
+def rank_choices(user_id, choices, d_c_id=None):
+    '''Orders (id, name) carrier choices best first, labelling the ones with delivered loads with their score.'''
+    names = dict(choices)
+    return [(rank.carrier_id, f'{names[rank.carrier_id]} ({rank.score:.0f})' if rank.total_loads else names[rank.carrier_id])
+            for rank in rank_carriers(user_id, [id for id, name in choices], d_c_id=d_c_id)]
+
+#
+# REBUILDS
+#
+
+def rebuild_carrier_scores(user_id=None):
+    '''Recomputes carrier scores from the delivered loads, for one user or everyone. Returns the number of rows.'''
+    query = (db.session.query(Load.carrier_id, Load.d_c_id, Load.user_id,
+                              func.count(LoadData.id), flag_sum(LoadData.ontime), flag_sum(LoadData.damges), flag_sum(LoadData.breakdown),
+                              value_sum(cast(func.coalesce(LoadData.cost, 0), BigInteger)), value_sum(func.coalesce(Load.miles, 0)))
+             .join(LoadData, LoadData.load_id == Load.id)
+             .filter(LoadData.delivered == 1)
+             .group_by(Load.carrier_id, Load.d_c_id, Load.user_id))
+    if user_id is not None:
+        query = query.filter(Load.user_id == user_id)
+    return rebuild_totals(CarrierScore, ['carrier_id', 'd_c_id', 'user_id', *CarrierTotals._fields], query, user_id)
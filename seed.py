@@ -1,6 +1,14 @@
-from app import app
+from app import create_app
 from models import db
+from migrations import stamp
+from events import ensure_partitions
 
 
-db.drop_all()
-db.create_all()
\ No newline at end of file
+# Only the database is needed, so the pages and commands aren't loaded.
+with create_app(web=False).app_context():
+    db.drop_all()
+    db.create_all()
+    # The tables are already current, so there is nothing to migrate.
+    stamp()
+    # Monthly partitions for load events, flask event-partitions keeps adding them.
+    ensure_partitions()
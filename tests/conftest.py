@@ -0,0 +1,92 @@
+'''Fixtures shared by the tests. They run against a scratch PostgreSQL database, TEST_DATABASE_URL,
+which is emptied and recreated at the start of every run.
+
+    createdb freight_test
+    python -m pytest
+'''
+from datetime import date
+from itertools import count
+import os
+import pytest
+from app import create_app
+from models import db, User, Carrier, DistributionCenter, Load, LoadData
+from migrations import stamp
+from events import ensure_partitions
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'postgresql:///freight_test')
+
+_names = count(1)
+
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URL,
+        'SQLALCHEMY_ECHO': False,
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        # Hash in the test process and cheaply.
+        'BCRYPT_POOL_SIZE': 0,
+        'BCRYPT_LOG_ROUNDS': 4,
+        'DISTANCE_PROVIDER': 'offline',
+    })
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        stamp()
+        ensure_partitions()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def unique(prefix):
+    '''Returns a name no other test has used, for the columns that must be unique.'''
+    return f'{prefix} {next(_names)}'
+
+
+def make_user():
+    user = User(username=unique('user'), password='not a hash')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def make_dc(user, city='Atlanta', state='GA'):
+    dc = DistributionCenter(name=unique('DC'), address=unique('1 DC Way'), city=city, state=state, zip='30301', phone='5555555555', user_id=user.id)
+    db.session.add(dc)
+    db.session.commit()
+    return dc
+
+
+def make_carrier(user):
+    carrier = Carrier(name=unique('Carrier'), address=unique('1 Carrier Way'), city='Dallas', state='TX', zip='75201', phone='5555555555', user_id=user.id)
+    db.session.add(carrier)
+    db.session.commit()
+    return carrier
+
+
+def make_load(user, carrier, dc, city='Memphis', state='TN', miles=400):
+    load = Load(po=unique('PO'), name=unique('Load'), pickup_city=city, pickup_state=state, due_date=date(2024, 6, 3), temp=0, team=0,
+                miles=miles, carrier_id=carrier.id, d_c_id=dc.id, user_id=user.id)
+    load.data = LoadData(user_id=user.id)
+    db.session.add(load)
+    db.session.commit()
+    return load
+
+
+@pytest.fixture
+def user(app):
+    return make_user()
+
+
+@pytest.fixture
+def logged_in(client, user):
+    '''A client logged in as user.'''
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+    return client
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app import create_app
+from conftest import TEST_DATABASE_URL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_trusts_herokus_router(monkeypatch):
+    monkeypatch.setenv('DYNO', 'web.1')
+    monkeypatch.delenv('TRUSTED_PROXIES', raising=False)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URL}, web=False)
+    assert isinstance(app.wsgi_app, ProxyFix) and app.wsgi_app.x_for == 1
+
+
+def test_trusts_no_proxy_by_default(monkeypatch):
+    monkeypatch.delenv('DYNO', raising=False)
+    monkeypatch.delenv('TRUSTED_PROXIES', raising=False)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URL}, web=False)
+    assert not isinstance(app.wsgi_app, ProxyFix)
+
+
+def test_importing_the_app_loads_nothing_heavy():
+    # A fresh interpreter, the test process has imported everything already.
+    modules = ('models', 'passwords', 'events', 'pooling', 'metrics', 'alerts', 'bcrypt', 'numpy')
+    code = f'import sys, app; print(sorted(set({modules!r}) & set(sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=ROOT)
+    assert result.stdout.strip() == '[]', result.stderr
+
+
+def test_models_load_password_hashing_on_first_use():
+    code = 'import sys, models; print("passwords" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=ROOT)
+    assert result.stdout.strip() == 'False', result.stderr
@@ -0,0 +1,27 @@
+from models import db
+from helper import encode_cursor, decode_cursor
+from conftest import make_dc, make_carrier, make_load
+
+
+def test_undated_loads_are_paged_through(logged_in, user):
+    dc, carrier = make_dc(user), make_carrier(user)
+    dated = make_load(user, carrier, dc)
+    undated = [make_load(user, carrier, dc, miles=miles) for miles in (300, 500)]
+    for load in undated:
+        load.due_date = None
+    db.session.commit()
+    expected = [dated.id] + [load.id for load in undated]
+    seen, after = [], None
+    for page in range(len(expected) + 1):
+        body = logged_in.get('/api/v1/loads', query_string=dict(per_page=1, **({'after': after} if after else {}))).get_json()
+        seen += [load['id'] for load in body['loads']]
+        after = body['next']
+        if after is None:
+            break
+    assert seen == expected
+
+
+def test_undated_cursors_round_trip(user):
+    load = make_load(user, make_carrier(user), make_dc(user))
+    load.due_date = None
+    assert decode_cursor(encode_cursor(load)) == (None, load.miles, load.id)
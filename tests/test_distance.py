@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+import pytest
+from benchmarks.fake_mapquest import FakeMapQuest, fake_miles
+from models import db, DistanceCache
+from distance import cached_miles, cache_stats, clear_memory_cache, get_offline_provider
+from lifecycle import update_locations
+from conftest import make_user, make_dc, make_carrier, make_load
+
+
+@pytest.fixture
+def mapquest(app):
+    '''Points the app at a fake MapQuest server for one test.'''
+    with FakeMapQuest() as fake:
+        app.config.update(DISTANCE_PROVIDER='mapquest', MAPQUEST_URL=fake.url, MAPQUEST_TIMEOUT=1)
+        app.extensions.pop('distance_provider', None)
+        clear_memory_cache()
+        yield fake
+    app.config.update(DISTANCE_PROVIDER='offline')
+    app.extensions.pop('distance_provider', None)
+    clear_memory_cache()
+
+
+def api_calls():
+    return cache_stats()['api_calls']
+
+
+def test_miss_then_hit(mapquest):
+    dc = make_dc(make_user())
+    calls = api_calls()
+    miles = cached_miles('Memphis', 'TN', dc)
+    db.session.commit()
+    assert miles == fake_miles('Memphis, TN', f'{dc.city}, {dc.state}')
+    assert api_calls() == calls + 1
+    # Memory tier.
+    assert cached_miles('memphis ', 'tn', dc) == miles
+    # Database tier, as another worker would see it.
+    clear_memory_cache()
+    assert cached_miles('Memphis', 'TN', dc) == miles
+    assert api_calls() == calls + 1
+
+
+def test_expired_rows_are_looked_up_again(mapquest):
+    dc = make_dc(make_user())
+    cached_miles('Memphis', 'TN', dc)
+    db.session.commit()
+    calls = api_calls()
+    DistanceCache.query.filter_by(d_c_id=dc.id).update({'created_at': datetime.utcnow() - timedelta(days=365)})
+    db.session.commit()
+    clear_memory_cache()
+    cached_miles('Memphis', 'TN', dc)
+    assert api_calls() == calls + 1
+
+
+def test_falls_back_to_offline_when_the_provider_is_down(mapquest):
+    dc = make_dc(make_user())
+    mapquest.stop()
+    miles = cached_miles('Memphis', 'TN', dc)
+    assert miles == get_offline_provider().miles('Memphis', 'TN', dc)
+    # The estimate isn't cached, so the real distance is fetched once MapQuest is back.
+    assert DistanceCache.query.filter_by(d_c_id=dc.id).count() == 0
+
+
+def test_unknown_places_have_no_miles(app, mapquest):
+    dc = make_dc(make_user())
+    mapquest.stop()
+    assert cached_miles('Nowhere', 'ZZ', dc) is None
+
+
+def test_offline_unknown_places_have_no_miles(app):
+    user = make_user()
+    dc = make_dc(user, state='ZZ')
+    assert cached_miles('Memphis', 'TN', dc) is None
+    load = make_load(user, make_carrier(user), dc)
+    assert update_locations(user.id, [{'id': load.id, 'city': 'Memphis', 'state': 'TN'}]) == {load.id: 'Could not find Memphis, TN.'}
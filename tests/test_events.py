@@ -0,0 +1,44 @@
+from datetime import datetime
+import logging
+from sqlalchemy import create_engine
+from events import EventWriter
+from conftest import TEST_DATABASE_URL
+
+
+def unreachable():
+    '''An engine whose connections fail straight away.'''
+    return create_engine(TEST_DATABASE_URL.replace('freight_test', 'no_such_database'))
+
+
+def events(count, start=0):
+    return [dict(load_id=start + i, user_id=1, kind='created', created_at=datetime.utcnow()) for i in range(count)]
+
+
+def test_failed_writes_are_logged_and_kept(caplog):
+    writer = EventWriter(unreachable(), log=logging.getLogger('test'))
+    writer.add(events(3))
+    with caplog.at_level(logging.ERROR):
+        assert writer.flush() == 0
+    assert 'Could not write 3 load events' in caplog.text
+    assert len(writer.buffer) == 3 and writer.written == 0
+
+
+def test_the_buffer_drops_its_oldest_events():
+    writer = EventWriter(unreachable(), flush_size=4, max_buffer=5, log=logging.getLogger('test'))
+    writer.add(events(3))
+    # Fills the buffer, the flush fails and puts the first three back in front of the new ones.
+    writer.add(events(3, start=3))
+    assert [event['load_id'] for event in writer.buffer] == [1, 2, 3, 4, 5]
+    assert writer.dropped == 1
+
+
+def test_requests_finish_while_events_cannot_be_written(app, client):
+    writer = EventWriter(unreachable())
+    writer.add(events(1))
+    previous = app.extensions.get('event_writer')
+    app.extensions['event_writer'] = writer
+    try:
+        assert client.get('/').status_code == 200
+    finally:
+        app.extensions['event_writer'] = previous
+    assert len(writer.buffer) == 1
@@ -0,0 +1,60 @@
+from datetime import date, timedelta
+import numpy as np
+from models import db, Load, KPIRollup
+from lifecycle import deliver_loads
+from forecast import FEATURES, MIN_HISTORY, features, fit_model, get_model, summarize_open_loads
+import forecast
+from conftest import make_dc, make_carrier, make_load
+
+
+def make_history(user, count):
+    '''Loads due on every day of the week, with their cost and on time set. Returns their ids.'''
+    dc, carrier = make_dc(user), make_carrier(user)
+    loads = []
+    for i in range(count):
+        load = make_load(user, carrier, dc, miles=300 + 10 * i)
+        load.due_date = date(2024, 6, 3) + timedelta(days=i)
+        load.data.cost = 900 + 25 * i
+        load.data.ontime = int(i % 3 != 0)
+        loads.append(load)
+    db.session.commit()
+    return [load.id for load in loads]
+
+
+def test_features_use_the_date_not_its_name():
+    # 2024-06-04 is a Tuesday, Monday has no feature of its own.
+    x = features([100, 100], [0, 0], [0, 0], [date(2024, 6, 4), date(2024, 6, 3)])
+    assert x[0, FEATURES.index('Tuesday')] == 1 and x[0, 4:].sum() == 1
+    assert x[1, 4:].sum() == 0
+
+
+def test_deliveries_add_to_the_cached_model_as_a_refit_would(user):
+    ids = make_history(user, MIN_HISTORY + 7)
+    deliver_loads(user.id, ids[:MIN_HISTORY])
+    db.session.commit()
+    assert get_model(user.id) is not None
+    # These are added to the cached model in Python, from the same rows the SQL fit reads.
+    deliver_loads(user.id, ids[MIN_HISTORY:])
+    db.session.commit()
+    cached, refitted = get_model(user.id), fit_model(user.id)
+    assert cached.history == refitted.history == MIN_HISTORY + 7
+    assert np.allclose(cached.xtx, refitted.xtx) and np.allclose(cached.xty, refitted.xty)
+
+
+def test_summary_fetches_the_model_once(user, monkeypatch):
+    ids = make_history(user, MIN_HISTORY + 2)
+    deliver_loads(user.id, ids[:MIN_HISTORY])
+    db.session.commit()
+    calls = []
+    monkeypatch.setattr(forecast, 'get_model', lambda user_id: calls.append(user_id) or get_model(user_id))
+    summary = summarize_open_loads(user.id)
+    assert calls == [user.id]
+    assert summary['history'] == MIN_HISTORY and summary['loads'] == 2
+
+
+def test_users_without_a_rollup_row_are_forecast(user):
+    ids = make_history(user, MIN_HISTORY)
+    deliver_loads(user.id, ids)
+    KPIRollup.query.filter_by(user_id=user.id).delete()
+    db.session.commit()
+    assert get_model(user.id).history == MIN_HISTORY
@@ -0,0 +1,36 @@
+from models import db, DistributionCenter
+from geocode import geocode_place, backfill_coordinates
+from conftest import unique, make_user, make_dc
+
+
+def new_dc(user, city, state):
+    return DistributionCenter(name=unique('DC'), address=unique('1 DC Way'), city=city, state=state, zip='30301', phone='5555555555', user_id=user.id)
+
+
+def test_known_cities_are_exact(app):
+    dc = new_dc(make_user(), 'Atlanta', 'GA')
+    assert geocode_place(dc) is None
+    assert round(dc.latitude) == 34 and dc.approximate == 0
+
+
+def test_unknown_cities_are_placed_in_their_state(app):
+    dc = new_dc(make_user(), 'Nowheresville', 'GA')
+    assert geocode_place(dc) is None
+    assert dc.latitude is not None and dc.approximate == 1
+
+
+def test_unknown_states_are_refused(app):
+    dc = new_dc(make_user(), 'Atlanta', 'ZZ')
+    assert geocode_place(dc) == 'Could not find Atlanta, ZZ. Please check the state.'
+    assert dc.latitude is None
+
+
+def test_backfill_flags_approximate_places(app):
+    user = make_user()
+    exact, approximate, unknown = make_dc(user), make_dc(user, city='Nowheresville'), make_dc(user, state='ZZ')
+    result = backfill_coordinates('dcs', threads=2, echo=lambda line: None)
+    assert result.approximate >= 1 and result.not_found >= 1
+    for dc in (exact, approximate, unknown):
+        db.session.refresh(dc)
+    assert (exact.approximate, approximate.approximate) == (0, 1)
+    assert approximate.latitude is not None and unknown.latitude is None
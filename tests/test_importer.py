@@ -0,0 +1,28 @@
+import io
+from models import Load
+from importer import text_stream
+from conftest import make_dc, make_carrier
+
+
+class ReadOnlyStream:
+    '''Only read(), like a SpooledTemporaryFile before Python 3.11.'''
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+
+def test_text_stream_needs_only_read():
+    assert text_stream(ReadOnlyStream('﻿po,name\nPO1,Load\n'.encode('utf-8'))).read() == 'po,name\nPO1,Load\n'
+
+
+def test_upload(logged_in, user):
+    carrier = make_carrier(user)
+    dc = make_dc(user)
+    data = f'po,name,city,state,due_date,temp,team,carrier,dc\nPO1,Bananas,Memphis,TN,06/03/2024,34,no,{carrier.name},{dc.name}\n'
+    response = logged_in.post('/loads/import', data={'format': 'csv', 'file': (io.BytesIO(data.encode()), 'loads.csv')},
+                              content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert Load.query.filter_by(user_id=user.id).count() == 1
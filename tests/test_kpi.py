@@ -0,0 +1,21 @@
+from datetime import date
+from models import db
+from conftest import make_dc, make_carrier, make_load
+
+
+def test_breakdown_ignores_a_bad_since(logged_in, user):
+    make_load(user, make_carrier(user), make_dc(user))
+    response = logged_in.get('/kpi/breakdown', query_string=dict(since='abc'))
+    assert response.status_code == 200
+    assert b'That is not a date' in response.data
+
+
+def test_breakdown_filters_by_since(logged_in, user):
+    dc, carrier = make_dc(user), make_carrier(user)
+    make_load(user, carrier, dc)
+    make_load(user, carrier, dc).due_date = date(2024, 7, 1)
+    db.session.commit()
+    response = logged_in.get('/kpi/breakdown', query_string=dict(since='2024-07-01', period='day'))
+    assert response.status_code == 200
+    assert b'2024-07-01' in response.data
+    assert b'2024-06-03' not in response.data
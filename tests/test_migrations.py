@@ -0,0 +1,91 @@
+from datetime import date
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+from app import create_app
+from models import db, KPIRollup
+from migrations import MIGRATIONS, ColumnChange, change_columns, migrate, pending_migrations, SMALLINT
+from conftest import TEST_DATABASE_URL
+
+
+def test_changing_a_missing_column_fails(app):
+    with pytest.raises(LookupError):
+        change_columns('loads', {'no_such_column': ColumnChange('smallint', SMALLINT, False, None)}, echo=lambda line: None)
+
+
+def test_migrations_can_run_again(app):
+    # A migration interrupted after its changes but before being recorded runs again, on a schema that has them.
+    lines = []
+    for migration in MIGRATIONS:
+        migration.run(1000, lines.append)
+    db.session.commit()
+    assert not [line for line in lines if 'converted' in line]
+
+
+# The tables as they were before any migration: dates as text, yes/no columns as integers.
+BASELINE_SCHEMA = '''
+CREATE TABLE users (id serial PRIMARY KEY, username text UNIQUE NOT NULL, password text NOT NULL);
+CREATE TABLE distribution_centers (id serial PRIMARY KEY, name text UNIQUE NOT NULL, address text UNIQUE NOT NULL, city text NOT NULL,
+    state text NOT NULL, zip text NOT NULL, phone text NOT NULL, user_id integer NOT NULL REFERENCES users);
+CREATE TABLE carriers (id serial PRIMARY KEY, name text NOT NULL, address text NOT NULL, city text NOT NULL, state text NOT NULL,
+    zip text NOT NULL, phone text NOT NULL, user_id integer NOT NULL REFERENCES users);
+CREATE TABLE loads (id serial PRIMARY KEY, po text NOT NULL, name text NOT NULL, pickup_city text NOT NULL, pickup_state text NOT NULL,
+    due_date text, day_of_week text, temp integer NOT NULL, team integer NOT NULL, miles integer NOT NULL, delivered integer,
+    user_id integer NOT NULL REFERENCES users, carrier_id integer NOT NULL REFERENCES carriers, d_c_id integer NOT NULL REFERENCES distribution_centers);
+CREATE TABLE load_data (id serial PRIMARY KEY, load_id integer UNIQUE NOT NULL REFERENCES loads, user_id integer NOT NULL REFERENCES users,
+    ontime integer, damges integer, breakdown integer, cost integer, pallets integer, weight integer, delivered integer);
+INSERT INTO users (username, password) VALUES ('old', 'not a hash');
+INSERT INTO distribution_centers (name, address, city, state, zip, phone, user_id) VALUES ('DC', '1 DC Way', 'Atlanta', 'GA', '30301', '5555555555', 1);
+INSERT INTO carriers (name, address, city, state, zip, phone, user_id) VALUES ('Carrier', '1 Carrier Way', 'Dallas', 'TX', '75201', '5555555555', 1);
+INSERT INTO loads (po, name, pickup_city, pickup_state, due_date, day_of_week, temp, team, miles, delivered, user_id, carrier_id, d_c_id) VALUES
+    ('PO1', 'ISO date', 'Memphis', 'TN', '2024-06-03', 'Monday', 34, 1, 400, 1, 1, 1, 1),
+    ('PO2', 'US date', 'Memphis', 'TN', '06/04/2024', 'Tuesday', 0, 0, 500, 0, 1, 1, 1),
+    ('PO3', 'No date', 'Memphis', 'TN', 'next week', NULL, 0, 0, 600, 0, 1, 1, 1);
+INSERT INTO load_data (load_id, user_id, ontime, damges, breakdown, cost, pallets, weight, delivered) VALUES
+    (1, 1, 1, 0, 1, 1200, 10, 20000, 1), (2, 1, 0, 0, 0, 0, 0, 0, 0), (3, 1, 0, 0, 0, 0, 0, 0, 0);
+'''
+
+
+@pytest.fixture
+def baseline(app):
+    '''An app on a scratch database with the baseline schema and a few rows, dropped afterwards.'''
+    url = make_url(TEST_DATABASE_URL)
+    name = f'{url.database}_baseline'
+    server = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    server.execute(f'DROP DATABASE IF EXISTS {name}')
+    server.execute(f'CREATE DATABASE {name}')
+    url.database = name
+    old = create_app({'SQLALCHEMY_DATABASE_URI': str(url), 'TESTING': True, 'BCRYPT_POOL_SIZE': 0, 'DISTANCE_PROVIDER': 'offline'})
+    # The session is shared between app contexts, let go of the test database's connection first.
+    db.session.remove()
+    try:
+        with old.app_context():
+            db.engine.execute(text(BASELINE_SCHEMA))
+            yield old
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        server.execute(f'DROP DATABASE IF EXISTS {name}')
+        server.close()
+
+
+def test_a_baseline_database_is_migrated(baseline):
+    # What runs before the new code is deployed must be enough for it.
+    migrate(to=16, echo=lambda line: None)
+    client = baseline.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    for path in ('/manage', '/locations', '/carriers', '/kpi', '/lanes'):
+        assert client.get(path).status_code == 200, path
+
+    migrate(echo=lambda line: None)
+    rows = db.engine.execute('SELECT due_date, team, delivered, miles_pending FROM loads ORDER BY id').fetchall()
+    assert [tuple(row) for row in rows] == [(date(2024, 6, 3), 1, 1, 0), (date(2024, 6, 4), 0, 0, 0), (None, 0, 0, 0)]
+    data = db.engine.execute('SELECT ontime, damges, breakdown, delivered FROM load_data WHERE load_id = 1').first()
+    assert tuple(data) == (1, 0, 1, 1)
+    types = dict(db.engine.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_name IN ('loads', 'load_data')"
+                                   " AND column_name IN ('due_date', 'team', 'ontime', 'day_of_week')").fetchall())
+    assert types == {'due_date': 'date', 'team': 'smallint', 'ontime': 'smallint'}
+    rollup = KPIRollup.query.get(1)
+    assert (rollup.delivered, rollup.ontime, rollup.breakdown, rollup.cost) == (1, 1, 1, 1200)
+    assert [migration.version for migration in pending_migrations()] == []
@@ -0,0 +1,45 @@
+from concurrent.futures import Future
+from models import db, Load, MileageJob
+from mileage import claim_jobs, process_jobs, dc_address_changed, MAX_ATTEMPTS
+from conftest import make_user, make_dc, make_carrier, make_load
+
+
+class InlinePool:
+    '''Runs submitted calls straight away, enough for process_jobs.'''
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+def test_jobs_that_cannot_be_placed_give_up_without_failing_the_batch(app):
+    user = make_user()
+    carrier = make_carrier(user)
+    good = make_load(user, carrier, make_dc(user))
+    bad = make_load(user, carrier, make_dc(user, state='ZZ'), miles=123)
+    for load in (good, bad):
+        db.session.add(MileageJob(load_id=load.id, status='pending', attempts=MAX_ATTEMPTS - 1))
+        load.miles_pending = 1
+    db.session.commit()
+    done, failed = process_jobs(claim_jobs(), InlinePool())
+    assert (done, failed) == (1, 1)
+    db.session.expire_all()
+    assert Load.query.get(bad.id).miles == 123 and Load.query.get(bad.id).miles_pending == 0
+    assert MileageJob.query.filter_by(load_id=bad.id).one().status == 'failed'
+    assert Load.query.get(good.id).miles_pending == 0
+
+
+def test_dc_address_change_relocates_and_queues(app):
+    user = make_user()
+    dc = make_dc(user)
+    load = make_load(user, make_carrier(user), dc)
+    dc.city, dc.latitude, dc.longitude = 'Savannah', 0.0, 0.0
+    problem, queued = dc_address_changed(dc)
+    db.session.commit()
+    assert problem is None and queued == 1
+    assert round(dc.latitude) == 32
+    assert MileageJob.query.filter_by(load_id=load.id).count() == 1
@@ -0,0 +1,80 @@
+'''SQL statements per request of the busiest pages. A change in a count is a change in round trips,
+so if one of these fails, check that the new queries are worth it before updating the number.'''
+from contextlib import contextmanager
+from sqlalchemy import event
+import pytest
+from lifecycle import deliver_loads
+from models import db, Load
+from conftest import unique, make_dc, make_carrier, make_load
+
+
+@contextmanager
+def count_queries():
+    '''Collects the statements sent while inside the block. Load event writes go out in the background, so they are left out.'''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('INSERT INTO LOAD_EVENTS'):
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture
+def board(logged_in, user):
+    '''A user with a DC, a carrier, an open load and a delivered one, and their pages visited once so caches are warm.'''
+    dc = make_dc(user)
+    carrier = make_carrier(user)
+    open_load = make_load(user, carrier, dc)
+    delivered = make_load(user, carrier, dc, city='Dallas', state='TX')
+    deliver_loads(user.id, [delivered.id])
+    db.session.commit()
+    for path in ('/manage', '/kpi', '/lanes'):
+        logged_in.get(path)
+    return dict(client=logged_in, dc=dc, carrier=carrier, open_load=open_load, delivered=delivered)
+
+
+def queries(board, method, path, **kwargs):
+    with count_queries() as statements:
+        response = getattr(board['client'], method)(path, **kwargs)
+    assert response.status_code in (200, 302), response.status_code
+    return len(statements)
+
+
+def test_manage(board):
+    assert queries(board, 'get', '/manage') == 5
+
+
+def test_create_load(board):
+    po = unique('PO')
+    form = dict(po=po, name='Bananas', city='Memphis', state='TN', due_date='06/03/2024', temp=34, team=0,
+                carrier_id=board['carrier'].id, d_c_id=board['dc'].id)
+    assert queries(board, 'post', '/manage', data=form) == 4
+    assert Load.query.filter_by(po=po).count() == 1
+
+
+def test_kpi(board):
+    assert queries(board, 'get', '/kpi') == 1
+
+
+def test_lanes(board):
+    assert queries(board, 'get', '/lanes') == 1
+
+
+def test_update_load(board):
+    load_id = board['delivered'].id
+    assert queries(board, 'get', f'/update_load/{load_id}') == 1
+    form = dict(ontime=1, damages=0, breakdown=0, cost=1200, pallets=10, weight=20000)
+    assert queries(board, 'post', f'/update_load/{load_id}', data=form) == 5
+
+
+def test_update_location(board):
+    assert queries(board, 'post', f'/update_location/{board["open_load"].id}', data=dict(city='Dallas', state='TX')) == 2
+
+
+def test_delivered(board):
+    assert queries(board, 'post', f'/delivered/{board["open_load"].id}') == 6
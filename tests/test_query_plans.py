@@ -0,0 +1,64 @@
+'''The index each per user read is planned with, on a database shared by several users. Plans are
+made with sequential scans turned off, so the planner only picks one when no index can serve the
+query. benchmarks/explain.py runs the same check on a database of any size.'''
+import re
+import pytest
+from models import db
+from benchmarks.generate import generate, analyze
+from benchmarks.explain import hot_reads, record_statements, full_scans, indexes_used
+from lanes import rebuild_lanes
+from scorecard import rebuild_carrier_scores
+from conftest import unique
+
+# The indexes each hot read's queries use between them.
+EXPECTED = {
+    'Load.get_open_loads_page': {'ix_loads_open_board'},
+    'Load.get_open_loads_page[carrier,dc]': {'ix_loads_user_carrier_dc_due'},
+    'Load.get_open_loads_page[due]': {'ix_loads_open_board'},
+    'Carrier.get_carrier_by_user': {'ix_carriers_user'},
+    'DistributionCenter.get_dist_by_user': {'ix_distribution_centers_user'},
+    'LoadData.get_load_data_by_user': {'ix_load_data_user_delivered'},
+    'refdata.get_choices[carriers]': {'users_pkey', 'ix_carriers_user'},
+    'refdata.get_choices[dcs]': {'ix_distribution_centers_user'},
+    'kpi.get_user_totals': {'ix_load_data_user_delivered'},
+    'kpi.get_user_kpis': {'kpi_rollups_pkey'},
+    'kpi.get_grouped_kpis[carrier,dc]': {'ix_loads_user_id', 'load_data_load_id_key', 'ix_carriers_user', 'ix_distribution_centers_user'},
+    'forecast.score_open_loads': {'kpi_rollups_pkey', 'ix_loads_user_id', 'ix_load_data_user_delivered', 'ix_loads_open_board'},
+    'alerts.count_alerts': {'ix_load_alerts_user_kind'},
+    'alerts.get_load_alerts': {'ix_load_alerts_user_kind'},
+    'lanes.search_lanes': {'ix_lane_stats_user_origin', 'distribution_centers_pkey'},
+    'scorecard.rank_carriers': {'ix_carrier_scores_user'},
+    'export.export_rows': {'ix_loads_user_id', 'load_data_load_id_key', 'ix_carriers_user', 'ix_distribution_centers_user'},
+    # Every monthly partition's copy of the index.
+    'events.get_timeline': {'load_id_created_at_idx'},
+}
+
+
+@pytest.fixture(scope='module')
+def reads(app):
+    '''The hot reads of the last of three benchmark users, by name.'''
+    user_ids = [generate(unique('tenant'), 300, seed=index / 4).id for index in range(3)]
+    rebuild_lanes()
+    rebuild_carrier_scores()
+    analyze()
+    return dict(hot_reads(user_ids[-1]))
+
+
+def test_every_hot_read_is_checked(reads):
+    assert set(reads) == set(EXPECTED)
+
+
+@pytest.fixture(params=sorted(EXPECTED))
+def read(request, reads):
+    return request.param, reads[request.param]
+
+
+def test_hot_read_uses_its_indexes(read):
+    name, call = read
+    statements = record_statements(db.engine, call)
+    assert statements
+    used = set()
+    for statement, parameters in statements:
+        assert not full_scans(db.engine, statement, parameters), statement
+        used |= {re.sub(r'^load_events_\w+?_(load_id_created_at_idx)$', r'\1', index) for index in indexes_used(db.engine, statement, parameters)}
+    assert used == EXPECTED[name]
@@ -0,0 +1,66 @@
+'''Running sums kept per key in a table, like the lane stats and carrier scores.
+
+Each table has a namedtuple of counters. Changes are applied as deltas: summed per key, then written
+with one upsert that adds them to the stored sums, inside the caller's transaction. A rebuild
+recomputes the rows from an aggregate query over the delivered loads instead.
+'''
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
+from models import db
+
+
+def flag_sum(column):
+    '''SQL counting the rows where a 0/1 flag column is set.'''
+    return func.coalesce(func.sum(case([(column == 1, 1)], else_=0)), 0)
+
+
+def value_sum(column):
+    '''SQL summing a numeric column, treating missing values as 0.'''
+    return func.coalesce(func.sum(column), 0)
+
+
+def add_totals(a, b):
+    '''Adds two sets of counters of the same kind.'''
+    return type(a)(*[x + y for x, y in zip(a, b)])
+
+
+def subtract_totals(new, old):
+    '''Returns the change between two sets of counters of the same kind.'''
+    return type(new)(*[n - o for n, o in zip(new, old)])
+
+
+def apply_deltas(model, keys, user_id, deltas):
+    '''Adds (key, counters) deltas to a model's table inside the current transaction.
+
+    keys names the primary key columns held by each key tuple, in order. Deltas for the same key
+    are summed first, and every row is written by one upsert.
+    '''
+    summed = {}
+    for key, delta in deltas:
+        summed[key] = add_totals(summed[key], delta) if key in summed else delta
+    # Sorted so concurrent transactions lock rows in the same order.
+    rows = [dict(zip(keys, key), user_id=user_id, **delta._asdict()) for key, delta in sorted(summed.items()) if any(delta)]
+    if not rows:
+        return
+    fields = next(iter(summed.values()))._fields
+    table = model.__table__
+    stmt = insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(index_elements=list(keys), set_={field: table.c[field] + stmt.excluded[field] for field in fields})
+    db.session.execute(stmt)
+
+
+def rebuild_totals(model, columns, query, user_id=None):
+    '''Replaces a model's rows, for one user or everyone, with the rows of an aggregate query, and commits.
+
+    columns names the query's columns in order, and the query is already limited to user_id's loads.
+    Returns the number of rows written.
+    '''
+    stale = model.query
+    if user_id is not None:
+        stale = stale.filter(model.user_id == user_id)
+    rows = [dict(zip(columns, row)) for row in query]
+    stale.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
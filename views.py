@@ -0,0 +1,389 @@
+'''Pages of the site. Registered on the app by create_app.'''
+from datetime import date
+from flask import Blueprint, Response, request, render_template, redirect, flash, session, stream_with_context, url_for
+from models import db, User, DistributionCenter, Load, Carrier, LoadData
+from forms import states, LoginForm, SignupForm, DCCarrierForm, LoadForm, UpdateLocationForm, LoadDataForm, LoadImportForm
+from helper import tenant_query, get_user_carriers, get_dc, get_miles, get_board_filters, get_page_size, encode_cursor, decode_cursor, try_commit, try_commit_rollback, try_signup
+from events import record_event
+from passwords import login_wait, PasswordsBusy
+from export import export_rows, csv_chunks, STATUSES
+from importer import import_loads, text_stream
+from lifecycle import deliver_loads, update_locations
+from alerts import get_load_alerts, count_alerts
+from forecast import score_loads, summarize_open_loads, MIN_HISTORY
+from lanes import lane_of, lane_counters, apply_lane_deltas, get_lane, search_lanes
+from geocode import geocode_place
+from scorecard import carrier_counters, apply_carrier_deltas, rank_choices
+from kpi import get_user_kpis, get_grouped_kpis, load_data_counters, apply_rollup_delta
+from totals import subtract_totals
+
+views = Blueprint('views', __name__)
+
+# 
+# LANDING PAGE
+# 
+
+@views.route('/')
+def home():
+    '''Renders home screen or user's manage page.'''
+    # Checks if user id in session and directs accordingly!
+    if 'user_id' in session:
+        return redirect('/manage')
+    return render_template('home.html')
+
+# 
+# Login, SignUp, and Logout views
+# 
+
+@views.route('/login', methods=['GET', 'POST'])
+def login():
+    '''Renders and handles the login.'''
+    form = LoginForm()
+    if form.validate_on_submit():
+        username = form.username.data
+        password = form.password.data
+        # Turns away floods of attempts before any password is hashed.
+        if login_wait(username):
+            flash('Too many login attempts, please wait a minute and try again.', 'alert-danger')
+            return render_template('login.html', form=form), 429
+        # Checks user credentials
+        try:
+            user = User.authenticate(username=username, password=password)
+        except PasswordsBusy:
+            flash('Lots of people are logging in right now, please try again in a moment.', 'alert-danger')
+            return render_template('login.html', form=form), 503
+        # If user is authenticated we set users session.
+        if user:
+            session['user_id'] = user.id
+            flash(f'Welcome back {username}!', 'alert-success')
+            return redirect('/manage')
+        else:
+            flash('Username/Password is incorrect.', 'alert-danger')
+    return render_template('login.html', form=form)
+
+@views.route('/signup', methods=['GET', 'POST'])
+def signup():
+    '''Renders and handles the signup.'''
+    form = SignupForm()
+    if form.validate_on_submit():
+        username = form.username.data
+        password = form.password.data
+        if login_wait():
+            flash('Too many attempts, please wait a minute and try again.', 'alert-danger')
+            return render_template('signup.html', form=form), 429
+        # Signs user up
+        try:
+            user = User.singup(username=username, password=password)
+        except PasswordsBusy:
+            flash('Lots of people are signing up right now, please try again in a moment.', 'alert-danger')
+            return render_template('signup.html', form=form), 503
+        # Verifies if user was created before commiting to database
+        if user:
+            db.session.add(user)
+            return try_signup(id=user.id, success='User was created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/', duplicate='You already have an account. Please login!')
+    return render_template('signup.html', form=form)
+
+@views.route('/logout', methods=['POST'])
+def logout():
+    '''Handles logging out a user.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    session.pop('user_id')
+    flash("You've been logged out!", 'alert-success')
+    return redirect('/')
+
+# 
+# USER VIEWS
+# 
+
+@views.route('/manage', methods=['GET', 'POST'])
+def user_portal():
+    '''Renders the user portal.'''
+    # Checks if user has been autherized prior to allowing entrance to route.
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    # Sets forms carrier and DC options.
+    tup_carriers = get_user_carriers()
+    tup_dc = get_dc()
+    filters = get_board_filters(request.args)
+    # Selectfield form values.
+    form = LoadForm()
+    # Best carriers first, for the D.C. the board is filtered to if any.
+    form.carrier_id.choices = rank_choices(user_id=session['user_id'], choices=tup_carriers, d_c_id=filters['d_c_id'])
+    form.d_c_id.choices = tup_dc
+    if form.validate_on_submit():
+        po = form.po.data
+        name = form.name.data
+        city = form.city.data
+        state = form.state.data
+        due_date = form.due_date.data
+        temp = form.temp.data
+        team = form.team.data
+        carrier_id = form.carrier_id.data
+        d_c_id = form.d_c_id.data
+        # Gets the distance from the configured provider (offline by default, or MapQuest)
+        miles = get_miles(dc_id=d_c_id, city=city, state=state)
+        if miles is None:
+            flash(f'Could not find {city}, {state}. Please check the pickup location.', 'alert-danger')
+            return redirect('/manage')
+        # Creates load object with its load data, so that a user can add/edit from one route.
+        load = Load(po=po, name=name, pickup_city=city, pickup_state=state, due_date=due_date, temp=temp, team=team, miles=miles, carrier_id=carrier_id, d_c_id=d_c_id, user_id=session['user_id'])
+        load.data = LoadData(user_id=session['user_id'])
+        try:
+            # Both rows are written in one flush, the load data picks up the new load id.
+            db.session.add(load)
+            db.session.flush()
+            record_event(load.id, load.user_id, 'created', pickup_city=city, pickup_state=state, miles=miles)
+            db.session.commit()
+            flash('Load created!', 'alert-success')
+        except Exception as ex:
+            db.session.rollback()
+            flash('Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', 'alert-danger')
+        # Redirects either way, so refreshing the page doesn't post the load again.
+        return redirect('/manage')
+    # Grabs one page of open loads, sorted and filtered in the database.
+    per_page = get_page_size(request.args)
+    loads = Load.get_open_loads_page(user_id=session['user_id'], after=decode_cursor(request.args.get('after')), limit=per_page, **filters)
+    next_page = None
+    if len(loads) > per_page:
+        loads = loads[:per_page]
+        args = {key: value for key, value in request.args.items() if key != 'after'}
+        next_page = url_for('.user_portal', after=encode_cursor(loads[-1]), **args)
+    # Cost and on time forecasts for the page, scored in one batch.
+    forecasts = score_loads(user_id=session['user_id'], loads=loads)
+    # Alerts come from the table the alert evaluator keeps up to date.
+    alerts = get_load_alerts(user_id=session['user_id'], load_ids=[load.id for load in loads])
+    alert_counts = count_alerts(user_id=session['user_id'])
+    return render_template('user/portal.html', form=form, loads=loads, filters=filters, per_page=per_page, next_page=next_page,
+                           carriers=tup_carriers, dcs=tup_dc, states=states, paged='after' in request.args, forecasts=forecasts,
+                           due=request.args.get('due', ''), alerts=alerts, alert_counts=alert_counts)
+
+@views.route('/loads/import', methods=['GET', 'POST'])
+def import_loads_view():
+    '''Renders and handles bulk load uploads.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    form = LoadImportForm()
+    result = None
+    if form.validate_on_submit():
+        result = import_loads(text_stream(form.file.data.stream), user_id=session['user_id'], fmt=form.format.data)
+        flash(f'{result.imported} loads imported, {result.failed} rows skipped.', 'alert-success' if not result.failed else 'alert-warning')
+    return render_template('user/import.html', form=form, result=result)
+
+@views.route('/loads/export.csv')
+def export_loads_view():
+    '''Streams the user's loads as a CSV download.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    status = request.args.get('status', 'all')
+    if status not in STATUSES:
+        status = 'all'
+    rows = export_rows(user_id=session['user_id'], status=status)
+    return Response(stream_with_context(csv_chunks(rows)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename=loads_{status}.csv'})
+
+@views.route('/locations', methods=['GET', 'POST'])
+def locations():
+    '''Renders and handles DC locations users add.'''
+    # Checks if user has been autherized prior to allowing entrance to route.
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    form = DCCarrierForm()
+    # Grabs all user DC locations
+    dc = DistributionCenter.get_dist_by_user(user_id=session['user_id'])
+    if form.validate_on_submit():
+        name = form.name.data
+        address = form.address.data
+        city = form.city.data
+        state = form.state.data
+        zip = form.zip.data
+        phone = form.phone.data
+        # Creates a new DC location
+        dc = DistributionCenter(name=name, address=address, city=city, state=state, zip=zip, phone=phone, user_id=session['user_id'])
+        # Located once here, so a misspelled city is caught before any miles are worked out from it.
+        problem = geocode_place(dc)
+        if problem:
+            flash(problem, 'alert-danger')
+            return render_template('user/locations.html', form=form, dc=DistributionCenter.get_dist_by_user(user_id=session['user_id']))
+        if dc.approximate:
+            flash(f'Could not find {city}, {state} exactly, distances will be measured from the middle of {state}.', 'alert-warning')
+        # If location was created, we commit.
+        if dc:
+            db.session.add(dc)
+            return try_commit_rollback(success='Location created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/locations', duplicate="Location has already been added by another user. Locations have to be unqiue to each user. See our FAQ's for more info.")
+    return render_template('user/locations.html', form=form, dc=dc)
+
+@views.route('/carriers', methods=['GET', 'POST'])
+def carriers():
+    '''Renders and handles carriers the user adds.'''
+    # Checks if user has been autherized prior to allowing entrance to route.
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    form = DCCarrierForm()
+    # Grabs all the carrier information.
+    carriers = Carrier.get_carrier_by_user(user_id=session['user_id'])
+    if form.validate_on_submit():
+        name = form.name.data
+        address = form.address.data
+        city = form.city.data
+        state = form.state.data
+        zip = form.zip.data
+        phone = form.phone.data
+        # Creates a carrier.
+        carrier = Carrier(name=name, address=address, city=city, state=state, zip=zip, phone=phone, user_id=session['user_id'])
+        problem = geocode_place(carrier)
+        if problem:
+            flash(problem, 'alert-danger')
+            return render_template('user/carriers.html', form=form, carriers=carriers)
+        if carrier.approximate:
+            flash(f'Could not find {city}, {state} exactly, the carrier is placed in the middle of {state}.', 'alert-warning')
+        # If carrier was created we commit it.
+        if carrier:
+            db.session.add(carrier)
+            return try_commit_rollback(success='Carrier created!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.', route='/carriers')
+    return render_template('user/carriers.html', form=form, carriers=carriers)
+
+@views.route('/update_load/<int:load_id>', methods=['GET', 'POST'])
+def update_load(load_id):
+    '''Renders and handles the load data updates.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/') 
+    # One query for the user's load data; it is locked on submit so the KPI rollup delta is worked out from current values.
+    query = tenant_query(LoadData).filter_by(load_id=load_id)
+    if request.method == 'POST':
+        query = query.with_for_update()
+    data = query.first()
+    if not data:
+        flash('That load could not be found.', 'alert-danger')
+        return redirect('/manage')
+    form = LoadDataForm(obj=data)
+    if form.validate_on_submit():
+        before = load_data_counters(data)
+        lane_before = lane_counters(data, data.load.miles) if data.delivered == 1 else None
+        carrier_before = carrier_counters(data, data.load.miles) if data.delivered == 1 else None
+        data.ontime = form.ontime.data
+        data.damges = form.damages.data
+        data.breakdown = form.breakdown.data
+        data.cost = form.cost.data
+        data.pallets = form.pallets.data
+        data.weight = form.weight.data
+        # Delivered loads are already counted in the KPI rollup, so it gets the difference.
+        if data.delivered == 1:
+            apply_rollup_delta(user_id=data.user_id, delta=subtract_totals(load_data_counters(data), before))
+            load = data.load
+            apply_lane_deltas(data.user_id, [(lane_of(load.pickup_city, load.pickup_state, load.d_c_id), subtract_totals(lane_counters(data, load.miles), lane_before))])
+            apply_carrier_deltas(data.user_id, [((load.carrier_id, load.d_c_id), subtract_totals(carrier_counters(data, load.miles), carrier_before))])
+        record_event(load_id, data.user_id, 'data', detail={field: form[field].data for field in ('ontime', 'damages', 'breakdown', 'cost', 'pallets', 'weight')})
+        # Once object has been updated we commit.
+        return try_commit(success='Load Data added!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
+    return render_template('user/load.html', form=form)
+
+@views.route('/update_location/<int:load_id>', methods=['GET', 'POST'])
+def update_location(load_id):
+    '''Renders and handles updates to load locations.'''
+    # Checks if user has been autherized prior to allowing entrance to route.
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')    
+    form = UpdateLocationForm()
+    if form.validate_on_submit():
+        # With a remote distance provider the miles are recalculated by the background worker.
+        status = update_locations(user_id=session['user_id'], updates=[{'id': load_id, 'city': form.city.data, 'state': form.state.data}])[load_id]
+        if status == 'not_found':
+            flash('That load could not be found.', 'alert-danger')
+            return redirect('/manage')
+        success = 'Location updated! Miles are being recalculated.' if status == 'pending' else 'Location updated!'
+        # Commits changes.
+        return try_commit(success=success, fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
+    return render_template('user/update.html', form=form)
+
+@views.route('/delivered/<int:load_id>', methods=['POST'])
+def completed(load_id):
+    '''Handles when a load is marked as delivered.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    # A single set based UPDATE per table, only the first delivery is added to the KPI rollup.
+    status = deliver_loads(user_id=session['user_id'], load_ids=[load_id])[load_id]
+    if status == 'not_found':
+        flash('That load could not be found.', 'alert-danger')
+        return redirect('/manage')
+    # Commits the change.
+    return try_commit(success='Load was delivered!', fail='Something went wrong, please try again later. If this continues please email meet.gio@icloud.com.')
+
+@views.route('/kpi')
+def show_kpi():
+    '''Gathers KPI's and renders results.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    # All six KPI's come from one aggregate query.
+    kpis = get_user_kpis(user_id=session['user_id'])
+    return render_template('user/kpi.html', **kpis._asdict())
+
+@views.route('/kpi/breakdown')
+def show_kpi_breakdown():
+    '''Renders KPI's grouped by carrier and/or DC and due date period.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    by = request.args.get('by', 'carrier')
+    period = request.args.get('period', 'month')
+    try:
+        since = date.fromisoformat(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        flash('That is not a date, showing every period instead.', 'alert-warning')
+        since = None
+    group_by = ('carrier', 'dc') if by == 'both' else (by,)
+    groups = get_grouped_kpis(user_id=session['user_id'], group_by=group_by, period=period, since=since)
+    return render_template('user/kpi_breakdown.html', groups=groups, by=by, period=period, since=since or '')
+
+@views.route('/lanes')
+def show_lanes():
+    '''Renders lane stats, for one lane or a search by pickup location and DC.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    city = request.args.get('city', '').strip()
+    state = request.args.get('state', '').strip().upper()
+    try:
+        d_c_id = int(request.args.get('d_c_id') or 0) or None
+    except ValueError:
+        d_c_id = None
+    # A full lane is a primary key lookup, anything less searches the user's busiest lanes.
+    if city and state and d_c_id:
+        lane = get_lane(user_id=session['user_id'], city=city, state=state, d_c_id=d_c_id)
+        lanes = [lane._replace(dc=dict(get_dc()).get(d_c_id))] if lane else []
+    else:
+        lanes = search_lanes(user_id=session['user_id'], city=city, state=state, d_c_id=d_c_id)
+    return render_template('user/lanes.html', lanes=lanes, dcs=get_dc(), states=states, city=city, state=state, d_c_id=d_c_id)
+
+@views.route('/forecast')
+def show_forecast():
+    '''Renders the forecast cost and on time odds of every open load.'''
+    if 'user_id' not in session:
+        flash('You must be logged to access', 'alert-danger')
+        return redirect('/')
+    summary = summarize_open_loads(user_id=session['user_id'])
+    return render_template('user/forecast.html', summary=summary, carriers=dict(get_user_carriers()), min_history=MIN_HISTORY)
+
+# 
+# 404 PAGE
+# 
+@views.app_errorhandler(404)
+def page_not_found(e):
+    '''Custom 404 page'''
+    return render_template('404.html'), 404
+# 
+# FAQ'S
+# 
+@views.route('/faqs')
+def faq():
+    return render_template('user/faqs.html')